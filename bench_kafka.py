@@ -0,0 +1,594 @@
+#!/usr/bin/env python
+""" Micro benchmarks for pykafka's hot paths.
+
+    Usage: python bench_kafka.py [--json PATH] [benchmark ...]
+
+    The produce benchmarks write to a local socket that discards everything
+    it receives (produce requests get no response in the 0.7 protocol), so
+    they measure encoding and syscall overhead without needing a broker.
+    The codec, compression, parse and sizes benchmarks don't touch a socket 
+    at all. The cluster and transport benchmarks run against 
+    kafka.fakebroker.FakeBroker.
+
+    With --json, the results are also written to PATH ('-' for stdout) as
+    a JSON document, one entry per line of output, to compare runs with.
+"""
+import json
+import platform
+import socket
+import struct
+import sys
+import threading
+import time
+from cStringIO import StringIO
+from functools import partial
+
+from kafka import Kafka, Lengths, COMPRESSION_NONE, COMPRESSION_GZIP, \
+    COMPRESSION_SNAPPY
+from kafka.cluster import KafkaCluster
+from kafka.compression import snappy
+from kafka.fakebroker import FakeBroker
+from kafka.producer import AsyncProducer
+from kafka.protocol import Codec, Connection, LazyMessageSet
+
+try:
+    from tornado.ioloop import IOLoop
+    from kafka.nonblocking import KafkaTornado
+except ImportError:
+    KafkaTornado = None
+
+# How the metrics benchmarks report are shown, in this order. Anything 
+# else they report (message sizes and such) only goes in the JSON output.
+FORMATS = [
+    ('msgs_per_sec', '{0:>12.0f} msgs/sec'),
+    ('requests_per_sec', '{0:>12.0f} requests/sec'),
+    ('mb_per_sec', '{0:>10.1f} MB/sec'),
+    ('p50_ms', '{0:>8.2f} ms p50'),
+    ('p99_ms', '{0:>8.2f} ms p99'),
+    ('wire_bytes', '{0:>8} bytes on the wire'),
+    ('wire_ratio', '({0:>5.1%} of payloads)'),
+    ('encode_msgs_per_sec', '{0:>10.0f} encoded msgs/sec'),
+    ('decode_msgs_per_sec', '{0:>10.0f} decoded msgs/sec'),
+    ('held_per_fetched', '{0:>8.1f} MB held per MB fetched'),
+    ('first_message_ms', '{0:>8.1f} ms to the first message,'),
+    ('total_ms', '{0:>8.1f} ms in all'),
+]
+
+# What _report() got, for --json
+results = []
+current_benchmark = None
+
+def _report(name, **values):
+    """ Print a line of results and keep them for the JSON output. """
+    print '{0:<24} {1}'.format(name, ' '.join(format.format(values[key]) 
+        for key, format in FORMATS if key in values))
+    values.update(benchmark=current_benchmark, name=name)
+    results.append(values)
+
+def _percentiles(latencies):
+    """ The p50 and p99 of latencies, in seconds, as _report() values. """
+    latencies = sorted(latencies)
+    def percentile(percent):
+        return 1000 * latencies[min(len(latencies) - 1, 
+            int(len(latencies) * percent / 100.0))]
+    return dict(p50_ms=percentile(50), p99_ms=percentile(99))
+
+def _timeit(func, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def _discard_server():
+    """ Start a local server that reads and drops everything sent to it. """
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+
+    def drain(conn):
+        while conn.recv(1024 * 1024):
+            pass
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            thread = threading.Thread(target=drain, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()
+
+def _canned_response_server(response):
+    """ Start a local server that answers every request with `response`. """
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    framed_response = struct.pack('>I', len(response)) + response
+
+    def read_exactly(conn, length):
+        data = ''
+        while len(data) < length:
+            chunk = conn.recv(length - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def answer(conn):
+        try:
+            while True:
+                request_size = struct.unpack('>I', read_exactly(conn, 4))[0]
+                read_exactly(conn, request_size)
+                conn.sendall(framed_response)
+        except (EOFError, socket.error):
+            conn.close()
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            thread = threading.Thread(target=answer, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()
+
+def bench_multi_produce(num_partitions=32, messages_per_partition=10,
+        message_size=100, ticks=200):
+    host, port = _discard_server()
+    kafka = Kafka(host=host, port=port)
+    message = 'x' * message_size
+    batch = dict((('bench', partition), [message] * messages_per_partition)
+                 for partition in range(num_partitions))
+    total_messages = num_partitions * messages_per_partition * ticks
+
+    def loop_produce():
+        for i in range(ticks):
+            for (topic, partition), messages in batch.iteritems():
+                kafka.produce(topic, messages, partition)
+
+    def multi_produce():
+        for i in range(ticks):
+            kafka.multi_produce(batch)
+
+    for name, func in [('produce() loop', loop_produce),
+                       ('multi_produce()', multi_produce)]:
+        elapsed = _timeit(func)
+        _report(name, msgs_per_sec=total_messages / elapsed)
+
+def bench_async_produce(message_size=100, num_messages=50000):
+    host, port = _discard_server()
+    message = 'x' * message_size
+
+    def produce():
+        kafka = Kafka(host=host, port=port)
+        for i in xrange(num_messages):
+            kafka.produce('bench', message)
+
+    def async_produce():
+        producer = AsyncProducer(Kafka(host=host, port=port))
+        for i in xrange(num_messages):
+            producer.send('bench', message)
+        producer.close()
+
+    for name, func in [('produce() per msg', produce),
+                       ('AsyncProducer', async_produce)]:
+        elapsed = _timeit(func)
+        _report(name, msgs_per_sec=num_messages / elapsed)
+
+def bench_encode(message_sizes=(10, 100), messages_per_request=10,
+        requests=20000):
+    """ Small produce requests, the kind a producer sends when it doesn't
+        batch much, where the per request and per message overhead shows
+        the most. """
+    codec = Codec()
+    total_messages = messages_per_request * requests
+    for message_size in message_sizes:
+        messages = ['x' * message_size] * messages_per_request
+
+        def produce_request():
+            for i in xrange(requests):
+                codec.produce_request('bench', messages, i % 8)
+
+        elapsed = _timeit(produce_request)
+        _report('{0} byte messages'.format(message_size), 
+            msgs_per_sec=total_messages / elapsed, message_size=message_size)
+
+def bench_codec(message_size=100, num_messages=1000, requests=200):
+    codec = Codec()
+    message = 'x' * message_size
+    messages = [message] * num_messages
+    total_messages = num_messages * requests
+
+    def produce_request():
+        for i in xrange(requests):
+            codec.produce_request('bench', messages, 0)
+
+    def framed_produce_request():
+        buffer = bytearray()
+        for i in xrange(requests):
+            codec.frame_into(buffer, 
+                codec.produce_request('bench', messages, 0))
+            del buffer[:]
+
+    for name, func in [('produce request', produce_request),
+                       ('framed into buffer', framed_produce_request)]:
+        elapsed = _timeit(func)
+        _report(name, msgs_per_sec=total_messages / elapsed)
+
+    def fetch_request():
+        for i in xrange(total_messages):
+            codec.fetch_request('bench', i, 0, Kafka.DEFAULT_MAX_SIZE)
+
+    elapsed = _timeit(fetch_request)
+    _report('fetch request', requests_per_sec=total_messages / elapsed)
+
+    # Fetch responses fed to a Connection in network sized chunks
+    body = struct.pack('>H', 0) + codec.encode_message_set(messages)
+    data = (struct.pack('>I', len(body)) + body) * requests
+    chunk_size = 64 * 1024
+    chunks = [data[i:i + chunk_size] for i in xrange(0, len(data), chunk_size)]
+
+    def receive_data():
+        connection = Connection(codec)
+        for i in xrange(requests):
+            connection.fetch('bench', 0)
+        for chunk in chunks:
+            connection.receive_data(chunk)
+
+    elapsed = _timeit(receive_data)
+    _report('fetch responses', msgs_per_sec=total_messages / elapsed)
+
+def bench_compression(num_messages=1000):
+    codec = Codec()
+    # Small, repetitive JSON documents
+    messages = ['{{"host": "web-{0}", "metric": "requests", "value": {1}, '
+                '"tags": ["env:prod", "role:frontend"]}}'.format(i % 20, i)
+                for i in range(num_messages)]
+    raw_size = sum(len(message) for message in messages)
+
+    codecs = [('none', COMPRESSION_NONE), ('gzip', COMPRESSION_GZIP)]
+    if snappy is not None:
+        codecs.append(('snappy', COMPRESSION_SNAPPY))
+
+    for name, compression in codecs:
+        message_set = codec.encode_message_set(messages, compression)
+        response = struct.pack('>H', 0) + message_set
+
+        encode = lambda: codec.encode_message_set(messages, compression)
+        decode = lambda: codec.decode_fetch_response(response, 0)
+        encode_elapsed = _timeit(encode)
+        decode_elapsed = _timeit(decode)
+        _report(name, wire_bytes=len(message_set), 
+            wire_ratio=len(message_set) / float(raw_size),
+            encode_msgs_per_sec=num_messages / encode_elapsed,
+            decode_msgs_per_sec=num_messages / decode_elapsed)
+
+def bench_parse(message_size=50, fetch_size=Kafka.DEFAULT_MAX_SIZE):
+    codec = Codec()
+    message = 'x' * message_size
+    num_messages = fetch_size // (Lengths.MESSAGE_HEADER + message_size)
+    response = struct.pack('>H', 0) + \
+        codec.encode_message_set([message] * num_messages)
+
+    def stringio_parser():
+        response_buffer = StringIO(response)
+        response_buffer.read(Lengths.ERROR_CODE)
+        list(codec.parse_message_set(0, response_buffer))
+
+    def buffer_parser():
+        list(codec.decode_fetch_response(response, 0))
+
+    def zero_copy_parser():
+        codec.zero_copy = True
+        try:
+            buffer_parser()
+        finally:
+            codec.zero_copy = False
+
+    def unverified_parser():
+        codec.verify_checksums = False
+        try:
+            buffer_parser()
+        finally:
+            codec.verify_checksums = True
+
+    for name, func in [('StringIO parser', stringio_parser),
+                       ('buffer parser', buffer_parser),
+                       ('zero copy parser', zero_copy_parser),
+                       ('no checksums', unverified_parser)]:
+        elapsed = _timeit(func)
+        _report(name, msgs_per_sec=num_messages / elapsed)
+
+def _held_bytes(messages):
+    """ Roughly how much memory a fetch result holds on to, besides the
+        response itself. """
+    if isinstance(messages, LazyMessageSet):
+        arrays = [messages._offsets, messages._buffer_ids, messages._starts,
+                  messages._ends]
+        return sum(sys.getsizeof(a) for a in arrays)
+    return sys.getsizeof(messages) + sum(sys.getsizeof(message) + 
+        sys.getsizeof(message[1]) for message in messages)
+
+def bench_lazy(message_size=50, fetch_size=Kafka.DEFAULT_MAX_SIZE):
+    """ A consumer that only wants the 1% of messages with a prefix. """
+    message = 'x' * message_size
+    num_messages = fetch_size // (Lengths.MESSAGE_HEADER + message_size)
+    messages = [message] * num_messages
+    for i in range(0, num_messages, 100):
+        messages[i] = 'wanted' + message[6:]
+    response = struct.pack('>H', 0) + Codec().encode_message_set(messages)
+
+    codec, lazy_codec = Codec(), Codec(lazy=True)
+    def eager_filter():
+        [payload for offset, payload in 
+         codec.decode_fetch_response(response, 0) 
+         if payload.startswith('wanted')]
+
+    def lazy_filter():
+        [message.payload for message in 
+         lazy_codec.decode_fetch_response(response, 0).with_prefix('wanted')]
+
+    for name, func, result in [
+            ('MessageSet', eager_filter, 
+             codec.decode_fetch_response(response, 0)),
+            ('LazyMessageSet', lazy_filter, 
+             lazy_codec.decode_fetch_response(response, 0))]:
+        elapsed = _timeit(func)
+        _report(name, msgs_per_sec=num_messages / elapsed, 
+            held_per_fetched=_held_bytes(result) / float(len(response)))
+
+def bench_read(message_size=50, fetch_size=Kafka.DEFAULT_MAX_SIZE,
+        fetches=200):
+    message = 'x' * message_size
+    num_messages = fetch_size // (Lengths.MESSAGE_HEADER + message_size)
+    response = struct.pack('>H', 0) + \
+        Codec().encode_message_set([message] * num_messages)
+    host, port = _canned_response_server(response)
+
+    # A small receive window splits each response into many recv() calls,
+    # closer to what happens over a real network than plain loopback does.
+    for name, rcvbuf in [('loopback', None), ('64 KB rcvbuf', 64 * 1024)]:
+        kafka = Kafka(host=host, port=port)
+        kafka._connect()
+        if rcvbuf:
+            kafka._connection.socket.setsockopt(socket.SOL_SOCKET,
+                socket.SO_RCVBUF, rcvbuf)
+
+        def fetch():
+            for i in range(fetches):
+                kafka._write(kafka.codec.fetch_request('bench', 0, 0,
+                    fetch_size))
+                kafka._read(struct.unpack('>I', 
+                    kafka._read(Lengths.RESPONSE_SIZE))[0])
+
+        elapsed = _timeit(fetch)
+        _report(name, mb_per_sec=fetches * len(response) / elapsed / 
+            (1024 * 1024))
+
+def bench_stream(message_size=50, fetch_size=16 * 1024 * 1024, fetches=5):
+    """ How long until the first message of a large fetch can be worked
+        on. """
+    message = 'x' * message_size
+    num_messages = fetch_size // (Lengths.MESSAGE_HEADER + message_size)
+    response = struct.pack('>H', 0) + \
+        Codec().encode_message_set([message] * num_messages)
+    host, port = _canned_response_server(response)
+    kafka = Kafka(host=host, port=port)
+
+    def fetch():
+        start = time.time()
+        messages = kafka.fetch('bench', 0, max_size=fetch_size)
+        first = time.time()
+        for offset, message in messages:
+            pass
+        return first - start, time.time() - start
+
+    def fetch_stream():
+        start = time.time()
+        first = None
+        for offset, message in kafka.fetch_stream('bench', 0, 
+                max_size=fetch_size):
+            if first is None:
+                first = time.time()
+        return first - start, time.time() - start
+
+    for name, func in [('fetch()', fetch), ('fetch_stream()', fetch_stream)]:
+        first, total = min(func() for i in range(fetches))
+        _report(name, first_message_ms=first * 1000, total_ms=total * 1000)
+
+def bench_cluster(num_brokers=4, latency=0.005, message_size=100, 
+        num_messages=100, rounds=50):
+    """ multi_fetch() over brokers that each take latency seconds to 
+        answer, one broker after the other vs all at once. """
+    brokers = [FakeBroker(latency=latency) for i in range(num_brokers)]
+    cluster = KafkaCluster([broker.start() for broker in brokers], dict(
+        (('bench', partition), (broker.host, broker.port)) 
+        for partition, broker in enumerate(brokers)))
+    for partition in range(num_brokers):
+        cluster.produce('bench', ['x' * message_size] * num_messages, 
+            partition)
+    fetches = [('bench', partition, 0, None) 
+               for partition in range(num_brokers)]
+
+    def one_by_one():
+        for i in range(rounds):
+            for topic, partition, offset, max_size in fetches:
+                cluster.broker(topic, partition).multi_fetch(
+                    [(topic, partition, offset, max_size)])
+
+    def parallel():
+        for i in range(rounds):
+            cluster.multi_fetch(fetches)
+
+    for name, func in [('one by one', one_by_one), ('parallel', parallel)]:
+        elapsed = _timeit(func)
+        _report(name, msgs_per_sec=rounds * num_brokers * num_messages / 
+            elapsed)
+
+    cluster.close()
+    for broker in brokers:
+        broker.close()
+
+def bench_sizes(message_sizes=(10, 100, 1000, 10000, 100000),
+        batch_bytes=1024 * 1024):
+    """ Encoding and decoding a batch_bytes worth of messages of each 
+        size. """
+    codec = Codec()
+    for message_size in message_sizes:
+        num_messages = max(1, batch_bytes // message_size)
+        messages = ['x' * message_size] * num_messages
+        response = struct.pack('>H', 0) + codec.encode_message_set(messages)
+
+        encode = lambda: codec.produce_request('bench', messages, 0)
+        decode = lambda: list(codec.decode_fetch_response(response, 0))
+        encode_elapsed = _timeit(encode, repeat=5)
+        decode_elapsed = _timeit(decode, repeat=5)
+        _report('{0} byte messages'.format(message_size), 
+            encode_msgs_per_sec=num_messages / encode_elapsed,
+            decode_msgs_per_sec=num_messages / decode_elapsed,
+            message_size=message_size)
+
+def _blocking_round(broker, topic, messages, max_size, requests):
+    """ Produce messages requests times, then fetch them back a batch at
+        a time. Return the produce and fetch latencies. """
+    kafka = Kafka(broker.host, broker.port)
+    produce_latencies, fetch_latencies = [], []
+    for i in xrange(requests):
+        start = time.time()
+        kafka.produce(topic, messages)
+        produce_latencies.append(time.time() - start)
+
+    offset = 0
+    for i in xrange(requests):
+        start = time.time()
+        offset = kafka.fetch(topic, offset, max_size=max_size).next_offset
+        fetch_latencies.append(time.time() - start)
+    kafka._disconnect()
+    return produce_latencies, fetch_latencies
+
+def _tornado_round(broker, topic, messages, max_size, requests):
+    """ _blocking_round() with KafkaTornado, one request at a time. A 
+        produce is over once it is written out. """
+    io_loop = IOLoop()
+    kafka = KafkaTornado(broker.host, broker.port, io_loop=io_loop)
+    produce_latencies, fetch_latencies = [], []
+
+    def produce(start=None):
+        if start is not None:
+            produce_latencies.append(time.time() - start)
+        if len(produce_latencies) < requests:
+            kafka.produce(topic, messages, 
+                callback=partial(produce, time.time()))
+        else:
+            fetch(0)
+
+    def fetch(offset, start=None, batch=None):
+        if start is not None:
+            fetch_latencies.append(time.time() - start)
+            offset = batch.next_offset
+        if len(fetch_latencies) < requests:
+            kafka.fetch(topic, offset, max_size=max_size, 
+                callback=partial(fetch, offset, time.time()))
+        else:
+            io_loop.stop()
+
+    io_loop.add_callback(produce)
+    io_loop.start()
+    kafka._disconnect()
+    io_loop.close()
+    return produce_latencies, fetch_latencies
+
+def bench_transport(message_sizes=(10, 100, 1000, 10000, 100000), 
+        batch_sizes=(1, 10, 100), max_batch_bytes=1024 * 1024, 
+        round_bytes=4 * 1024 * 1024):
+    """ Produce then fetch through each client, one request at a time, 
+        against a FakeBroker. Batches of more than max_batch_bytes are 
+        skipped, each round moves about round_bytes (20 requests at least, 
+        500 at most). """
+    transports = [('blocking', _blocking_round)]
+    if KafkaTornado is not None:
+        transports.append(('tornado', _tornado_round))
+
+    broker = FakeBroker()
+    broker.start()
+    for transport, run_round in transports:
+        for message_size in message_sizes:
+            for batch_size in batch_sizes:
+                messages = ['x' * message_size] * batch_size
+                max_size = len(Codec().encode_message_set(messages))
+                if max_size > max_batch_bytes:
+                    continue
+                requests = max(20, min(500, round_bytes // max_size))
+                topic = 'bench-{0}-{1}-{2}'.format(transport, message_size,
+                    batch_size)
+
+                produce_latencies, fetch_latencies = run_round(broker, 
+                    topic, messages, max_size, requests)
+                for operation, latencies in [('produce', produce_latencies),
+                                             ('fetch', fetch_latencies)]:
+                    elapsed = sum(latencies)
+                    values = _percentiles(latencies)
+                    values.update(
+                        msgs_per_sec=requests * batch_size / elapsed,
+                        mb_per_sec=requests * max_size / elapsed / 
+                            (1024 * 1024),
+                        transport=transport, operation=operation, 
+                        message_size=message_size, batch_size=batch_size)
+                    _report('{0} {1} {2}Bx{3}'.format(transport, operation, 
+                        message_size, batch_size), **values)
+    broker.close()
+
+BENCHMARKS = {
+    'async_produce': bench_async_produce,
+    'cluster': bench_cluster,
+    'codec': bench_codec,
+    'compression': bench_compression,
+    'encode': bench_encode,
+    'lazy': bench_lazy,
+    'multi_produce': bench_multi_produce,
+    'parse': bench_parse,
+    'read': bench_read,
+    'sizes': bench_sizes,
+    'stream': bench_stream,
+    'transport': bench_transport,
+}
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    json_path = None
+    if args[:1] == ['--json']:
+        json_path, args = args[1], args[2:]
+
+    # Keep stdout for the JSON
+    output = sys.stdout
+    if json_path == '-':
+        sys.stdout = sys.stderr
+
+    for name in args or sorted(BENCHMARKS):
+        print '== {0}'.format(name)
+        current_benchmark = name
+        BENCHMARKS[name]()
+
+    if json_path is not None:
+        document = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'results': results,
+        }
+        if json_path == '-':
+            json.dump(document, output, indent=2, sort_keys=True)
+        else:
+            with open(json_path, 'w') as f:
+                json.dump(document, f, indent=2, sort_keys=True)
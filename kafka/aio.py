@@ -0,0 +1,483 @@
+import socket
+from collections import deque
+from datetime import datetime
+
+from kafka.base import BaseKafka, Partition, AdaptiveFetch, logging, \
+    kafka_log, ConnectionFailure, OffsetOutOfRange, InvalidOffset, \
+    MessageTooLarge, \
+    EARLIEST_OFFSET, LATEST_OFFSET, COMPRESSION_NONE
+from kafka.protocol import Connection, ResponseFailed
+socket_log = logging.getLogger('kafka.asyncio')
+
+# The asyncio API on Python 2. Coroutines are generators that use
+# `yield From(...)` for `await` and `raise Return(value)` for `return`.
+import trollius as asyncio
+from trollius import From, Return
+
+__all__ = [
+    'KafkaAsyncio',
+    'AsyncPartition',
+]
+
+class KafkaProtocol(asyncio.Protocol):
+    """ Hands what comes from the server to the client, and writes what it
+        sends. """
+
+    def __init__(self, kafka):
+        self._kafka = kafka
+        self.transport = None
+        self._paused = False
+        self._drain_waiters = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def data_received(self, data):
+        self._kafka._data_received(self, data)
+
+    def connection_lost(self, exc):
+        self._kafka._connection_lost(self, exc)
+        self._wake_drain_waiters()
+
+    def write(self, data):
+        if isinstance(data, str):
+            self.transport.write(data)
+        else:
+            self.transport.writelines(data)
+
+    # Flow control, so producers wait while the write buffer is full
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake_drain_waiters()
+
+    @asyncio.coroutine
+    def drain(self):
+        if self._paused and self.transport is not None:
+            waiter = asyncio.Future(loop=self._kafka._loop)
+            self._drain_waiters.append(waiter)
+            yield From(waiter)
+
+    def _wake_drain_waiters(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class KafkaAsyncio(BaseKafka):
+    """ A client for asyncio event loops.
+
+        The request methods are coroutines. Any number of them can run at
+        once: requests are written as they come, up to max_in_flight of them
+        waiting for a response, and the responses are matched to them in
+        order.
+
+        Example:
+
+            @asyncio.coroutine
+            def bark(loop):
+                kafka = KafkaAsyncio(loop=loop)
+                yield From(kafka.produce('good_dogs', ['woof']))
+                messages = yield From(kafka.fetch('good_dogs', 0))
+    """
+    def __init__(self, *args, **kwargs):
+        loop = kwargs.pop('loop', None)
+        BaseKafka.__init__(self, *args, **kwargs)
+        self._loop = loop or asyncio.get_event_loop()
+
+        self._protocol = None
+        # kafka.protocol.Connection, matches the responses to the requests
+        self._connection = None
+        self._connecting = None
+        # (request, callback, future) waiting for one of the max_in_flight
+        # slots
+        self._waiting = deque()
+
+    # Public API
+
+    @asyncio.coroutine
+    def connect(self):
+        """ Connect to the Kafka server, unless we already are. """
+        if self._protocol is not None:
+            return
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open_connection(),
+                loop=self._loop)
+        yield From(asyncio.shield(self._connecting, loop=self._loop))
+
+    def close(self):
+        """ Disconnect, requests waiting for a response fail with
+            ConnectionFailure. """
+        if self._protocol is not None:
+            self._protocol.transport.close()
+            self._connection_lost(self._protocol, None)
+
+    @asyncio.coroutine
+    def produce(self, topic, messages, partition=None, callback=None,
+            compression=COMPRESSION_NONE, key=None):
+        """ Coroutine version of BaseKafka.produce(). Waits while the
+            connection's write buffer is full. """
+        yield From(self.connect())
+        result = BaseKafka.produce(self, topic, messages, partition, callback,
+            compression, key)
+        yield From(self._protocol.drain())
+        raise Return(result)
+
+    @asyncio.coroutine
+    def multi_produce(self, messages_by_partition, callback=None,
+            compression=COMPRESSION_NONE):
+        """ Coroutine version of BaseKafka.multi_produce(). """
+        yield From(self.connect())
+        result = BaseKafka.multi_produce(self, messages_by_partition, callback,
+            compression)
+        yield From(self._protocol.drain())
+        raise Return(result)
+
+    @asyncio.coroutine
+    def fetch(self, topic, offset, partition=None, max_size=None,
+            callback=None, include_corrupt=False):
+        """ Coroutine version of BaseKafka.fetch(). """
+        yield From(self.connect())
+        result = yield From(BaseKafka.fetch(self, topic, offset, partition,
+            max_size, callback, include_corrupt))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def multi_fetch(self, fetches, callback=None, include_corrupt=False):
+        """ Coroutine version of BaseKafka.multi_fetch(). """
+        yield From(self.connect())
+        result = yield From(BaseKafka.multi_fetch(self, fetches, callback,
+            include_corrupt))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def offsets(self, topic, time_val, max_offsets, partition=None,
+            callback=None):
+        """ Coroutine version of BaseKafka.offsets(). """
+        yield From(self.connect())
+        result = yield From(BaseKafka.offsets(self, topic, time_val,
+            max_offsets, partition, callback))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def multi_offsets(self, requests, callback=None):
+        """ Look up offsets for several topics/partitions at once, see
+            Kafka.multi_offsets(). The requests are all sent right away. """
+        results = yield From(asyncio.gather(*[
+            self.offsets(topic, time_val, max_offsets, partition)
+            for topic, partition, time_val, max_offsets in requests],
+            loop=self._loop))
+        results = list(results)
+        raise Return(callback(results) if callback else results)
+
+    @asyncio.coroutine
+    def cached_offset(self, topic, time_val, partition=None, callback=None,
+            max_age=None):
+        """ Coroutine version of BaseKafka.cached_offset(). """
+        offset = self.offsets_cache.get(topic, partition, time_val, max_age)
+        if offset is None:
+            offsets = yield From(self.offsets(topic, time_val, 1, partition))
+            offset = offsets[0]
+        raise Return(callback(offset) if callback else offset)
+
+    def topic(self, topic, partition=None):
+        """ Return an AsyncPartition for topic/partition. """
+        return AsyncPartition(self, topic, partition)
+
+    def partition(self, topic, partition=None):
+        """ Return an AsyncPartition for topic/partition. """
+        return AsyncPartition(self, topic, partition)
+
+    # Connection management methods
+
+    @asyncio.coroutine
+    def _open_connection(self):
+        try:
+            transport, protocol = yield From(self._loop.create_connection(
+                lambda: KafkaProtocol(self), self.host, self.port))
+        except (socket.error, OSError), e:
+            raise ConnectionFailure("Could not connect to kafka at {0}:{1}".format(self.host, self.port))
+        finally:
+            self._connecting = None
+        self._protocol = protocol
+        self._connection = Connection(self.codec)
+
+    def _connection_lost(self, protocol, exc):
+        if protocol is not self._protocol:
+            return
+        self._protocol = None
+
+        error = ConnectionFailure("Connection to kafka at {0}:{1} lost".format(self.host, self.port))
+        pending = [event.token for event in 
+                   self._connection.connection_lost(error)] + \
+                  [future for request, callback, future in self._waiting]
+        self._connection = None
+        self._waiting.clear()
+        for future in pending:
+            if not future.done():
+                future.set_exception(error)
+
+    # Request pipelining
+
+    def _request(self, request, callback):
+        """ Write `request` as soon as there is an in-flight slot for it,
+            return a Future for the result of callback(response). """
+        future = asyncio.Future(loop=self._loop)
+        if self._connection is not None and \
+           self._connection.pending >= self.max_in_flight:
+            self._waiting.append((request, callback, future))
+        else:
+            self._send(request, callback, future)
+        return future
+
+    def _send(self, request, callback, future):
+        if self._protocol is None:
+            future.set_exception(ConnectionFailure("Not connected to kafka at {0}:{1}".format(self.host, self.port)))
+            return
+        data = self._connection.request(request, callback, future)
+        if self.metrics is not None:
+            self._count_sent(data)
+        self._protocol.write(data)
+
+    def _data_received(self, protocol, data):
+        if protocol is not self._protocol:
+            return
+        if self.metrics is not None:
+            self.metrics.increment('bytes_received', len(data))
+        events = self._connection.receive_data(data)
+
+        # Fill the freed slots before handing the responses over
+        while self._waiting and self._connection is not None and \
+              self._connection.pending < self.max_in_flight:
+            self._send(*self._waiting.popleft())
+
+        for event in events:
+            future = event.token
+            if future.done():
+                continue
+            if isinstance(event, ResponseFailed):
+                future.set_exception(event.error)
+            else:
+                future.set_result(event.result)
+
+    def _write(self, data, callback=None, retries=BaseKafka.MAX_RETRY):
+        """ Write `data`, which expects no response. """
+        if self._protocol is None:
+            raise ConnectionFailure("Not connected to kafka at {0}:{1}".format(self.host, self.port))
+        self._protocol.write(data)
+        if self.metrics is not None:
+            self._count_sent(data)
+        if callback:
+            return callback()
+
+
+class AsyncPartition(object):
+    """ Partition for KafkaAsyncio: the same methods, as coroutines. """
+
+    def __init__(self, kafka, topic, partition=None):
+        self._kafka = kafka
+        self._topic = topic
+        self._partition = partition
+
+    @asyncio.coroutine
+    def earliest_offset(self, max_age=None):
+        """ See Partition.earliest_offset(). """
+        offset = yield From(self._kafka.cached_offset(self._topic,
+            EARLIEST_OFFSET, self._partition, max_age=max_age))
+        raise Return(offset)
+
+    @asyncio.coroutine
+    def latest_offset(self, max_age=None):
+        """ See Partition.latest_offset(). """
+        offset = yield From(self._kafka.cached_offset(self._topic,
+            LATEST_OFFSET, self._partition, max_age=max_age))
+        raise Return(offset)
+
+    @asyncio.coroutine
+    def fetch(self, offset, max_size=None, include_corrupt=False):
+        """ Fetch the messages at offset, resolves to a MessageSet. """
+        messages = yield From(self._kafka.fetch(self._topic, offset,
+            partition=self._partition, max_size=max_size,
+            include_corrupt=include_corrupt))
+        raise Return(messages)
+
+    def poll(self, offset=None, end_offset=None, poll_interval=1,
+            max_size=None, include_corrupt=False, retry_limit=3,
+            adaptive=False, checkpoint=None):
+        """ Partition.poll() for coroutines, with the same parameters
+            (except prefetch: polls of many partitions already overlap on
+            the connection). Returns an AsyncPoll:
+
+                dogs = kafka.partition('good_dogs').poll(offset)
+                while True:
+                    status, messages = yield From(dogs.next())
+        """
+        return AsyncPoll(self, offset, end_offset, poll_interval, max_size,
+            include_corrupt, retry_limit, adaptive, checkpoint)
+
+
+class AsyncPoll(object):
+    """ What AsyncPartition.poll() returns. next() resolves to the next
+        (status, messages) pair, or None once past end_offset. """
+
+    def __init__(self, partition, offset, end_offset, poll_interval,
+            max_size, include_corrupt, retry_limit, adaptive, checkpoint):
+        self._partition = partition
+        self._topic = partition._topic
+        self.offset = offset
+        self.end_offset = end_offset
+        self.poll_interval = poll_interval
+        self.max_size = max_size
+        self.include_corrupt = include_corrupt
+        self.retry_limit = retry_limit
+        self.checkpoint = checkpoint
+        self._fetch_policy = None
+        if adaptive:
+            self._fetch_policy = AdaptiveFetch(
+                max_size or partition._kafka.max_size,
+                poll_interval=poll_interval)
+
+        self._started = False
+        self._first_fetch = True
+        self._checked_offset = None # The offset of the last too large message
+        self._delay = 0 # Wait before the next fetch
+        self._unprocessed = None # The last (offset, messages) handed out
+        self.start_offset = None
+        self.last_offset_read = None
+        self.messages_read = 0
+        self.bytes_read = 0
+        self.num_fetches = 0
+        self.seconds_slept = 0
+        self.polling_start_time = datetime.now()
+
+    @asyncio.coroutine
+    def next(self):
+        if not self._started:
+            yield From(self._start())
+
+        # Back for more, so the last batch was processed
+        if self._unprocessed is not None:
+            if self.checkpoint is not None:
+                self.checkpoint.commit(self._topic,
+                    self._partition._partition, *self._unprocessed)
+            self._unprocessed = None
+
+        if self._delay:
+            yield From(asyncio.sleep(self._delay,
+                loop=self._partition._kafka._loop))
+            self.seconds_slept += self._delay
+            self._delay = 0
+
+        if self.end_offset is not None and self.offset > self.end_offset:
+            raise Return(None)
+        msg_batch = yield From(self._fetch_with_retries())
+
+        # See Partition._poll() for what happens from here on
+        offset = self.offset
+        next_offset = msg_batch.next_offset
+        truncated = msg_batch.truncated
+        fetched_batch = msg_batch
+        if self.end_offset is not None:
+            past_end_offsets = [msg_offset for msg_offset, msg in msg_batch
+                                if msg_offset > self.end_offset]
+            if past_end_offsets:
+                next_offset = past_end_offsets[0]
+            msg_batch = [(msg_offset, msg) for msg_offset, msg in msg_batch
+                         if msg_offset <= self.end_offset]
+
+        if self._first_fetch and not msg_batch and not truncated:
+            earliest = yield From(self._partition.earliest_offset())
+            latest = yield From(self._partition.latest_offset())
+            if earliest <= offset < latest:
+                retry_batch = yield From(self._fetch(offset))
+                if not retry_batch:
+                    raise InvalidOffset("No message at offset {0}".format(offset))
+        if not fetched_batch and truncated and offset != self._checked_offset:
+            latest = yield From(self._partition.latest_offset(max_age=0))
+            if offset + truncated >= latest:
+                raise InvalidOffset("No message at offset {0}".format(offset))
+            if self._fetch_policy is None:
+                raise MessageTooLarge("Message at offset {0} is larger than max_size, raise it or poll with adaptive".format(offset))
+            self._checked_offset = offset
+        self._first_fetch = False
+
+        if self._fetch_policy is not None:
+            delay = self._fetch_policy.fetched(offset, fetched_batch)
+        else:
+            delay = 0 if fetched_batch else self.poll_interval
+
+        messages = [msg for msg_offset, msg in msg_batch]
+        self.messages_read += len(messages)
+        self.bytes_read += sum(len(msg) for msg in messages)
+        self.num_fetches += 1
+        if msg_batch:
+            self.last_offset_read = msg_batch[-1][0]
+            self.offset = next_offset
+            self._unprocessed = (self.offset, len(messages))
+        elif delay:
+            self._delay = delay
+
+        raise Return((Partition.PollingStatus(
+            start_offset=self.start_offset,
+            next_offset=self.offset,
+            last_offset_read=self.last_offset_read,
+            messages_read=self.messages_read,
+            bytes_read=self.bytes_read,
+            num_fetches=self.num_fetches,
+            polling_start_time=self.polling_start_time,
+            seconds_slept=self.seconds_slept), messages))
+
+    @asyncio.coroutine
+    def _start(self):
+        if self.offset is None and self.checkpoint is not None:
+            self.offset = self.checkpoint.offset(self._topic,
+                self._partition._partition)
+        if self.offset is None:
+            self.offset = yield From(self._partition.latest_offset())
+        self.start_offset = self.offset
+        self._started = True
+
+    def _fetch(self, offset):
+        if self._fetch_policy is not None:
+            max_size = self._fetch_policy.max_size
+        else:
+            max_size = self.max_size
+        return self._partition.fetch(offset, max_size, self.include_corrupt)
+
+    @asyncio.coroutine
+    def _fetch_with_retries(self):
+        retry_attempts = 0
+        while True:
+            try:
+                msg_batch = yield From(self._fetch(self.offset))
+            except (ConnectionFailure, IOError), ex:
+                if self.retry_limit is not None and \
+                   retry_attempts > self.retry_limit:
+                    kafka_log.exception(ex)
+                    raise
+                retry_attempts += 1
+                kafka_log.error("Retry #{0} for fetch of topic {1}, offset {2}"
+                                .format(retry_attempts, self._topic,
+                                        self.offset))
+                yield From(asyncio.sleep(self.poll_interval or 0,
+                    loop=self._partition._kafka._loop))
+                continue
+            except OffsetOutOfRange:
+                earliest = yield From(self._partition.earliest_offset())
+                latest = yield From(self._partition.latest_offset())
+                raise OffsetOutOfRange(("Offset {offset} is out of range for " +
+                                       "topic {topic}, partition {partition} " +
+                                       "(earliest: {earliest}, latest: {latest})")
+                                       .format(offset=self.offset,
+                                               topic=self._topic,
+                                               partition=self._partition._partition,
+                                               earliest=earliest,
+                                               latest=latest))
+            raise Return(msg_batch)
@@ -1,104 +1,191 @@
 import binascii
 import logging
+import random
 import struct
+import threading
 import time
+import Queue
 import sys, traceback
 from cStringIO import StringIO
 from collections import namedtuple
 from datetime import datetime
 from functools import partial
 
+from kafka.compression import COMPRESSION_NONE, COMPRESSION_GZIP, \
+    COMPRESSION_SNAPPY, UnsupportedCodec
+from kafka.protocol import KafkaError, OffsetOutOfRange, \
+    InvalidMessageCode, WrongPartitionCode, InvalidRetchSizeCode, \
+    UnknownError, MultiFetchError, PRODUCE_REQUEST, FETCH_REQUEST, \
+    MULTIFETCH_REQUEST, MULTIPRODUCE_REQUEST, OFFSETS_REQUEST, \
+    LATEST_OFFSET, EARLIEST_OFFSET, Lengths, MessageSet, LazyMessageSet, \
+    Message, Codec, kafka_log
+
 __all__ = [
     'KafkaError',
     'ConnectionFailure',
+    'PoolExhausted',
     'OffsetOutOfRange',
     'InvalidMessageCode',
     'WrongPartitionCode',
     'InvalidRetchSizeCode',
     'UnknownError',
+    'MultiFetchError',
     'InvalidOffset',
+    'QueueFull',
+    'MessageTooLarge',
+    'MaxRetries',
+    'NoBrokerForPartition',
     'PRODUCE_REQUEST',
     'FETCH_REQUEST',
+    'MULTIFETCH_REQUEST',
+    'MULTIPRODUCE_REQUEST',
     'OFFSETS_REQUEST',
     'LATEST_OFFSET',
     'EARLIEST_OFFSET',
+    'COMPRESSION_NONE',
+    'COMPRESSION_GZIP',
+    'COMPRESSION_SNAPPY',
+    'UnsupportedCodec',
     'Lengths',
+    'MessageSet',
+    'LazyMessageSet',
+    'Message',
+    'Codec',
+    'OffsetCache',
+    'AdaptiveFetch',
 ]
 
-class KafkaError(Exception): pass
 class ConnectionFailure(KafkaError): pass
-class OffsetOutOfRange(KafkaError): pass
-class InvalidMessageCode(KafkaError): pass
-class WrongPartitionCode(KafkaError): pass
-class InvalidRetchSizeCode(KafkaError): pass
-class UnknownError(KafkaError): pass
+class PoolExhausted(ConnectionFailure): pass
 class InvalidOffset(KafkaError): pass
-
-error_codes = {
-    1: OffsetOutOfRange,
-    2: InvalidMessageCode,
-    3: WrongPartitionCode,
-    4: InvalidRetchSizeCode,
-}
-
-PRODUCE_REQUEST      = 0
-FETCH_REQUEST        = 1
-MULTIFETCH_REQUEST   = 2
-MULTIPRODUCE_REQUEST = 3
-OFFSETS_REQUEST      = 4
-
-MAGIC_BYTE = 0
-
-LATEST_OFFSET   = -1
-EARLIEST_OFFSET = -2
-
-kafka_log  = logging.getLogger('kafka')
-
-class Lengths(object):
-    ERROR_CODE = 2
-    RESPONSE_SIZE = 4
-    REQUEST_TYPE = 2
-    TOPIC_LENGTH = 2
-    PARTITION = 4
-    OFFSET = 8
-    OFFSET_COUNT = 4
-    MAX_NUM_OFFSETS = 4
-    MAX_REQUEST_SIZE = 4
-    TIME_VAL = 8
-    MESSAGE_LENGTH = 4
-    MAGIC = 1
-    CHECKSUM = 4
-    MESSAGE_HEADER = MESSAGE_LENGTH + MAGIC + CHECKSUM
+class QueueFull(KafkaError): pass
+class MessageTooLarge(KafkaError): pass
+class MaxRetries(ConnectionFailure): pass
+class NoBrokerForPartition(KafkaError): pass
+
+class OffsetCache(object):
+    """ Earliest and latest offsets recently received from the server, 
+        kept for ttl seconds so they can be reused instead of asked for 
+        again. """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # (topic, partition, time_val) -> (offset, time received)
+        self._offsets = {}
+
+    def get(self, topic, partition, time_val, max_age=None):
+        """ The offset if we got it less than max_age (default: ttl) 
+            seconds ago, else None. """
+        max_age = self.ttl if max_age is None else max_age
+        cached = self._offsets.get((topic, partition or 0, time_val))
+        if cached is None or time.time() - cached[1] >= max_age:
+            return None
+        return cached[0]
+
+    def set(self, topic, partition, time_val, offset):
+        if self.ttl:
+            self._offsets[(topic, partition or 0, time_val)] = \
+                (offset, time.time())
+
+    def clear(self):
+        self._offsets.clear()
 
 class BaseKafka(object):
     MAX_RETRY = 3
     DEFAULT_MAX_SIZE = 1024 * 1024
+    DEFAULT_MAX_IN_FLIGHT = 5
+    DEFAULT_OFFSETS_TTL = 0
     
     def __init__(self, host=None, port=None, max_size=None, 
-            include_corrupt=False):
+            include_corrupt=False, zero_copy=False, max_in_flight=None, 
+            offsets_ttl=None, verify_checksums=True, lazy=False, 
+            partitioner=None, metrics=None):
         self.host   = host or 'localhost'
         self.port   = port or 9092
         self.max_size = max_size or self.DEFAULT_MAX_SIZE
-        self.include_corrupt = include_corrupt
+        # How many requests may be waiting for a response on a pipelined
+        # connection
+        self.max_in_flight = max_in_flight or self.DEFAULT_MAX_IN_FLIGHT
+        # Encodes the requests and decodes the responses. With zero_copy,
+        # fetched payloads are memoryviews into the response instead of strs
+        # copied out of it, which only pays off for large payloads. With 
+        # lazy, fetches return LazyMessageSets. 
+        # verify_checksums=False skips checking fetched messages. See Codec.
+        self.codec = Codec(include_corrupt, zero_copy, lazy, verify_checksums,
+            metrics=metrics)
+        # Earliest/latest offsets are reused for this many seconds by 
+        # cached_offset(). 0, the default, disables the cache.
+        self.offsets_cache = OffsetCache(self.DEFAULT_OFFSETS_TTL 
+            if offsets_ttl is None else offsets_ttl)
+        # Picks the partition of messages produced without one, see 
+        # kafka.partitioner. Without one they go to partition 0.
+        self.partitioner = partitioner
+        # A kafka.metrics.Metrics to report requests, bytes, latencies and 
+        # such to. None reports nothing.
+        self.metrics = metrics
     
     # Public API
     
-    def produce(self, topic, messages, partition=None, callback=None):
+    def produce(self, topic, messages, partition=None, callback=None, 
+            compression=COMPRESSION_NONE, key=None):
+        """ Produce messages to a kafka queue
+
+            Params:
+                topic:      kafka topic to write to
+                messages:   a message or a list of messages
+                partition:  topic partition to write to (optional, picked 
+                            by the partitioner if there is one)
+                compression: COMPRESSION_GZIP or COMPRESSION_SNAPPY to send
+                            the messages compressed together (optional)
+                key:        handed to the partitioner (optional)
+        """
         
         # Clean up the input parameters
-        partition = partition or 0
+        messages = self._clean_messages(messages)
+        partition = self._pick_partition(topic, partition, key, messages)
         topic = topic.encode('utf-8')
-        if isinstance(messages, unicode):
-            messages = [messages.encode('utf-8')]
-        elif isinstance(messages, str):
-            messages = [messages]
         
         # Encode the request
-        request = self._produce_request(topic, messages, partition)
+        request = self.codec.produce_request(topic, messages, partition, 
+            compression)
+        if self.metrics is not None:
+            self.metrics.increment('requests.produce')
         
         # Send the request
         return self._write(request, callback)
     
+    def multi_produce(self, messages_by_partition, callback=None, 
+            compression=COMPRESSION_NONE):
+        """ Produce messages to several topics/partitions at once
+
+            All the message sets are encoded into a single MULTIPRODUCE 
+            request, so this costs one round of framing and one write no 
+            matter how many partitions are involved.
+
+            Params:
+                messages_by_partition: a dict mapping (topic, partition) 
+                                       to a message or a list of messages.
+                                       A None partition is picked by the
+                                       partitioner.
+                compression: compress each message set with 
+                             COMPRESSION_GZIP or COMPRESSION_SNAPPY 
+                             (optional)
+        """
+        request_parts = []
+        for (topic, partition), messages in messages_by_partition.iteritems():
+            messages = self._clean_messages(messages)
+            request_parts.append((topic.encode('utf-8'), 
+                self._pick_partition(topic, partition, None, messages), 
+                messages))
+
+        # Encode the request
+        request = self.codec.multi_produce_request(request_parts, compression)
+        if self.metrics is not None:
+            self.metrics.increment('requests.multi_produce')
+
+        # Send the request
+        return self._write(request, callback)
+    
     def fetch(self, topic, offset, partition=None, max_size=None, callback=None, include_corrupt=False):
         """ Fetch messages from a kafka queue
             
@@ -113,7 +200,7 @@ class BaseKafka(object):
                             in bytes (optional)
                 
             Returns:
-                a list: [(offset, message), ]
+                a MessageSet: [(offset, message), ]
         """
 
         # Clean up the input parameters
@@ -122,20 +209,56 @@ class BaseKafka(object):
         max_size = max_size or self.max_size
         
         # Encode the request
-        fetch_request_size, fetch_request = self._fetch_request(topic, offset, 
-            partition, max_size)
+        fetch_request = self.codec.fetch_request(topic, offset, partition, max_size)
         
         # Send the request. The logic for handling the response 
         # is in _read_fetch_response().
-        return self._write(
-            fetch_request_size, 
-            partial(self._wrote_request_size, 
-                    fetch_request, 
-                    partial(self._read_fetch_response, 
-                            callback, 
-                            offset, 
-                            include_corrupt
-                            )))
+        return self._request(
+            fetch_request, 
+            self._timed('fetch', partial(self._read_fetch_response, 
+                                         callback, 
+                                         offset, 
+                                         include_corrupt
+                                         )))
+
+    def multi_fetch(self, fetches, callback=None, include_corrupt=False):
+        """ Fetch messages from several topics/partitions at once
+
+            All the fetches are sent in a single MULTIFETCH request and 
+            answered in a single response, so this costs one round trip 
+            no matter how many partitions are involved.
+
+            Params:
+                fetches:    a list of (topic, partition, offset, max_size)
+                            tuples. partition and max_size may be None.
+
+            Returns:
+                a list with one entry per fetch, in the same order, each 
+                being a MessageSet: [(offset, message), ]
+
+            If some of the fetches fail (e.g. OffsetOutOfRange), 
+            MultiFetchError is raised. Its results are those of every 
+            fetch, with the error in place of the MessageSet for the ones 
+            that failed.
+        """
+
+        # Clean up the input parameters
+        fetches = [(topic.encode('utf-8'), partition or 0, offset, 
+                    max_size or self.max_size)
+                   for topic, partition, offset, max_size in fetches]
+
+        # Encode the request
+        request = self.codec.multi_fetch_request(fetches)
+
+        # Send the request. The logic for handling the response 
+        # is in _read_multi_fetch_response().
+        return self._request(
+            request, 
+            self._timed('multi_fetch', partial(self._read_multi_fetch_response,
+                                               callback, 
+                                               fetches, 
+                                               include_corrupt
+                                               )))
 
     def offsets(self, topic, time_val, max_offsets, partition=None, callback=None):
         
@@ -143,223 +266,113 @@ class BaseKafka(object):
         partition = partition or 0
         
         # Encode the request
-        request_size, request = self._offsets_request(topic, time_val, 
-            max_offsets, partition)
+        request = self.codec.offsets_request(topic, time_val, max_offsets, 
+            partition)
         
         # Send the request. The logic for handling the response 
         # is in _read_offset_response().
         
-        return self._write(request_size, 
-            partial(self._wrote_request_size, request, 
-                partial(self._read_offset_response, callback)))
+        cache_key = None
+        if max_offsets == 1 and time_val in (EARLIEST_OFFSET, LATEST_OFFSET):
+            cache_key = (topic, partition, time_val)
+        return self._request(request, self._timed('offsets', 
+            partial(self._read_offset_response, callback, cache_key)))
+
+    def cached_offset(self, topic, time_val, partition=None, callback=None, 
+            max_age=None):
+        """ The EARLIEST_OFFSET or LATEST_OFFSET of topic/partition, from
+            offsets_cache if we got it less than max_age (default: 
+            offsets_ttl) seconds ago, otherwise from the server. """
+        offset = self.offsets_cache.get(topic, partition, time_val, max_age)
+        if offset is None:
+            return self.offsets(topic, time_val, 1, partition, 
+                lambda offsets: callback(offsets[0]) if callback 
+                                else offsets[0])
+        return callback(offset) if callback else offset
 
         
     # Helper methods
-    
+
     @staticmethod
     def compute_checksum(value):
         return binascii.crc32(value)
 
+    def _timed(self, request_type, decode):
+        """ Count a request of request_type and return decode, wrapped to
+            report how long the response took to come. """
+        metrics = self.metrics
+        if metrics is None:
+            return decode
+        metrics.increment('requests.' + request_type)
+        start = time.time()
+        def timed(data):
+            metrics.timing('latency.' + request_type, time.time() - start)
+            return decode(data)
+        return timed
+
+    def _count_sent(self, data):
+        """ Report data, a str or a list of strs, as sent. """
+        if isinstance(data, str):
+            size = len(data)
+        else:
+            size = sum(len(part) for part in data)
+        self.metrics.increment('bytes_sent', size)
+
+    def _pick_partition(self, topic, partition, key, messages):
+        if partition is None and self.partitioner is not None:
+            return self.partitioner.partition(topic, key, messages)
+        return partition or 0
+
+    @staticmethod
+    def _clean_messages(messages):
+        if isinstance(messages, unicode):
+            return [messages.encode('utf-8')]
+        elif isinstance(messages, str):
+            return [messages]
+        return messages
+
     # Private methods
 
-    # Response decoding methods
+    # Response decoding methods. The codec does the decoding, these hand
+    # the result to the callback.
     
     def _read_fetch_response(self, callback, start_offset, include_corrupt, 
-            message_buffer):
-        if message_buffer:
-            messages = list(self._parse_message_set(
-                start_offset, message_buffer, include_corrupt)
-            )
-        else:
-            messages = []
+            data):
+        messages = self.codec.decode_fetch_response(data, start_offset, 
+            include_corrupt)
 
         if callback:
             return callback(messages)
         else:
             return messages
 
-    def _parse_message_set(self, start_offset, message_buffer, 
-            include_corrupt=False):
-        offset = start_offset
-        
-        try:
-            has_more = True
-            while has_more:
-                offset = start_offset + message_buffer.tell() - Lengths.ERROR_CODE
-                
-                # Parse the message length (uint:4)
-                raw_message_length = message_buffer.read(Lengths.MESSAGE_LENGTH)
-                
-                if raw_message_length == '':
-                    break
-                elif len(raw_message_length) < Lengths.MESSAGE_LENGTH:
-                    kafka_log.error('Unexpected end of message set. Expected {0} bytes for message length, only read {1}'.format(Lengths.MESSAGE_LENGTH, len(raw_message_length)))
-                    break
-                
-                message_length = struct.unpack('>I', 
-                    raw_message_length)[0]
-                
-                # Parse the magic byte (int:1)
-                raw_magic = message_buffer.read(Lengths.MAGIC)
-                if len(raw_magic) < Lengths.MAGIC:
-                    kafka_log.error('Unexpected end of message set. Expected {0} bytes for magic byte, only read{1}'.format(Lengths.MAGIC, len(raw_magic)))
-                    break
-                
-                magic = struct.unpack('>B', raw_magic)[0]
-                
-                # Parse the checksum (int:4)
-                raw_checksum = message_buffer.read(Lengths.CHECKSUM)
-                if len(raw_checksum) < Lengths.CHECKSUM:
-                    kafka_log.error('Unexpected end of message set. Expected {0} bytes for checksum, only read {1}'.format(Lengths.CHECKSUM, len(raw_checksum)))
-                    break
-                    
-                checksum = struct.unpack('>i', raw_checksum)[0]
-                
-                # Parse the payload (variable length string)
-                payload_length = message_length - Lengths.MAGIC - Lengths.CHECKSUM
-                payload = message_buffer.read(payload_length)
-                if len(payload) < payload_length and not self.include_corrupt:
-                    # This is not an error - this happens everytime we reach
-                    # the end of the read buffer without having parsed a complete msg
-                    # kafka_log.error('Unexpected end of message set. Expected {0} bytes for payload, only read {1}'.format(payload_length, len(payload)))
-                    break
-                
-                actual_checksum = self.compute_checksum(payload)
-                if magic != MAGIC_BYTE:
-                    kafka_log.error('Unexpected magic byte: {0} (expecting {1})'.format(magic, MAGIC_BYTE))
-                    corrupt = True
-
-                elif checksum != actual_checksum:
-                    kafka_log.error('Checksum failure at offset {0}'.format(offset))
-                    corrupt = True
-                else:
-                    corrupt = False
+    def _read_multi_fetch_response(self, callback, fetches, include_corrupt,
+            data):
+        results = self.codec.decode_multi_fetch_response(data, fetches, 
+            include_corrupt)
 
-                if include_corrupt:
-                    kafka_log.debug('message {0}: (offset: {1}, {2} bytes, corrupt: {3})'.format(payload, offset, message_length, corrupt))
-                    yield offset, payload, corrupt
-                else:
-                    kafka_log.debug('message {0}: (offset: {1}, {2} bytes)'.format(payload, offset, message_length))
-                    yield offset, payload
-        except:
-            kafka_log.error("Unexpected error:{0}".format(sys.exc_info()[0]))
-        finally:
-            message_buffer.close()
-
-    def _read_offset_response(self, callback, data):
-        # The number of offsets received (uint:4)
-        raw_offset_count = data.read(Lengths.OFFSET_COUNT)
-        offset_count = struct.unpack('>L', raw_offset_count)[0]
+        if callback:
+            return callback(results)
+        else:
+            return results
 
-        offsets = []
-        has_more = True
-        for i in range(offset_count):
-            raw_offset = data.read(Lengths.OFFSET)
-            offset = struct.unpack('>Q', raw_offset)[0]
-            offsets.append(offset)
+    def _read_offset_response(self, callback, cache_key, data):
+        offsets = self.codec.decode_offsets_response(data)
 
-        #assert data.getvalue() == '', 'Some leftover data in offset response buffer: {0}'.format(data.getvalue())
-        kafka_log.debug('Received {0} offsets: {1}'.format(offset_count, len(offsets)))
+        if cache_key is not None and offsets:
+            self.offsets_cache.set(cache_key[0], cache_key[1], cache_key[2], 
+                offsets[0])
 
         if callback:
             return callback(offsets)
         else:
             return offsets
     
-    # Request encoding methods
-    
-    def _produce_request(self, topic, messages, partition):
-        message_set_buffer = StringIO()
-
-        for message in messages:
-            # <<int:1, int:4, str>>
-            encoded_message = struct.pack('>Bi{0}s'.format(len(message)), 
-                MAGIC_BYTE, 
-                self.compute_checksum(message), 
-                message
-            )
-            message_size = len(encoded_message)
-            bin_format = '>i{0}s'.format(message_size)
-            message_set_buffer.write(struct.pack(bin_format, message_size, 
-                encoded_message))
-
-        message_set = message_set_buffer.getvalue()
-
-        # create the request <<unit:4, uint:2, uint:2, str, uint:4, uint:4, str>>>
-        request = (
-            PRODUCE_REQUEST,
-            len(topic),
-            topic,
-            partition,
-            len(message_set),
-            message_set
-        )
-        data = struct.pack('>HH{0}sII{1}s'.format(len(topic), len(message_set)),
-            *request
-        )
-        request_size = len(data)
-        bin_format = '<<uint:4, uint:2, uint:2, str:{0}, uint:4, uint:4, str:{1}>>'.format(len(topic), len(message_set))
-        kafka_log.info('produce request: {0} in format {1} ({2} bytes)'.format(request, bin_format, request_size))
-        return struct.pack('>I{0}s'.format(request_size), request_size, data)
-    
-    def _fetch_request(self, topic, offset, partition, max_size):
-        # Build fetch request request
-        topic_length = len(topic)
-        request_size = sum([
-            Lengths.REQUEST_TYPE,
-            Lengths.TOPIC_LENGTH, # length of the topic length
-            topic_length,
-            Lengths.PARTITION,
-            Lengths.OFFSET,
-            Lengths.MAX_REQUEST_SIZE
-        ])
-        request = (
-            FETCH_REQUEST, 
-            topic_length, 
-            topic, 
-            partition, 
-            offset, 
-            max_size
-        )
-
-        # Send the fetch request
-        bin_format = '<<uint:4, uint:2, uint:2, str:{0}, uint:4, uint:8, uint:4>>'.format(topic_length)
-        # kafka_log.info('fetch request: {0} in format {1} ({2} bytes)'.format(request, bin_format, request_size))
-        
-        bin_request_size = struct.pack('>I', request_size)
-        bin_request = struct.pack('>HH%dsIQI' % topic_length, *request)
-        return bin_request_size, bin_request
-    
-    def _offsets_request(self, topic, time_val, max_offsets, partition):
-        offsets_request_size = sum([
-            Lengths.REQUEST_TYPE,
-            Lengths.TOPIC_LENGTH,
-            len(topic),
-            Lengths.PARTITION,
-            Lengths.TIME_VAL,
-            Lengths.MAX_NUM_OFFSETS,
-        ])
-        
-        offsets_request = (
-            OFFSETS_REQUEST, 
-            len(topic), 
-            topic, 
-            partition, 
-            time_val, 
-            max_offsets
-        )
-        
-        bin_format = '<<uint:4, uint:2, uint:2, str:{0}, uint:4, int:8, uint:4>>'.format(len(topic))
-        # kafka_log.debug('Fetching offsets for {0}-{1}, time: {2}, max_offsets: {3} in format {5} ({4} bytes)'.format(topic, partition, time_val, max_offsets, offsets_request_size, bin_format))
-
-        bin_request_size = struct.pack('>I', offsets_request_size)
-        bin_request = struct.pack('>HH{0}sIqI'.format(len(topic)), 
-            *offsets_request)
-
-        return bin_request_size, bin_request
-
     # Request/response protocol
-    def _wrote_request_size(self, request, callback):
+    def _request(self, request, callback):
+        """ Send `request` and hand the body of its response to `callback`. 
+            Transports that can have several requests in flight on one 
+            connection override this. """
         return self._write(request, partial(self._wrote_request, callback))
 
     def _wrote_request(self, callback):
@@ -374,14 +387,8 @@ class BaseKafka(object):
             partial(self._read_response, callback))
     
     def _read_response(self, callback, data):
-        # Check if there is a non zero error code (2 byte unsigned int):
-        response_buffer = StringIO(data)
-        raw_error_code = response_buffer.read(Lengths.ERROR_CODE)
-        error_code = struct.unpack('>H', raw_error_code)[0]
-        if error_code != 0:
-            raise error_codes.get(error_code, UnknownError)('Code: {0}'.format(error_code))
-        else:
-            return callback(response_buffer)
+        self.codec.check_error(data)
+        return callback(data)
     
     # Socket management methods
     
@@ -399,6 +406,7 @@ class BaseKafka(object):
         raise NotImplementedError()
 
     def _write(self, data, callback=None, retries=MAX_RETRY):
+        """ Write `data`, a str or a list of strs, to the server. """
         raise NotImplementedError()
 
     def topic(self, topic, partition=None):
@@ -412,6 +420,83 @@ class BaseKafka(object):
         return Partition(self, topic, partition)
 
 
+class AdaptiveFetch(object):
+    """ Picks the fetch size and the wait between fetches for a partition, 
+        following what its fetches return:
+
+        - A fetch that couldn't hold a single whole message doubles the 
+          size and is retried right away, up to max_fetch_size, past which 
+          MessageTooLarge is raised.
+        - Fetches that come back full (more data was waiting) double the 
+          size, up to max_fetch_size, so busy partitions get big fetches.
+        - SHRINK_AFTER fetches in a row that use less than a quarter of the
+          size halve it, down to min_size.
+        - Empty fetches wait poll_interval, then twice as long after each 
+          further empty fetch, up to max_poll_interval. Waits are randomized
+          between half and all of that, so idle partitions don't poll in 
+          lockstep.
+
+        Params (all optional):
+            max_size:       initial fetch size, in bytes
+            min_size:       smallest fetch size
+            max_fetch_size: largest fetch size
+            poll_interval:  wait after the first empty fetch, in seconds.
+                            None or 0 never waits.
+            max_poll_interval: longest wait between empty fetches
+    """
+    DEFAULT_MIN_SIZE = 64 * 1024
+    DEFAULT_MAX_FETCH_SIZE = 16 * 1024 * 1024
+    DEFAULT_MAX_POLL_INTERVAL = 10
+    SHRINK_AFTER = 5
+
+    def __init__(self, max_size=None, min_size=None, max_fetch_size=None, 
+            poll_interval=1, max_poll_interval=None):
+        self.max_size = max_size or BaseKafka.DEFAULT_MAX_SIZE
+        self.min_size = min(min_size or self.DEFAULT_MIN_SIZE, self.max_size)
+        self.max_fetch_size = max(max_fetch_size or 
+            self.DEFAULT_MAX_FETCH_SIZE, self.max_size)
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max(max_poll_interval or 
+            self.DEFAULT_MAX_POLL_INTERVAL, poll_interval or 0)
+
+        self._empty_fetches = 0 # Empty fetches in a row
+        self._small_fetches = 0 # Mostly unused fetches in a row
+
+    def fetched(self, offset, batch):
+        """ Adjust to batch, the MessageSet fetched at offset with max_size.
+            Returns how many seconds to wait before the next fetch. """
+        if batch:
+            self._empty_fetches = 0
+            if batch.truncated:
+                self._small_fetches = 0
+                self._grow()
+            elif (batch.next_offset - offset) * 4 < self.max_size:
+                self._small_fetches += 1
+                if self._small_fetches >= self.SHRINK_AFTER:
+                    self._small_fetches = 0
+                    self.max_size = max(self.max_size // 2, self.min_size)
+            else:
+                self._small_fetches = 0
+            return 0
+
+        if batch.truncated:
+            # The next message is bigger than max_size
+            if self.max_size >= self.max_fetch_size:
+                raise MessageTooLarge("Message at offset {0} is larger than {1} bytes".format(offset, self.max_fetch_size))
+            self._grow()
+            return 0
+
+        self._empty_fetches += 1
+        if not self.poll_interval:
+            return 0
+        backoff = 2 ** min(self._empty_fetches - 1, 30)
+        delay = min(self.poll_interval * backoff, self.max_poll_interval)
+        return random.uniform(delay / 2.0, delay)
+
+    def _grow(self):
+        self.max_size = min(self.max_size * 2, self.max_fetch_size)
+
+
 # By David Ormsbee (dave@datadog.com):
 class Partition(object):
     """A higher level abstraction over the Kafka object to make dealing with
@@ -428,19 +513,37 @@ class Partition(object):
         self._kafka = kafka
         self._topic = topic
         self._partition = partition
+        # Serializes our requests when a prefetching thread shares _kafka
+        self._lock = threading.RLock()
 
-    def earliest_offset(self):
-        """Return the first offset we have a message for."""
-        return self._kafka.offsets(self._topic, EARLIEST_OFFSET, max_offsets=1,
-                                   partition=self._partition)[0]
+    def earliest_offset(self, max_age=None):
+        """Return the first offset we have a message for. 
+        
+        Like latest_offset(), it may come from the Kafka object's offset cache
+        if it was received less than max_age seconds ago (default: the 
+        Kafka object's offsets_ttl). Pass 0 to always ask the server."""
+        with self._lock:
+            return self._kafka.cached_offset(self._topic, EARLIEST_OFFSET, 
+                                             partition=self._partition, 
+                                             max_age=max_age)
     
-    def latest_offset(self):
+    def latest_offset(self, max_age=None):
         """Return the latest offset we can request. Note that this is the offset
         *after* the last known message in the queue. The offset this method 
         returns will not have a message in it at the time you call it, but it's
         where the next message *will* be placed, whenever it arrives."""
-        return self._kafka.offsets(self._topic, LATEST_OFFSET, max_offsets=1,
-                                   partition=self._partition)[0]
+        with self._lock:
+            return self._kafka.cached_offset(self._topic, LATEST_OFFSET, 
+                                             partition=self._partition, 
+                                             max_age=max_age)
+
+    def fetch(self, offset, max_size=None, include_corrupt=False):
+        """Fetch the messages at offset, returns a MessageSet."""
+        with self._lock:
+            return self._kafka.fetch(self._topic, offset, 
+                                     partition=self._partition, 
+                                     max_size=max_size, 
+                                     include_corrupt=include_corrupt)
     
     # FIXME DO: Put callback in
     # Partition should have it's own fetch() with the basic stuff pre-filled
@@ -450,7 +553,10 @@ class Partition(object):
              poll_interval=1,
              max_size=None,
              include_corrupt=False,
-             retry_limit=3):
+             retry_limit=3,
+             prefetch=None,
+             adaptive=False,
+             checkpoint=None):
         """Poll and iterate through messages from a Kafka queue.
 
         Params (all optional):
@@ -459,8 +565,22 @@ class Partition(object):
                         the message that corresponds to end_offset, and then
                         stop.
             poll_interval: How many seconds to pause between polling
-            max_size:   maximum size to read from the queue, in bytes
+            max_size:   maximum size to read from the queue, in bytes. A 
+                        message larger than that raises MessageTooLarge.
+            adaptive:   Adjust the fetch size and the pause between polls to
+                        the traffic, see AdaptiveFetch. max_size is then 
+                        only the initial fetch size.
+            checkpoint: A kafka.checkpoint.Checkpoint to record progress in.
+                        A batch counts as processed once the next one is 
+                        asked for. Without an offset, we resume from the 
+                        checkpoint's offset for this partition.
             include_corrupt: 
+            prefetch:   Fetch up to this many batches ahead on a background 
+                        thread while the current one is being processed, so
+                        network time and processing time overlap. Up to
+                        (prefetch + 1) batches are buffered, each as large
+                        as a fetch: max_size bytes, or with adaptive up to
+                        AdaptiveFetch's max_fetch_size (16 MB by default).
             
         
         This is a generator that will yield (status, messages) pairs, where
@@ -470,7 +590,8 @@ class Partition(object):
         initialized with.
         
         By default, the generator will pause for 1 second between polling for
-        more messages.
+        more messages. With adaptive, it pauses longer and longer (up to 10 
+        seconds) while there still aren't any.
         
         Example:
         
@@ -482,17 +603,45 @@ class Partition(object):
                 print "Count of barks received: {0}".format(status.messages_read)
                 print "Total barking received: {0}".format(status.bytes_read)
         
-        Note that this method assumes we can increment the offset by knowing the
-        last read offset, the last read message size, and the header size. This
-        will change if compression ever gets implemented and the header format
-        changes: https://issues.apache.org/jira/browse/KAFKA-79
+        Compressed messages are transparently unpacked. All the messages
+        that came out of the same compressed message share its offset, and
+        the offset moves past all of them at once (see MessageSet).
         """
-        # Kafka msg headers are 9 bytes: 4=len(msg), 1=magic val, 4=CRC
-        MESSAGE_HEADER_SIZE = 9
 
         # Init for first run
+        if offset is None and checkpoint is not None:
+            offset = checkpoint.offset(self._topic, self._partition)
+        if offset is None:
+            offset = self.latest_offset()
+        start_offset = offset
+
+        # Shorthand fetch call alias with everything filled in except offset
+        # The return from a call to fetch is list of (offset, msg) tuples that 
+        # look like: [(0, 'Rusty'), (14, 'Patty'), (28, 'Jack'), (41, 'Clyde')]
+        fetch_policy = None
+        if adaptive:
+            fetch_policy = AdaptiveFetch(max_size or self._kafka.max_size,
+                                         poll_interval=poll_interval)
+        def fetch_messages(offset):
+            if fetch_policy is not None:
+                return self.fetch(offset, fetch_policy.max_size, 
+                                  include_corrupt)
+            return self.fetch(offset, max_size, include_corrupt)
+        if prefetch:
+            fetch_messages = _Prefetcher(fetch_messages, prefetch)
+        try:
+            for status_and_messages in self._poll(fetch_messages, offset, 
+                    start_offset, end_offset, poll_interval, retry_limit, 
+                    fetch_policy, checkpoint):
+                yield status_and_messages
+        finally:
+            if prefetch:
+                fetch_messages.stop()
+
+    def _poll(self, fetch_messages, offset, start_offset, end_offset, 
+            poll_interval, retry_limit, fetch_policy, checkpoint):
         first_loop = True
-        start_offset = self.latest_offset() if offset is None else offset
+        checked_offset = None # The offset of the last too large message
         last_offset_read = None # The offset of the last message we returned
         messages_read = 0 # How many messages have we read from the stream?
         bytes_read = 0 # Total number of bytes read from the stream?
@@ -500,15 +649,6 @@ class Partition(object):
         seconds_slept = 0
         polling_start_time = datetime.now()
 
-        # Shorthand fetch call alias with everything filled in except offset
-        # The return from a call to fetch is list of (offset, msg) tuples that 
-        # look like: [(0, 'Rusty'), (14, 'Patty'), (28, 'Jack'), (41, 'Clyde')]
-        fetch_messages = partial(self._kafka.fetch,
-                                 self._topic,
-                                 partition=self._partition,
-                                 max_size=max_size,
-                                 callback=None,
-                                 include_corrupt=include_corrupt)
         retry_attempts = 0
         while True:
             if end_offset is not None and offset > end_offset:
@@ -538,8 +678,18 @@ class Partition(object):
                                                earliest=self.earliest_offset(),
                                                latest=self.latest_offset()))
 
+            # Where the next fetch starts: right after the last complete
+            # message, unless we drop some of them below.
+            next_offset = msg_batch.next_offset
+            truncated = msg_batch.truncated
+            fetched_batch = msg_batch
+
             # Filter out the messages that are past our end_offset
             if end_offset is not None:
+               past_end_offsets = [msg_offset for msg_offset, msg in msg_batch
+                                   if msg_offset > end_offset]
+               if past_end_offsets:
+                   next_offset = past_end_offsets[0]
                msg_batch = [(msg_offset, msg) for msg_offset, msg in msg_batch
                             if msg_offset <= end_offset]
 
@@ -549,7 +699,7 @@ class Partition(object):
             # invalid-but-in-plausible-range offset is requested. We assume that
             # if we get past the first loop, we're ok, because we don't want to
             # constantly call earliest/latest_offset() (they're network calls)
-            if first_loop and not msg_batch:
+            if first_loop and not msg_batch and not truncated:
                 # If we're not at the latest available offset, then a call to 
                 # fetch should return us something if it's valid. We have to 
                 # make another fetch here because there's a chance 
@@ -557,8 +707,24 @@ class Partition(object):
                 if self.earliest_offset() <= offset < self.latest_offset() and \
                    not fetch_messages(offset):
                     raise InvalidOffset("No message at offset {0}".format(offset))
+            # Only part of a message came back: it is either larger than the
+            # fetch, or we're not at the start of a message and read garbage.
+            # If the fetch reached the end of the log, it was garbage. Asked 
+            # once per message, adaptive fetches retry it with larger sizes.
+            if not fetched_batch and truncated and offset != checked_offset:
+                if offset + truncated >= self.latest_offset(max_age=0):
+                    raise InvalidOffset("No message at offset {0}".format(offset))
+                if fetch_policy is None:
+                    raise MessageTooLarge("Message at offset {0} is larger than max_size, raise it or poll with adaptive".format(offset))
+                checked_offset = offset
             first_loop = False
 
+            # How long to wait before the next fetch
+            if fetch_policy is not None:
+                delay = fetch_policy.fetched(offset, fetched_batch)
+            else:
+                delay = 0 if fetched_batch else poll_interval
+
             # Our typical processing...
             messages = [msg for msg_offset, msg in msg_batch]
             messages_read += len(messages)
@@ -566,9 +732,8 @@ class Partition(object):
             num_fetches += 1
 
             if msg_batch:
-                last_offset_read, last_message_read = msg_batch[-1]
-                offset = last_offset_read + len(last_message_read) + \
-                         MESSAGE_HEADER_SIZE
+                last_offset_read = msg_batch[-1][0]
+                offset = next_offset
 
             status = Partition.PollingStatus(start_offset=start_offset,
                                              next_offset=offset,
@@ -580,16 +745,116 @@ class Partition(object):
                                              seconds_slept=seconds_slept)
         
             yield status, messages # messages is a list of strs
+
+            # Back for more, so these were processed
+            if checkpoint is not None and messages:
+                checkpoint.commit(self._topic, self._partition, offset, 
+                                  len(messages))
         
             # We keep grabbing as often as we can until we run out, after which
             # we start sleeping between calls until we see more.
-            if poll_interval and not messages:
-                time.sleep(poll_interval)
-                seconds_slept += poll_interval
+            if delay and not messages:
+                time.sleep(delay)
+                seconds_slept += delay
+
 
+class _Prefetcher(object):
+    """ Stands in for Partition.poll's fetch function and fetches the 
+        batches that follow the one just handed out on a background thread,
+        keeping at most `depth` of them queued. The thread holds on to one
+        more while it waits for room in the queue, so up to depth + 1 
+        batches are buffered on top of the one being processed.
+
+        After an empty batch or an error the thread waits until it is asked
+        for an offset again. Asking for any other offset than the one 
+        following the last batch throws away what was fetched ahead.
+    """
+    def __init__(self, fetch, depth):
+        self._fetch = fetch
+        # (generation, offset, batch, error)
+        self._batches = Queue.Queue(depth)
+        self._lock = threading.Condition()
+        # Bumped every time what was fetched ahead becomes useless
+        self._generation = 0
+        # Offset the thread should fetch next, None to wait
+        self._fetch_offset = None
+        # Offset of the next batch the queue will hand out
+        self._expected_offset = None
+        # Whether the thread is between picking an offset and queueing the
+        # batch it fetched
+        self._fetching = False
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, 
+            name='kafka-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, offset):
+        while True:
+            with self._lock:
+                if offset != self._expected_offset:
+                    self._generation += 1
+                    self._discard_batches()
+                    # Fetched next, once a fetch for the old offset is done
+                    self._fetch_offset = offset
+                    self._expected_offset = offset
+                    self._lock.notify()
+                elif self._fetch_offset is None and not self._fetching and \
+                   self._batches.empty():
+                    # Nothing is on its way, fetch it now
+                    self._fetch_offset = offset
+                    self._lock.notify()
+                generation = self._generation
+
+            batch_generation, batch_offset, batch, error = self._batches.get()
+            if batch_generation == generation and batch_offset == offset:
+                break
 
+        with self._lock:
+            if batch:
+                self._expected_offset = batch.next_offset
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return batch
 
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._discard_batches()
+            self._lock.notify()
 
+    def _discard_batches(self):
+        while True:
+            try:
+                self._batches.get_nowait()
+            except Queue.Empty:
+                return
 
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._fetch_offset is None and not self._stopped:
+                    self._lock.wait()
+                if self._stopped:
+                    return
+                offset, generation = self._fetch_offset, self._generation
+                self._fetching = True
+
+            batch, error = None, None
+            try:
+                batch = self._fetch(offset)
+            except Exception:
+                error = sys.exc_info()
 
+            with self._lock:
+                if generation != self._generation or self._stopped:
+                    self._fetching = False
+                    continue
+                # Keep going only while there is something to read
+                self._fetch_offset = batch.next_offset if batch else None
 
+            # Blocks while `depth` batches are waiting to be processed
+            self._batches.put((generation, offset, batch, error))
+            with self._lock:
+                self._fetching = False
@@ -1,42 +1,230 @@
 import array
 import errno
+import select
 import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 
-from kafka.base import BaseKafka, logging, StringIO, ConnectionFailure
+from kafka import protocol
+from kafka.base import BaseKafka, logging, StringIO, ConnectionFailure, \
+    KafkaError, MaxRetries
 socket_log = logging.getLogger('kafka.socket')
 
 __all__ = [
     'Kafka',
+    'Pipeline',
+    'FetchStream',
+    'Connection',
 ]
 
+class Connection(object):
+    """ A socket to a Kafka server along with its receive buffer. """
+
+    # Largest receive buffer kept from one read to the next. Reads of more
+    # than that get a buffer of their own, dropped once they are done, so 
+    # one large fetch doesn't pin its size for the life of the connection.
+    MAX_RECV_BUFFER_SIZE = BaseKafka.DEFAULT_MAX_SIZE + 64 * 1024
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.socket = None
+        # Reusable receive buffer, grown to the largest response seen, up 
+        # to MAX_RECV_BUFFER_SIZE
+        self.recv_buffer = bytearray()
+        self.last_used = time.time()
+
+    @property
+    def connected(self):
+        return self.socket is not None
+
+    def connect(self):
+        """ Connect to the Kafka server. """
+
+        self.socket = socket.socket()
+        # Requests are small and often written back to back (produce then 
+        # fetch, pipelines), don't let Nagle hold them back.
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.socket.connect((self.host, self.port))
+        except Exception, e:
+            self.socket = None
+            raise ConnectionFailure("Could not connect to kafka at {0}:{1}".format(self.host, self.port))
+
+    def close(self):
+        """ Disconnect from the remote server & close the socket. """
+        try:
+            self.socket.close()
+        except (IOError, AttributeError):
+            pass
+        finally:
+            self.socket = None
+
+    def is_alive(self):
+        """ Cheap health check for an idle connection: there should be 
+            nothing to read on it, readable means the server hung up or 
+            sent something we never asked for. """
+        if self.socket is None:
+            return False
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def read(self, length):
+        """ Read exactly `length` bytes. """
+        
+        if length > self.MAX_RECV_BUFFER_SIZE:
+            recv_view = memoryview(bytearray(length))
+        else:
+            if len(self.recv_buffer) < length:
+                self.recv_buffer = bytearray(length)
+            recv_view = memoryview(self.recv_buffer)
+        read_length = 0
+        
+        # socket_log.debug('recv: expected {0} bytes'.format(length))
+        while read_length < length:
+            chunk_length = self.socket.recv_into(
+                recv_view[read_length:length], length - read_length)
+            if chunk_length == 0:
+                raise ConnectionFailure("Connection to kafka at {0}:{1} closed".format(self.host, self.port))
+            read_length += chunk_length
+
+        # socket_log.info('recv: {0} bytes total'.format(read_length))
+        return recv_view[0:length].tobytes()
+
+    def recv(self, max_length):
+        """ Read whatever has come in, up to max_length bytes, waiting for
+            something if there is nothing yet. """
+        data = self.socket.recv(max_length)
+        if not data:
+            raise ConnectionFailure("Connection to kafka at {0}:{1} closed".format(self.host, self.port))
+        return data
+
+    def send(self, data):
+        """ Send `data`, a str or a list of strs. A list is joined once, 
+            size prefix, headers and payloads together, and goes out in a 
+            single sendall(): Python 2 sockets have no scatter/gather 
+            write. """
+
+        # socket_log.info('send: {0}'.format(repr(data)))
+        if not isinstance(data, str):
+            data = ''.join(data)
+        self.socket.sendall(data)
+
+
 class Kafka(BaseKafka):
     def __init__(self, *args, **kwargs):
+        # An optional kafka.pool.ConnectionPool. With a pool, every request
+        # borrows a connection from it and the Kafka object can be shared 
+        # between threads.
+        self.pool = kwargs.pop('pool', None)
         BaseKafka.__init__(self, *args, **kwargs)
         
-        self._socket = None
-        self._overflow = ''
+        self._connection = Connection(self.host, self.port)
+        self._local = threading.local()
         self.total_read = 0
 
+    DEFAULT_STREAM_CHUNK_SIZE = 64 * 1024
+
+    def fetch_stream(self, topic, offset, partition=None, max_size=None, 
+            include_corrupt=False, chunk_size=None):
+        """ Fetch like fetch(), but generate the (offset, message) tuples 
+            as they come off the socket instead of once the whole response
+            is in. The first messages of a large fetch can be worked on 
+            while the rest is on its way, and only one partial message is 
+            kept at a time.
+
+            Returns a FetchStream, whose next_offset and truncated are 
+            those of the MessageSet fetch() would have returned once it is
+            exhausted.
+
+            Params (in addition to fetch()'s):
+                chunk_size: most bytes read from the socket at a time
+        """
+        return FetchStream(self, topic, offset, partition, max_size, 
+            include_corrupt, chunk_size or self.DEFAULT_STREAM_CHUNK_SIZE)
+
+    def pipeline(self, max_in_flight=None):
+        """ Return a Pipeline that batches requests on this connection. """
+        return Pipeline(self, max_in_flight)
+
+    def multi_offsets(self, requests, callback=None):
+        """ Look up offsets for several topics/partitions at once
+
+            Kafka has no request for this, so the OFFSETS requests are 
+            pipelined on one connection: one pass over the partitions 
+            instead of a round trip each. Earliest/latest offsets land in 
+            offsets_cache as usual.
+
+            Params:
+                requests:   a list of (topic, partition, time_val, 
+                            max_offsets) tuples
+
+            Returns:
+                a list of offset lists, in the same order as requests
+        """
+        pipeline = self.pipeline()
+        for topic, partition, time_val, max_offsets in requests:
+            pipeline.offsets(topic, time_val, max_offsets, partition)
+        results = pipeline.execute()
+        return callback(results) if callback else results
+
+    # Connection management methods
+
+    @property
+    def _current_connection(self):
+        """ The connection the calling thread is working with. """
+        if self.pool is None:
+            return self._connection
+        return self._local.connection
+
+    @contextmanager
+    def _borrowed_connection(self):
+        """ Hold on to a pooled connection for the duration of a request, 
+            since the write and the read must happen on the same socket. 
+            Nested uses (e.g. from a Pipeline) keep the outermost one. """
+        
+        if self.pool is None or \
+           getattr(self._local, 'connection', None) is not None:
+            yield
+            return
+
+        connection = self.pool.checkout(self.host, self.port)
+        self._local.connection = connection
+        try:
+            yield
+        except KafkaError, e:
+            # Error responses are read in full, the connection is still in 
+            # a known state unless the error came from the socket itself.
+            self._local.connection = None
+            self.pool.checkin(connection, 
+                discard=isinstance(e, ConnectionFailure))
+            raise
+        except:
+            self._local.connection = None
+            self.pool.checkin(connection, discard=True)
+            raise
+        else:
+            self._local.connection = None
+            self.pool.checkin(connection)
+
+    def _request(self, request, callback):
+        with self._borrowed_connection():
+            return BaseKafka._request(self, request, callback)
+
     # Socket management methods
     
     def _connect(self):
         """ Connect to the Kafka server. """
-
-        self._socket = socket.socket()
-        try:
-            self._socket.connect((self.host, self.port))
-        except Exception, e:
-            self._socket = None
-            raise ConnectionFailure("Could not connect to kafka at {0}:{1}".format(self.host, self.port))
+        self._current_connection.connect()
 
     def _disconnect(self):
         """ Disconnect from the remote server & close the socket. """
-        try:
-            self._socket.close()
-        except IOError:
-            pass
-        finally:
-            self._socket = None
+        self._current_connection.close()
 
     def _read(self, length, callback=None):
         """ Send a read request to the remote Kafka server. """
@@ -44,63 +232,221 @@ class Kafka(BaseKafka):
         if callback is None:
             callback = lambda v: v
         
-        if self._socket is None:
-            self._connect()
+        connection = self._current_connection
+        if not connection.connected:
+            connection.connect()
 
-        read_length = 0
-        read_data = ''
-        
         try:
-            # socket_log.debug('recv: expected {0} bytes'.format(length))
-            while read_length < length:            
-                chunk = self._socket.recv(length)
-                read_length = read_length + len(chunk)
-                read_data = read_data + chunk
-                self.total_read += read_length
-        except errno.EAGAIN:
-            self._disconnect()
+            data = connection.read(length)
+            self.total_read += length
+            if self.metrics is not None:
+                self.metrics.increment('bytes_received', length)
+        except socket.timeout:
+            connection.close()
             raise IOError("Timeout reading from the socket.")
-        except IOError:
-            self._disconnect()
+        except (IOError, ConnectionFailure):
+            connection.close()
             raise
         else:
-            # socket_log.info('recv: {0} bytes total'.format(len(read_data)))
-            output = self._overflow + read_data[0:length]
-            self._overflow = read_data[length:]
-      
-            return callback(output)
+            return callback(data)
 
     def _write(self, data, callback=None, retries=BaseKafka.MAX_RETRY):
         """ Write `data` to the remote Kafka server. """
         
+        with self._borrowed_connection():
+            return self._write_connection(data, callback, retries)
+
+    def _write_connection(self, data, callback, retries, connection=None):
         if callback is None:
             callback = lambda: None
         
-        if self._socket is None:
-            self._connect()
-
-        wrote_length = 0
+        if connection is None:
+            connection = self._current_connection
+        if not connection.connected:
+            connection.connect()
 
         try:
-            write_length = len(data)
-            wrote_length = 0
-
-            while write_length > wrote_length:
-                # socket_log.info('send: {0}'.format(repr(data)))
-                wrote_length += self._socket.send(data)
+            connection.send(data)
 
         except socket.error, e:
             if e.errno in [errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED]:
                 # Retry once.
-                self._reconnect()
+                connection.close()
+                connection.connect()
+                if self.metrics is not None:
+                    self.metrics.increment('reconnects')
                 if retries > 0:
                     retries -= 1
                     socket_log.warn("Socket error (%s), reconnecting (%s retries left)" % (str(e), retries))
-                    return self._write(data, callback, retries)
+                    if self.metrics is not None:
+                        self.metrics.increment('retries')
+                    return self._write_connection(data, callback, retries, 
+                        connection)
                 else:
-                    raise MaxRetries()
+                    raise MaxRetries("Could not write to kafka at {0}:{1}: {2}".format(self.host, self.port, e))
             else:
                 raise
         else:
+            if self.metrics is not None:
+                self._count_sent(data)
             return callback()
-    
\ No newline at end of file
+
+
+class FetchStream(object):
+    """ What Kafka.fetch_stream() returns, an iterator over the messages of
+        the fetch. It reads them from a connection of its own, taken from 
+        the Kafka's pool if there is one. Closing it before the end drops 
+        the connection, since the rest of the response is still on it. """
+
+    def __init__(self, kafka, topic, offset, partition, max_size, 
+            include_corrupt, chunk_size):
+        self._kafka = kafka
+        self.next_offset = offset
+        self.truncated = 0
+        self._messages = self._read(topic.encode('utf-8'), offset, 
+            partition or 0, max_size or kafka.max_size, include_corrupt, 
+            chunk_size)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._messages.next()
+
+    def close(self):
+        self._messages.close()
+
+    def _read(self, topic, offset, partition, max_size, include_corrupt, 
+            chunk_size):
+        kafka = self._kafka
+        # A connection of the stream's own: on the Kafka's (or the thread's
+        # borrowed) connection, requests made while the stream is being 
+        # iterated over would read the rest of its response as theirs.
+        if kafka.pool is not None:
+            connection = kafka.pool.checkout(kafka.host, kafka.port)
+        else:
+            connection = Connection(kafka.host, kafka.port)
+        stream = protocol.Connection(kafka.codec)
+
+        done = False
+        try:
+            if kafka.metrics is not None:
+                kafka.metrics.increment('requests.fetch')
+            kafka._write_connection(stream.fetch_stream(topic, offset, 
+                partition, max_size, include_corrupt), None, 
+                BaseKafka.MAX_RETRY, connection)
+
+            while not done:
+                try:
+                    data = connection.recv(chunk_size)
+                except socket.timeout:
+                    raise IOError("Timeout reading from the socket.")
+                kafka.total_read += len(data)
+                if kafka.metrics is not None:
+                    kafka.metrics.increment('bytes_received', len(data))
+                for event in stream.receive_data(data):
+                    if isinstance(event, protocol.ResponseFailed):
+                        done = True
+                        raise event.error
+                    elif isinstance(event, protocol.Response):
+                        done = True
+                        messages = event.result
+                    else:
+                        messages = event.messages
+                    for message in messages:
+                        yield message
+                    self.next_offset = messages.next_offset
+                    self.truncated = messages.truncated
+        finally:
+            # Unless done, the rest of the response is still coming
+            if kafka.pool is not None:
+                kafka.pool.checkin(connection, discard=not done)
+            else:
+                connection.close()
+
+
+class Pipeline(BaseKafka):
+    """ Queues the requests made through it, then sends them all over its
+        Kafka's connection with up to max_in_flight of them waiting for a 
+        response at any time, instead of paying a round trip for each one.
+
+        Responses come back in order, so an error response doesn't 
+        desynchronize the connection: every queued request still gets 
+        sent and read, and the first error is raised at the end.
+
+        Example:
+
+            pipeline = kafka.pipeline()
+            for partition, offset in offsets.iteritems():
+                pipeline.fetch('good_dogs', offset, partition)
+            for messages in pipeline.execute():
+                ...
+    """
+    def __init__(self, kafka, max_in_flight=None):
+        BaseKafka.__init__(self, kafka.host, kafka.port, kafka.max_size, 
+            max_in_flight=max_in_flight or kafka.max_in_flight)
+        self._kafka = kafka
+        self.codec = kafka.codec
+        self.offsets_cache = kafka.offsets_cache
+        self.partitioner = kafka.partitioner
+        self.metrics = kafka.metrics
+        self._requests = []
+
+    def execute(self):
+        """ Send all the queued requests and return their results, in the 
+            order they were queued. Produce requests have no response, 
+            their result is whatever their callback returns. """
+        
+        requests, self._requests = self._requests, []
+        with self._kafka._borrowed_connection():
+            return self._execute(requests)
+
+    def _execute(self, requests):
+        results = [None] * len(requests)
+        awaiting = deque()
+        errors = []
+
+        try:
+            for index, (request, callback, has_response) in enumerate(requests):
+                if len(awaiting) >= self.max_in_flight:
+                    self._read_next_response(awaiting, results, errors)
+                # A write retried on a new connection would leave the 
+                # responses still owed on the old one behind, and the next
+                # ones read would be paired with the wrong requests
+                retries = 0 if awaiting else BaseKafka.MAX_RETRY
+                if has_response:
+                    self._kafka._write(request, None, retries)
+                    awaiting.append((index, callback))
+                else:
+                    results[index] = self._kafka._write(request, callback, 
+                        retries)
+
+            while awaiting:
+                self._read_next_response(awaiting, results, errors)
+        except:
+            # We can't tell how far the connection got, start over next time
+            self._kafka._disconnect()
+            raise
+
+        if errors:
+            raise errors[0]
+        return results
+
+    def _read_next_response(self, awaiting, results, errors):
+        index, callback = awaiting.popleft()
+        try:
+            results[index] = self._kafka._wrote_request(callback)
+        except (ConnectionFailure, IOError, socket.error):
+            # The connection is gone along with the responses still on it
+            raise
+        except KafkaError, e:
+            # The response was read in full, keep going
+            errors.append(e)
+
+    # Requests are queued rather than sent
+
+    def _request(self, request, callback):
+        self._requests.append((request, callback, True))
+
+    def _write(self, data, callback=None, retries=BaseKafka.MAX_RETRY):
+        self._requests.append((data, callback, False))
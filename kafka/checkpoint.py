@@ -0,0 +1,217 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from kafka.base import kafka_log
+
+__all__ = [
+    'OffsetStore',
+    'FileOffsetStore',
+    'SQLiteOffsetStore',
+    'Checkpoint',
+]
+
+class OffsetStore(object):
+    """ Where consumers keep the offset to resume each partition from.
+
+        Subclasses implement load() and save(). They are only ever called
+        from one thread at a time.
+    """
+    def load(self):
+        """ Return a dict mapping (topic, partition) to offset. """
+        raise NotImplementedError()
+
+    def save(self, offsets):
+        """ Store offsets, a dict mapping (topic, partition) to offset, in
+            addition to those already stored. """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class FileOffsetStore(OffsetStore):
+    """ Keeps offsets in a JSON file, rewritten in full by each save() and
+        swapped in atomically so a crash never leaves half a file. """
+
+    def __init__(self, path):
+        self.path = path
+        self._offsets = None
+
+    def load(self):
+        if self._offsets is None:
+            self._offsets = {}
+            try:
+                with open(self.path) as f:
+                    # Topics are strs everywhere else, not what json gives
+                    for topic, partition, offset in json.load(f):
+                        self._offsets[(topic.encode('utf-8'), partition)] = \
+                            offset
+            except IOError:
+                pass
+        return dict(self._offsets)
+
+    def save(self, offsets):
+        self.load()
+        self._offsets.update(offsets)
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.offsets')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump([[topic, partition, offset] for
+                    (topic, partition), offset in self._offsets.iteritems()],
+                    f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+
+class SQLiteOffsetStore(OffsetStore):
+    """ Keeps offsets in a SQLite database, one row per partition. """
+
+    def __init__(self, path):
+        self.path = path
+        # Opened in one thread and used from the Checkpoint's
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Topics come back as strs, not unicode
+        self._db.text_factory = str
+        self._db.execute('CREATE TABLE IF NOT EXISTS offsets ('
+            'topic TEXT NOT NULL, partition INTEGER NOT NULL, '
+            'offset INTEGER NOT NULL, PRIMARY KEY (topic, partition))')
+        self._db.commit()
+
+    def load(self):
+        return dict(((topic, partition), offset) for topic, partition, offset
+            in self._db.execute('SELECT topic, partition, offset FROM offsets'))
+
+    def save(self, offsets):
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO offsets '
+                '(topic, partition, offset) VALUES (?, ?, ?)',
+                [(topic, partition, offset) for (topic, partition), offset
+                 in offsets.iteritems()])
+
+    def close(self):
+        self._db.close()
+
+
+class Checkpoint(object):
+    """ Records how far consumers got and saves it to an OffsetStore in
+        the background, every_messages messages or every_seconds seconds
+        after the first unsaved commit, whichever comes first.
+
+        commit() only updates a dict, so it is cheap enough to call for
+        every batch. Whatever was committed since the last save is lost if
+        the process dies, and will be read again after a restart.
+
+        Example:
+
+            checkpoint = Checkpoint(SQLiteOffsetStore('offsets.db'))
+            dogs = kafka.partition('good_dogs')
+            for status, messages in dogs.poll(checkpoint=checkpoint):
+                ...
+    """
+    DEFAULT_EVERY_MESSAGES = 1000
+    DEFAULT_EVERY_SECONDS = 5
+
+    def __init__(self, store, every_messages=None, every_seconds=None):
+        self.store = store
+        self.every_messages = every_messages or self.DEFAULT_EVERY_MESSAGES
+        self.every_seconds = self.DEFAULT_EVERY_SECONDS \
+            if every_seconds is None else every_seconds
+
+        self._lock = threading.Condition()
+        # Held while saving, so saves go out in order
+        self._save_lock = threading.Lock()
+        self._offsets = store.load()
+        # (topic, partition) -> offset, committed but not saved yet
+        self._pending = {}
+        self._pending_messages = 0
+        self._first_pending = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run,
+            name='kafka-checkpoint')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def offset(self, topic, partition=None):
+        """ The last offset committed for topic/partition, None if there is
+            none. """
+        with self._lock:
+            return self._offsets.get((topic, partition or 0))
+
+    def commit(self, topic, partition, offset, messages=1):
+        """ Record that the messages of topic/partition before offset have
+            been processed. messages counts towards every_messages. """
+        with self._lock:
+            key = (topic, partition or 0)
+            self._offsets[key] = self._pending[key] = offset
+            self._pending_messages += messages
+            if self._first_pending is None:
+                self._first_pending = time.time()
+                self._lock.notify()
+            elif self._pending_messages >= self.every_messages:
+                self._lock.notify()
+
+    def flush(self):
+        """ Save everything committed so far, from the calling thread. """
+        self._save(raise_errors=True)
+
+    def close(self):
+        """ Save everything committed so far and stop the background
+            thread. The store is closed too. """
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        self._thread.join()
+        self.store.close()
+
+    def _save_due(self):
+        """ Seconds until the pending commits must be saved, None if there
+            are none. """
+        if self._first_pending is None:
+            return None
+        if self._pending_messages >= self.every_messages:
+            return 0
+        return max(0, self._first_pending + self.every_seconds - time.time())
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._closed and self._save_due() != 0:
+                    self._lock.wait(self._save_due())
+                closed = self._closed
+            self._save()
+            if closed:
+                return
+
+    def _save(self, raise_errors=False):
+        with self._save_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+                self._pending_messages = 0
+                self._first_pending = None
+
+            if not pending:
+                return
+            try:
+                self.store.save(pending)
+            except Exception:
+                # Keep them for the next save, unless newer ones came in
+                with self._lock:
+                    for key, offset in pending.iteritems():
+                        self._pending.setdefault(key, offset)
+                    if self._first_pending is None:
+                        self._first_pending = time.time()
+                if raise_errors:
+                    raise
+                kafka_log.exception('Failed to save offsets for {0} partitions'.format(len(pending)))
@@ -0,0 +1,273 @@
+import threading
+import Queue
+from collections import defaultdict
+
+from kafka.base import BaseKafka, Partition, KafkaError, MultiFetchError, \
+    NoBrokerForPartition, COMPRESSION_NONE
+from kafka.blocking import Kafka
+
+__all__ = [
+    'KafkaCluster',
+]
+
+class KafkaCluster(object):
+    """ Talks to several brokers, sending each request to the broker that
+        has the topic/partition it is about.
+
+        Kafka 0.7 clients have to know where partitions live, so the brokers
+        and the partitions each of them has are given up front. There is
+        one Kafka client (and so one connection, or a pool) per broker.
+        Requests about a single partition go straight to its broker;
+        multi_produce(), multi_fetch() and multi_offsets() split their work
+        by broker and send each broker its share at the same time: the 
+        calling thread talks to one of them, threads kept around for the 
+        purpose to the others.
+
+        Params:
+            brokers:    a list of 'host:port' strings or (host, port) tuples
+            partitions: a dict mapping (topic, partition) to the broker that
+                        has it, given the same way as in brokers
+            partitioner: picks the partition of messages produced without
+                        one, before picking the broker
+            Everything else is passed on to each broker's Kafka client
+            (max_size, max_in_flight, pool, ...).
+
+        Like Kafka, a KafkaCluster is only safe to share between threads
+        when given a pool.
+
+        Example:
+
+            cluster = KafkaCluster(['kafka1:9092', 'kafka2:9092'], {
+                ('good_dogs', 0): 'kafka1:9092',
+                ('good_dogs', 1): 'kafka2:9092',
+            })
+            cluster.produce('good_dogs', 'woof', partition=1)
+            results = cluster.multi_fetch([('good_dogs', 0, offset0, None),
+                                           ('good_dogs', 1, offset1, None)])
+    """
+    def __init__(self, brokers, partitions=None, **kwargs):
+        self.pool = kwargs.get('pool')
+        self.partitioner = kwargs.pop('partitioner', None)
+        # (host, port) -> Kafka
+        self.brokers = {}
+        for broker in brokers:
+            host, port = self._address(broker)
+            self.brokers[(host, port)] = Kafka(host, port, **kwargs)
+        if not self.brokers:
+            raise ValueError("A KafkaCluster needs at least one broker")
+        self.max_size = self.brokers.values()[0].max_size
+        # (topic, partition) -> (host, port)
+        self.partitions = {}
+        for (topic, partition), broker in (partitions or {}).iteritems():
+            self.assign(topic, partition, broker)
+        # Threads that run the calls to the other brokers for 
+        # _run_parallel(), started as needed
+        self._workers = []
+        self._tasks = Queue.Queue()
+        self._workers_lock = threading.Lock()
+
+    # Routing
+
+    def assign(self, topic, partition, broker):
+        """ Send the requests about topic/partition to broker from now on.
+            broker must be one of the cluster's. """
+        address = self._address(broker)
+        if address not in self.brokers:
+            raise ValueError("{0}:{1} is not one of the brokers".format(*address))
+        self.partitions[(topic, partition or 0)] = address
+
+    def broker(self, topic, partition=None):
+        """ The Kafka client for the broker that has topic/partition. """
+        try:
+            return self.brokers[self.partitions[(topic, partition or 0)]]
+        except KeyError:
+            raise NoBrokerForPartition("No broker has topic {0}, partition {1}".format(topic, partition or 0))
+
+    # Requests about a single partition
+
+    def produce(self, topic, messages, partition=None, callback=None,
+            compression=COMPRESSION_NONE, key=None):
+        """ See Kafka.produce(). """
+        messages = self._clean_messages(messages)
+        partition = self._pick_partition(topic, partition, key, messages)
+        return self.broker(topic, partition).produce(topic, messages,
+            partition, callback, compression)
+
+    def fetch(self, topic, offset, partition=None, max_size=None,
+            callback=None, include_corrupt=False):
+        """ See Kafka.fetch(). """
+        return self.broker(topic, partition).fetch(topic, offset, partition,
+            max_size, callback, include_corrupt)
+
+    def fetch_stream(self, topic, offset, partition=None, max_size=None,
+            include_corrupt=False, chunk_size=None):
+        """ See Kafka.fetch_stream(). """
+        return self.broker(topic, partition).fetch_stream(topic, offset,
+            partition, max_size, include_corrupt, chunk_size)
+
+    def offsets(self, topic, time_val, max_offsets, partition=None,
+            callback=None):
+        """ See Kafka.offsets(). """
+        return self.broker(topic, partition).offsets(topic, time_val,
+            max_offsets, partition, callback)
+
+    def cached_offset(self, topic, time_val, partition=None, callback=None,
+            max_age=None):
+        """ See Kafka.cached_offset(). """
+        return self.broker(topic, partition).cached_offset(topic, time_val,
+            partition, callback, max_age)
+
+    def topic(self, topic, partition=None):
+        """ Return a Partition for topic/partition. """
+        return Partition(self, topic, partition)
+
+    def partition(self, topic, partition=None):
+        """ Return a Partition for topic/partition. """
+        return Partition(self, topic, partition)
+
+    # Requests about many partitions, sent to every broker involved at once
+
+    def multi_produce(self, messages_by_partition, callback=None,
+            compression=COMPRESSION_NONE):
+        """ See Kafka.multi_produce(). Each broker gets one MULTIPRODUCE
+            request with its partitions' messages. """
+        by_broker = defaultdict(dict)
+        for (topic, partition), messages in messages_by_partition.iteritems():
+            messages = self._clean_messages(messages)
+            partition = self._pick_partition(topic, partition, None, messages)
+            by_broker[self.broker(topic, partition)][(topic, partition)] = \
+                messages
+
+        self._run_parallel([
+            (broker.multi_produce, (broker_messages, None, compression))
+            for broker, broker_messages in by_broker.iteritems()])
+        if callback:
+            return callback()
+
+    def multi_fetch(self, fetches, callback=None, include_corrupt=False):
+        """ See Kafka.multi_fetch(). Each broker gets one MULTIFETCH request
+            for its partitions, the results come back in the order of
+            fetches. A MultiFetchError has the results from every broker. """
+        def broker_multi_fetch(broker, broker_fetches):
+            try:
+                return broker.multi_fetch(broker_fetches, None, 
+                    include_corrupt)
+            except MultiFetchError, e:
+                return e.results
+
+        results = self._split_by_broker(fetches,
+            lambda broker, broker_fetches: (broker_multi_fetch,
+                (broker, broker_fetches)))
+        errors = dict((index, result) for index, result in enumerate(results)
+                      if isinstance(result, KafkaError))
+        if errors:
+            raise MultiFetchError(results, errors)
+        return callback(results) if callback else results
+
+    def multi_offsets(self, requests, callback=None):
+        """ See Kafka.multi_offsets(). Each broker's requests are pipelined
+            on its connection. """
+        results = self._split_by_broker(requests,
+            lambda broker, broker_requests: (broker.multi_offsets,
+                (broker_requests,)))
+        return callback(results) if callback else results
+
+    def close(self):
+        """ Disconnect from every broker, and stop the threads. With a 
+            pool, its idle connections are closed. """
+        with self._workers_lock:
+            for worker in self._workers:
+                self._tasks.put(None)
+            self._workers = []
+        for broker in self.brokers.itervalues():
+            broker._connection.close()
+        if self.pool is not None:
+            # The brokers share it
+            self.pool.close()
+
+    # Helper methods
+
+    _clean_messages = staticmethod(BaseKafka._clean_messages)
+
+    def _pick_partition(self, topic, partition, key, messages):
+        if partition is None and self.partitioner is not None:
+            return self.partitioner.partition(topic, key, messages)
+        return partition or 0
+
+    @staticmethod
+    def _address(broker):
+        if isinstance(broker, basestring):
+            host, _, port = broker.partition(':')
+            return host, int(port or 9092)
+        host, port = broker
+        return host, int(port)
+
+    def _split_by_broker(self, requests, make_call):
+        """ Group requests, (topic, partition, ...) tuples, by broker, send
+            each group with the call make_call(broker, group) returns, and
+            put the results back in the order of requests. """
+        indexes = defaultdict(list)
+        groups = defaultdict(list)
+        for index, request in enumerate(requests):
+            broker = self.broker(request[0], request[1])
+            indexes[broker].append(index)
+            groups[broker].append(request)
+
+        brokers = groups.keys()
+        broker_results = self._run_parallel([make_call(broker, groups[broker])
+                                             for broker in brokers])
+        results = [None] * len(requests)
+        for broker, group_results in zip(brokers, broker_results):
+            for index, result in zip(indexes[broker], group_results):
+                results[index] = result
+        return results
+
+    def _run_parallel(self, calls):
+        """ Run (function, args) calls, the first in this thread and the 
+            others on the worker threads, and return their results in 
+            order. The first exception raised is raised once they are all 
+            done. """
+        results = [None] * len(calls)
+        errors = [None] * len(calls)
+        def run(index):
+            function, args = calls[index]
+            try:
+                results[index] = function(*args)
+            except Exception, e:
+                errors[index] = e
+
+        done = Queue.Queue()
+        if len(calls) > 1:
+            self._start_workers(len(calls) - 1)
+            for index in range(1, len(calls)):
+                self._tasks.put((run, index, done))
+        if calls:
+            run(0)
+        for index in range(1, len(calls)):
+            done.get()
+
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
+
+    def _start_workers(self, count):
+        """ Make sure there are at least count worker threads. """
+        with self._workers_lock:
+            while len(self._workers) < count:
+                worker = threading.Thread(target=self._work, 
+                    name='kafka-cluster')
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            run, index, done = task
+            try:
+                run(index)
+            finally:
+                done.put(index)
@@ -0,0 +1,91 @@
+import struct
+import zlib
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+__all__ = [
+    'COMPRESSION_NONE',
+    'COMPRESSION_GZIP',
+    'COMPRESSION_SNAPPY',
+    'UnsupportedCodec',
+    'compress',
+    'decompress',
+]
+
+# Compression codecs, found in the lowest bits of a message's attributes
+COMPRESSION_NONE   = 0
+COMPRESSION_GZIP   = 1
+COMPRESSION_SNAPPY = 2
+
+COMPRESSION_CODEC_MASK = 0x03
+
+class UnsupportedCodec(ValueError): pass
+
+# The JVM clients wrap snappy data in snappy-java's (xerial) stream format:
+# a header, then <<uint:4 length, snappy block>> chunks.
+XERIAL_HEADER = struct.pack('>8sii', '\x82SNAPPY\x00', 1, 1)
+XERIAL_BLOCK_SIZE = 32 * 1024
+
+def gzip_encode(data):
+    # wbits > 16 writes a gzip header and trailer, like GZIPOutputStream
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+        16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_decode(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+def snappy_encode(data):
+    _check_snappy()
+    blocks = [XERIAL_HEADER]
+    for start in xrange(0, len(data), XERIAL_BLOCK_SIZE):
+        block = snappy.compress(data[start:start + XERIAL_BLOCK_SIZE])
+        blocks.append(struct.pack('>i', len(block)))
+        blocks.append(block)
+    return ''.join(blocks)
+
+def snappy_decode(data):
+    _check_snappy()
+    if not data.startswith(XERIAL_HEADER[:8]):
+        return snappy.decompress(data)
+
+    blocks = []
+    position = len(XERIAL_HEADER)
+    while position < len(data):
+        block_length = struct.unpack_from('>i', data, position)[0]
+        position += 4
+        blocks.append(snappy.decompress(
+            data[position:position + block_length]))
+        position += block_length
+    return ''.join(blocks)
+
+def _check_snappy():
+    if snappy is None:
+        raise UnsupportedCodec('Snappy compression requires python-snappy')
+
+_encoders = {
+    COMPRESSION_GZIP: gzip_encode,
+    COMPRESSION_SNAPPY: snappy_encode,
+}
+
+_decoders = {
+    COMPRESSION_GZIP: gzip_decode,
+    COMPRESSION_SNAPPY: snappy_decode,
+}
+
+def compress(codec, data):
+    try:
+        encode = _encoders[codec]
+    except KeyError:
+        raise UnsupportedCodec('Unknown compression codec: {0}'.format(codec))
+    return encode(data)
+
+def decompress(codec, data):
+    try:
+        decode = _decoders[codec]
+    except KeyError:
+        raise UnsupportedCodec('Unknown compression codec: {0}'.format(codec))
+    return decode(data)
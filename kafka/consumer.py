@@ -0,0 +1,258 @@
+import heapq
+import threading
+import time
+import Queue
+
+from kafka.base import kafka_log, KafkaError, ConnectionFailure, \
+    AdaptiveFetch, LATEST_OFFSET
+
+__all__ = [
+    'TopicConsumer',
+]
+
+class BaseTopicConsumer(object):
+    """ Reads many partitions of a topic at once, each from its own offset.
+
+        Params:
+            kafka:          the client to fetch with
+            topic:          topic to read from
+            partitions:     partition numbers to read, or a dict mapping
+                            partition numbers to the offset to start from
+                            (None for the latest offset)
+            max_size:       initial size of a fetch, in bytes
+            poll_interval:  seconds to wait before fetching again from a
+                            partition that had nothing new, growing while 
+                            it stays idle
+            include_corrupt:
+            checkpoint:     a kafka.checkpoint.Checkpoint to record progress
+                            in. Partitions without an offset resume from it.
+
+        Each partition's fetch size and wait follow its traffic, see 
+        AdaptiveFetch.
+    """
+    DEFAULT_POLL_INTERVAL = 1
+
+    def __init__(self, kafka, topic, partitions, max_size=None,
+            poll_interval=None, include_corrupt=False, checkpoint=None):
+        self._kafka = kafka
+        self.topic = topic
+        self.max_size = max_size
+        self.poll_interval = self.DEFAULT_POLL_INTERVAL \
+            if poll_interval is None else poll_interval
+        self.include_corrupt = include_corrupt
+        self.checkpoint = checkpoint
+
+        if not isinstance(partitions, dict):
+            partitions = dict.fromkeys(partitions)
+        if checkpoint is not None:
+            partitions = dict((partition, checkpoint.offset(topic, partition)
+                if offset is None else offset)
+                for partition, offset in partitions.iteritems())
+        self._partitions = dict(
+            (partition, kafka.partition(topic, partition))
+            for partition in partitions)
+        # partition -> offset of the next fetch
+        self._fetch_offsets = dict(partitions)
+        # partition -> offset right after the last batch handed out
+        self.offsets = dict(partitions)
+        # partition -> AdaptiveFetch
+        self._fetch_policies = dict(
+            (partition, AdaptiveFetch(max_size or kafka.max_size, 
+                poll_interval=self.poll_interval))
+            for partition in partitions)
+        self._closed = False
+
+    def _fetch_size(self, partition):
+        return self._fetch_policies[partition].max_size
+
+    def _fetched(self, partition, offset, batch):
+        """ Record that batch was read from partition at offset, return the
+            delay before fetching from it again. """
+        delay = self._fetch_policies[partition].fetched(offset, batch)
+        self._fetch_offsets[partition] = batch.next_offset
+        return delay
+
+    def _processed(self, partition, batch):
+        """ Record that batch, from partition, has been processed. """
+        if self.checkpoint is not None:
+            self.checkpoint.commit(self.topic, partition, batch.next_offset,
+                len(batch))
+
+
+class TopicConsumer(BaseTopicConsumer):
+    """ Fetches partitions concurrently from a pool of threads and yields
+        their batches, tagged with the partition, in the order they arrive.
+
+        Partitions are fetched one batch at a time, so each partition's
+        batches come out in order. A partition with nothing new waits
+        poll_interval on the side while the workers keep fetching from the
+        others, so idle partitions don't hold back active ones.
+
+        Give the Kafka object a ConnectionPool so the workers each get their
+        own connection, otherwise their requests take turns on a single one.
+
+        Connection errors are logged and the fetch retried after 
+        poll_interval. Other errors (e.g. OffsetOutOfRange) are raised from 
+        next() and the partition they came from is no longer fetched.
+
+        With a checkpoint, a batch counts as processed once the next one is 
+        asked for.
+
+        Params (in addition to BaseTopicConsumer's):
+            workers:        number of fetching threads
+            max_batches:    most batches fetched but not yet consumed
+
+        Example:
+
+            kafka = Kafka(pool=ConnectionPool(max_size=8))
+            consumer = TopicConsumer(kafka, 'good_dogs', range(32), workers=8)
+            for partition, messages in consumer:
+                for offset, message in messages:
+                    ...
+    """
+    DEFAULT_WORKERS = 4
+
+    def __init__(self, kafka, topic, partitions, max_size=None,
+            poll_interval=None, include_corrupt=False, checkpoint=None, 
+            workers=None, max_batches=None):
+        BaseTopicConsumer.__init__(self, kafka, topic, partitions, max_size,
+            poll_interval, include_corrupt, checkpoint)
+        # The last batch handed out, processed once the next one is asked for
+        self._unprocessed = None
+        self.workers = workers or self.DEFAULT_WORKERS
+        # (partition, batch, error)
+        self._batches = Queue.Queue(max_batches or 2 * self.workers)
+
+        self._lock = threading.Condition()
+        # Heap of (when, partition) waiting to be fetched
+        self._schedule = [(0, partition) for partition in self._partitions]
+        heapq.heapify(self._schedule)
+        # Only needed when the workers have to share a connection
+        self._kafka_lock = threading.Lock() \
+            if getattr(kafka, 'pool', None) is None else None
+
+        # Look up the partitions that start from the latest offset in one 
+        # pass rather than one round trip each
+        latest = [partition for partition, offset in 
+                  self._fetch_offsets.iteritems() if offset is None]
+        if latest:
+            results = kafka.multi_offsets([(topic, partition, LATEST_OFFSET, 1)
+                                           for partition in latest])
+            for partition, offsets in zip(latest, results):
+                self._fetch_offsets[partition] = offsets[0]
+
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                name='kafka-consumer-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """ Return the next (partition, MessageSet) fetched, waiting for one
+            if needed. Empty batches are skipped. """
+        if self._unprocessed is not None:
+            self._processed(*self._unprocessed)
+            self._unprocessed = None
+        if self._closed:
+            raise StopIteration()
+        partition, batch, error = self._batches.get()
+        if partition is None:
+            # close() woke us up
+            raise StopIteration()
+        if error is not None:
+            raise error
+        self.offsets[partition] = batch.next_offset
+        self._unprocessed = (partition, batch)
+        return partition, batch
+
+    def close(self):
+        """ Stop fetching. Batches fetched but not consumed are dropped. """
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        self._drop_batches()
+        for thread in self._threads:
+            thread.join()
+        # Workers waiting to queue a batch may have done so since
+        self._drop_batches()
+        # In case another thread is waiting in next(). If the queue is 
+        # full, it can't be.
+        try:
+            self._batches.put_nowait((None, None, None))
+        except Queue.Full:
+            pass
+
+    def _drop_batches(self):
+        while True:
+            try:
+                self._batches.get_nowait()
+            except Queue.Empty:
+                break
+
+    def _next_partition(self):
+        """ Wait until a partition is due for a fetch and take it off the
+            schedule, None once closed. """
+        with self._lock:
+            while not self._closed:
+                if self._schedule:
+                    delay = self._schedule[0][0] - time.time()
+                    if delay <= 0:
+                        return heapq.heappop(self._schedule)[1]
+                    self._lock.wait(delay)
+                else:
+                    self._lock.wait()
+            return None
+
+    def _reschedule(self, partition, delay):
+        with self._lock:
+            heapq.heappush(self._schedule, (time.time() + delay, partition))
+            self._lock.notify()
+
+    def _run(self):
+        while True:
+            partition = self._next_partition()
+            if partition is None:
+                return
+
+            batch, error, delay = None, None, 0
+            try:
+                offset, batch = self._fetch(partition)
+                delay = self._fetched(partition, offset, batch)
+            except (ConnectionFailure, IOError), e:
+                kafka_log.error("Fetch of topic {0}, partition {1} failed, retrying: {2}".format(self.topic, partition, e))
+                delay = self.poll_interval
+            except KafkaError, e:
+                # Out of range offsets, messages too large and the like, the
+                # consumer decides
+                error = e
+
+            if error is not None or batch:
+                # Put it out before the partition's next fetch can, so
+                # batches stay in order. Blocks while max_batches wait.
+                self._put(partition, batch, error)
+            if error is None:
+                self._reschedule(partition, delay)
+
+    def _put(self, partition, batch, error):
+        while not self._closed:
+            try:
+                self._batches.put((partition, batch, error), timeout=1)
+                return
+            except Queue.Full:
+                continue
+
+    def _fetch(self, partition):
+        offset = self._fetch_offsets[partition]
+        if self._kafka_lock is None:
+            return self._fetch_partition(partition, offset)
+        with self._kafka_lock:
+            return self._fetch_partition(partition, offset)
+
+    def _fetch_partition(self, partition, offset):
+        return offset, self._partitions[partition].fetch(offset, 
+            self._fetch_size(partition), self.include_corrupt)
@@ -0,0 +1,338 @@
+import os
+import socket
+import struct
+import threading
+import time
+import SocketServer
+
+from kafka.protocol import kafka_log, PRODUCE_REQUEST, FETCH_REQUEST, \
+    MULTIFETCH_REQUEST, MULTIPRODUCE_REQUEST, OFFSETS_REQUEST, \
+    LATEST_OFFSET
+
+__all__ = [
+    'FakeBroker',
+    'MemoryLog',
+    'FileLog',
+]
+
+# Error codes sent back, see kafka.protocol.error_codes
+NO_ERROR = 0
+OFFSET_OUT_OF_RANGE = 1
+WRONG_PARTITION = 3
+
+_UINT16 = struct.Struct('>H')
+_UINT32 = struct.Struct('>I')
+# offset, max_size
+_FETCH = struct.Struct('>QI')
+# time, max_offsets
+_OFFSETS = struct.Struct('>qI')
+
+class MemoryLog(object):
+    """ A partition's messages, kept in memory. Offsets are byte positions
+        in it, like a real broker's. """
+
+    def __init__(self):
+        self._data = bytearray()
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    def append(self, message_set):
+        self._data.extend(message_set)
+
+    def read(self, offset, max_size):
+        return str(self._data[offset:offset + max_size])
+
+
+class FileLog(object):
+    """ A partition's messages, kept in a file laid out like a Kafka 0.7
+        log segment that starts at offset 0. """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._file = open(path, 'a+b')
+
+    @property
+    def size(self):
+        self._file.seek(0, os.SEEK_END)
+        return self._file.tell()
+
+    def append(self, message_set):
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(message_set)
+        self._file.flush()
+
+    def read(self, offset, max_size):
+        self._file.seek(offset)
+        return self._file.read(max_size)
+
+    def close(self):
+        self._file.close()
+
+
+class FakeBroker(object):
+    """ An in-process stand-in for a Kafka 0.7 broker, for tests and
+        benchmarks that can't count on a real one.
+
+        Answers PRODUCE, FETCH, MULTIFETCH, MULTIPRODUCE and OFFSETS
+        requests from a thread per connection. Messages are appended to the
+        partition's log as they come, fetchable right away, and offsets are
+        byte positions in it as with a real broker. Produced message sets
+        are stored as they are, checksums and all.
+
+        Params (all optional):
+            host, port: where to listen, port 0 picks a free one
+            partitions: how many partitions each topic has, a number for
+                        every topic or a dict mapping topics to numbers.
+                        Requests for other partitions get a
+                        WrongPartitionCode error. Any partition is fine
+                        by default.
+            log_dir:    keep the logs in files in this directory instead of
+                        in memory, as <topic>-<partition>/00000000000000000000.kafka
+            latency:    seconds to wait before answering each request
+            bandwidth:  most bytes per second sent back on each connection
+
+        Example:
+
+            with FakeBroker(latency=0.001) as broker:
+                kafka = Kafka(broker.host, broker.port)
+                kafka.produce('good_dogs', 'woof')
+                broker.log('good_dogs', 0)
+    """
+    SEND_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, host='127.0.0.1', port=0, partitions=None,
+            log_dir=None, latency=0, bandwidth=None):
+        self.host = host
+        self.port = port
+        self.partitions = partitions
+        self.log_dir = log_dir
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        # (topic, partition) -> MemoryLog or FileLog
+        self._logs = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """ Start listening, return the (host, port) listened on. """
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.broker = self
+        self.host, self.port = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever,
+            name='kafka-fake-broker')
+        self._thread.daemon = True
+        self._thread.start()
+        return self.host, self.port
+
+    def stop(self):
+        """ Stop listening and close the connections, the logs are kept. """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.close_connections()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def close(self):
+        """ Stop, and close the log files. """
+        self.stop()
+        for log in self._logs.itervalues():
+            if isinstance(log, FileLog):
+                log.close()
+        self._logs.clear()
+
+    def log(self, topic, partition=0):
+        """ Everything in the log of topic/partition, as a str. """
+        with self._lock:
+            log = self._logs.get((topic, partition))
+            return log.read(0, log.size) if log is not None else ''
+
+    # Requests, sans I/O
+
+    def handle_request(self, request):
+        """ Handle request, a request without its size, and return the body
+            of the response, None for requests that get no response. """
+        request_type = _UINT16.unpack_from(request)[0]
+        position = _UINT16.size
+        if request_type == PRODUCE_REQUEST:
+            self._produce(request, position)
+            return None
+        elif request_type == MULTIPRODUCE_REQUEST:
+            count = _UINT16.unpack_from(request, position)[0]
+            position += _UINT16.size
+            for i in range(count):
+                position = self._produce(request, position)
+            return None
+        elif request_type == FETCH_REQUEST:
+            return self._fetch(request, position)[0]
+        elif request_type == MULTIFETCH_REQUEST:
+            count = _UINT16.unpack_from(request, position)[0]
+            position += _UINT16.size
+            responses = [_UINT16.pack(NO_ERROR)]
+            for i in range(count):
+                response, position = self._fetch(request, position)
+                responses.append(_UINT32.pack(len(response)))
+                responses.append(response)
+            return ''.join(responses)
+        elif request_type == OFFSETS_REQUEST:
+            return self._offsets(request, position)
+        raise ValueError("Unknown request type {0}".format(request_type))
+
+    def _topic_partition(self, request, position):
+        topic_length = _UINT16.unpack_from(request, position)[0]
+        position += _UINT16.size
+        topic = request[position:position + topic_length]
+        position += topic_length
+        partition = _UINT32.unpack_from(request, position)[0]
+        return topic, partition, position + _UINT32.size
+
+    def _has_partition(self, topic, partition):
+        if self.partitions is None:
+            return True
+        if isinstance(self.partitions, dict):
+            return partition < self.partitions.get(topic, 0)
+        return partition < self.partitions
+
+    def _get_log(self, topic, partition):
+        """ The log of topic/partition, created if needed. Call with _lock
+            held. """
+        log = self._logs.get((topic, partition))
+        if log is None:
+            if self.log_dir is None:
+                log = MemoryLog()
+            else:
+                log = FileLog(os.path.join(self.log_dir,
+                    '{0}-{1}'.format(topic, partition),
+                    '00000000000000000000.kafka'))
+            self._logs[(topic, partition)] = log
+        return log
+
+    def _produce(self, request, position):
+        topic, partition, position = self._topic_partition(request, position)
+        length = _UINT32.unpack_from(request, position)[0]
+        position += _UINT32.size
+        if self._has_partition(topic, partition):
+            with self._lock:
+                self._get_log(topic, partition).append(
+                    request[position:position + length])
+        else:
+            kafka_log.warn('Fake broker: dropping messages produced to topic {0}, partition {1}'.format(topic, partition))
+        return position + length
+
+    def _fetch(self, request, position):
+        topic, partition, position = self._topic_partition(request, position)
+        offset, max_size = _FETCH.unpack_from(request, position)
+        position += _FETCH.size
+        if not self._has_partition(topic, partition):
+            return _UINT16.pack(WRONG_PARTITION), position
+        with self._lock:
+            log = self._get_log(topic, partition)
+            if offset > log.size:
+                return _UINT16.pack(OFFSET_OUT_OF_RANGE), position
+            return _UINT16.pack(NO_ERROR) + log.read(offset, max_size), \
+                position
+
+    def _offsets(self, request, position):
+        topic, partition, position = self._topic_partition(request, position)
+        time_val, max_offsets = _OFFSETS.unpack_from(request, position)
+        if not self._has_partition(topic, partition):
+            return _UINT16.pack(WRONG_PARTITION)
+        with self._lock:
+            size = self._get_log(topic, partition).size
+        # A single segment starting at 0, the latest offset comes first
+        if time_val == LATEST_OFFSET and size:
+            offsets = [size, 0]
+        else:
+            offsets = [0]
+        offsets = offsets[:max_offsets]
+        return struct.pack('>HI{0}Q'.format(len(offsets)), NO_ERROR,
+            len(offsets), *offsets)
+
+    # I/O
+
+    def _serve(self, sock):
+        """ Answer the requests that come on sock until it is closed. """
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            header = self._recv(sock, _UINT32.size)
+            if header is None:
+                return
+            request = self._recv(sock, _UINT32.unpack(header)[0])
+            if request is None:
+                return
+            response = self.handle_request(request)
+            if self.latency:
+                time.sleep(self.latency)
+            if response is not None:
+                self._send(sock, _UINT32.pack(len(response)) + response)
+
+    def _recv(self, sock, length):
+        chunks = []
+        while length:
+            chunk = sock.recv(length)
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            length -= len(chunk)
+        return ''.join(chunks)
+
+    def _send(self, sock, data):
+        if not self.bandwidth:
+            return sock.sendall(data)
+        view = memoryview(data)
+        for start in xrange(0, len(data), self.SEND_CHUNK_SIZE):
+            chunk = view[start:start + self.SEND_CHUNK_SIZE]
+            sock.sendall(chunk)
+            time.sleep(len(chunk) / float(self.bandwidth))
+
+
+class _Handler(SocketServer.BaseRequestHandler):
+    def setup(self):
+        self.server.connections.add(self.request)
+
+    def handle(self):
+        try:
+            self.server.broker._serve(self.request)
+        except socket.error:
+            pass
+        except Exception:
+            # A real broker hangs up on requests it can't make sense of
+            kafka_log.exception('Fake broker: bad request, disconnecting')
+
+    def finish(self):
+        self.server.connections.discard(self.request)
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, handler):
+        SocketServer.TCPServer.__init__(self, address, handler)
+        self.connections = set()
+
+    def close_connections(self, timeout=1):
+        """ Hang up on the clients and give the handlers up to timeout 
+            seconds to be done. """
+        for sock in list(self.connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        deadline = time.time() + timeout
+        while self.connections and time.time() < deadline:
+            time.sleep(0.01)
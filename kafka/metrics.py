@@ -0,0 +1,139 @@
+import bisect
+import threading
+
+__all__ = [
+    'Metrics',
+    'MemoryMetrics',
+    'CallbackMetrics',
+    'Histogram',
+]
+
+class Metrics(object):
+    """ Where a client reports what it does. Give one to a client,
+        Kafka(metrics=...), the default is to report nothing at no cost.
+
+        The client reports:
+
+            requests.<type>         counter, requests sent by type (produce,
+                                    multi_produce, fetch, multi_fetch,
+                                    offsets)
+            latency.<type>          timing, seconds from sending a request
+                                    to having its response decoded
+            bytes_sent              counter
+            bytes_received          counter
+            retries                 counter, writes retried after a socket
+                                    error
+            reconnects              counter, connections reopened to retry
+            messages.fetched        counter
+            messages.corrupt        counter, fetched messages with a bad
+                                    checksum or magic byte, or that could
+                                    not be decompressed
+            fetches.truncated       counter, fetches that ended in a
+                                    partial message
+
+        Subclasses implement increment() and timing(). They may be called
+        from any thread the client is used from.
+    """
+    def increment(self, name, value=1):
+        """ Add value to the counter name. """
+        raise NotImplementedError()
+
+    def timing(self, name, seconds):
+        """ Record that something took seconds. """
+        raise NotImplementedError()
+
+
+class Histogram(object):
+    """ Counts values in buckets whose bounds grow by a factor of 2, from
+        smallest up. Percentiles are the upper bound of the bucket they
+        fall in, so they are within a factor of 2 of the real ones. """
+
+    def __init__(self, smallest=0.0001, num_buckets=24):
+        # Upper bounds, values past the last one go in an extra bucket
+        self.bounds = [smallest * 2 ** i for i in range(num_buckets)]
+        self.counts = [0] * (num_buckets + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """ The value percent % of those added are at most, None if there
+            are none. """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class MemoryMetrics(Metrics):
+    """ Keeps the counters and a Histogram per timing in memory.
+
+        Example:
+
+            metrics = MemoryMetrics()
+            kafka = Kafka(metrics=metrics)
+            ...
+            metrics.counters['requests.fetch']
+            metrics.histograms['latency.fetch'].percentile(99)
+    """
+    def __init__(self):
+        # name -> value
+        self.counters = {}
+        # name -> Histogram
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+class CallbackMetrics(Metrics):
+    """ Hands everything to callback(name, value, type), statsd style:
+        counters have type 'c', timings type 'ms' and a value in
+        milliseconds. Names get prefix prepended.
+
+        Example, to a statsd server:
+
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            def send(name, value, type):
+                sock.sendto('{0}:{1}|{2}'.format(name, value, type),
+                    ('localhost', 8125))
+            kafka = Kafka(metrics=CallbackMetrics(send, prefix='kafka.'))
+    """
+    def __init__(self, callback, prefix=''):
+        self.callback = callback
+        self.prefix = prefix
+
+    def increment(self, name, value=1):
+        self.callback(self.prefix + name, value, 'c')
+
+    def timing(self, name, seconds):
+        self.callback(self.prefix + name, seconds * 1000, 'ms')
@@ -1,16 +1,40 @@
 import array
 import socket
+import time
+from collections import deque
+from functools import partial
 
-from kafka.base import BaseKafka, logging, StringIO, ConnectionFailure
+from kafka.base import BaseKafka, logging, kafka_log, StringIO, \
+    KafkaError, ConnectionFailure, Lengths, QueueFull, COMPRESSION_NONE, \
+    LATEST_OFFSET
+from kafka.consumer import BaseTopicConsumer
+from kafka.protocol import Connection, Response, ResponseFailed, \
+    MessagesReceived
+from kafka.producer import BaseAsyncProducer
 socket_log = logging.getLogger('kafka.iostream')
 
+from tornado.ioloop import IOLoop
 from tornado.iostream import IOStream
 
 __all__ = [
-    'Kafka',
+    'KafkaTornado',
+    'AsyncProducerTornado',
+    'TopicConsumerTornado',
 ]
 
 class KafkaTornado(BaseKafka):
+    """ A client for the Tornado IOLoop. Results are handed to callbacks.
+
+        Requests are pipelined on a single connection, up to max_in_flight 
+        of them waiting for a response. An error response only fails its 
+        own request: fetch(), multi_fetch(), offsets(), multi_offsets() and
+        fetch_stream() take an errback, called with the KafkaError instead 
+        of the callback, or with a ConnectionFailure if the connection is 
+        lost before the response came. Errors without an errback are 
+        logged, lost connections raised from the IOLoop. Callbacks and 
+        errbacks are run from the IOLoop too, each on its own: an exception
+        in one is not an error of the request.
+    """
     def __init__(self, *args, **kwargs):
         if 'io_loop' in kwargs:
             self._io_loop = kwargs['io_loop']
@@ -20,6 +44,80 @@ class KafkaTornado(BaseKafka):
         BaseKafka.__init__(self, *args, **kwargs)
         
         self._stream = None
+        # kafka.protocol.Connection, matches the responses to the requests
+        # written on the stream. Kafka answers in order.
+        self._connection = None
+        # (request, decode, token) waiting for one of the max_in_flight 
+        # slots
+        self._waiting = deque()
+        # The callback and errback of the request being made, for 
+        # _request()
+        self._callback = None
+        self._errback = None
+
+    def fetch(self, topic, offset, partition=None, max_size=None, 
+            callback=None, include_corrupt=False, errback=None):
+        """ See BaseKafka.fetch(). """
+        return self._with_callbacks(callback, errback, BaseKafka.fetch, 
+            topic, offset, partition, max_size, None, include_corrupt)
+
+    def multi_fetch(self, fetches, callback=None, include_corrupt=False, 
+            errback=None):
+        """ See BaseKafka.multi_fetch(). """
+        return self._with_callbacks(callback, errback, 
+            BaseKafka.multi_fetch, fetches, None, include_corrupt)
+
+    def offsets(self, topic, time_val, max_offsets, partition=None, 
+            callback=None, errback=None):
+        """ See BaseKafka.offsets(). """
+        return self._with_callbacks(callback, errback, BaseKafka.offsets, 
+            topic, time_val, max_offsets, partition, None)
+
+    def fetch_stream(self, topic, offset, partition=None, max_size=None, 
+            callback=None, include_corrupt=False, errback=None):
+        """ Fetch like fetch(), but hand the messages to callback as they 
+            come in: callback(messages, done) is called with a MessageSet 
+            each time more messages are in, and a last time with done set 
+            once the response is over. The next_offset and truncated of 
+            that last MessageSet are those of the whole fetch. """
+        if callback is None:
+            raise ValueError("fetch_stream() needs a callback")
+        if not self._stream:
+            self._connect()
+        if self._connection.pending >= self.max_in_flight:
+            self._waiting.append((None, (topic, offset, partition, max_size, 
+                include_corrupt), (callback, errback, True)))
+            return
+        if self.metrics is not None:
+            self.metrics.increment('requests.fetch')
+        return self._write(lambda connection: connection.fetch_stream(
+            topic.encode('utf-8'), offset, partition or 0, 
+            max_size or self.max_size, include_corrupt, 
+            token=(callback, errback, True)))
+
+    def multi_offsets(self, requests, callback=None, errback=None):
+        """ Look up offsets for several topics/partitions at once. The 
+            OFFSETS requests are pipelined, callback gets a list of offset 
+            lists in the same order as requests. errback gets the first 
+            error, if any. """
+        results = [None] * len(requests)
+        remaining = [len(requests)]
+        def got_offsets(index, offsets):
+            results[index] = offsets
+            remaining[0] -= 1
+            if not remaining[0] and callback:
+                callback(results)
+        def failed(error):
+            if remaining[0] > 0:
+                remaining[0] = -1
+                self._failed(errback, error)
+
+        if not requests and callback:
+            return callback(results)
+        for index, (topic, partition, time_val, max_offsets) in \
+                enumerate(requests):
+            self.offsets(topic, time_val, max_offsets, partition, 
+                partial(got_offsets, index), failed)
 
     # Socket management methods
 
@@ -33,46 +131,344 @@ class KafkaTornado(BaseKafka):
         except Exception, e:
             raise ConnectionFailure("Could not connect to kafka at {0}:{1}".format(self.host, self.port))
         else:
-            self._stream = IOStream(sock, io_loop=self._io_loop)
+            stream = IOStream(sock, io_loop=self._io_loop)
+            self._stream = stream
+            # Responses can only be matched to the requests written on the 
+            # same stream
+            self._connection = Connection(self.codec)
+            stream.set_close_callback(partial(self._stream_closed, stream))
+            # Everything the server sends goes to the Connection as it 
+            # comes in
+            stream.read_until_close(lambda data: None, 
+                partial(self._data_received, stream))
 
     def _disconnect(self):
         """ Disconnect from the remote server & close the socket. """
+        stream = self._stream
+        self._drop_connection()
+        if stream is not None:
+            stream.close()
+
+    def _drop_connection(self, keep_waiting=False, keep_last=False):
+        """ Forget the stream and fail the requests written on it with 
+            ConnectionFailure, along with those waiting to be unless 
+            keep_waiting: they are sent on the next connection instead. 
+            With keep_last, the last request written is left out as well, 
+            it is about to be written again. Return how many of the failed
+            requests had no errback. """
+        error = ConnectionFailure("Connection to kafka at {0}:{1} lost".format(self.host, self.port))
+        errbacks = []
+        if self._connection is not None:
+            errbacks = [event.token[1] for event in 
+                        self._connection.connection_lost(error)]
+            if keep_last:
+                errbacks.pop()
+        if not keep_waiting:
+            errbacks.extend(token[1] 
+                            for request, decode, token in self._waiting)
+            self._waiting.clear()
+        self._stream = None
+        self._connection = None
+
+        lost = 0
+        for errback in errbacks:
+            if errback is None:
+                lost += 1
+            else:
+                self._run_callback(errback, error)
+        return lost
+
+    def _stream_closed(self, stream):
+        if stream is not self._stream:
+            # Closed by us, and already dropped
+            return
+        lost = self._drop_connection()
+        if lost:
+            raise ConnectionFailure("Connection to kafka at {0}:{1} lost, {2} requests went unanswered".format(self.host, self.port, lost))
+
+    # Request pipelining
+
+    def _with_callbacks(self, callback, errback, method, *args):
+        """ Call method(self, *args), whose request goes to _request(). Its
+            result goes to callback, its error to errback. """
+        self._callback = callback
+        self._errback = errback
         try:
-            self._stream.close()
-        except IOError:
-            pass
+            return method(self, *args)
         finally:
-            self._stream = None
-
-    def _read(self, length, callback=None):
-        """ Send a read request to the remote Kafka server. """
+            self._callback = None
+            self._errback = None
+    
+    def _request(self, request, decode):
+        """ Send `request` as soon as there is an in-flight slot for it. 
+            Responses are matched to the requests in the order they were 
+            written. """
+        return self._send(request, decode, (self._callback, self._errback, 
+            False))
 
-        if callback is None:
-            callback = lambda v: v
-        
+    def _send(self, request, decode, token):
         if not self._stream:
             self._connect()
-        
-        return self._stream.read_bytes(length, callback)
+        if self._connection.pending >= self.max_in_flight:
+            self._waiting.append((request, decode, token))
+            return
+
+        # The Connection only decodes the response. What comes out of it 
+        # goes to the request's token, its (callback, errback, streamed).
+        return self._write(lambda connection: connection.request(request, 
+            decode, token))
+
+    def _send_waiting(self):
+        request, decode, token = self._waiting.popleft()
+        if request is None:
+            # A streamed fetch
+            topic, offset, partition, max_size, include_corrupt = decode
+            callback, errback, streamed = token
+            self.fetch_stream(topic, offset, partition, max_size, callback,
+                include_corrupt, errback)
+        else:
+            self._send(request, decode, token)
+
+    def _fill_slots(self):
+        """ Send waiting requests while there are in-flight slots. """
+        while self._waiting and self._connection is not None and \
+              self._connection.pending < self.max_in_flight:
+            self._send_waiting()
+
+    def _run_callback(self, callback, *args):
+        """ Call callback(*args) from the IOLoop. Whatever it raises is 
+            the IOLoop's to report, and leaves the stream and the other 
+            requests alone. """
+        io_loop = self._io_loop or IOLoop.instance()
+        io_loop.add_callback(partial(callback, *args))
+
+    def _failed(self, errback, error):
+        if errback is not None:
+            self._run_callback(errback, error)
+        else:
+            socket_log.error("Request to kafka at {0}:{1} failed: {2!r}".format(self.host, self.port, error))
+
+    def _data_received(self, stream, data):
+        if stream is not self._stream:
+            return
+        if self.metrics is not None:
+            self.metrics.increment('bytes_received', len(data))
+        events = self._connection.receive_data(data)
+
+        # Free the slots and keep the pipeline moving before handing the 
+        # responses over
+        self._fill_slots()
+
+        # An error response fails its own request only, the connection is 
+        # fine
+        for event in events:
+            callback, errback, streamed = event.token
+            if isinstance(event, ResponseFailed):
+                self._failed(errback, event.error)
+            elif isinstance(event, MessagesReceived):
+                self._run_callback(callback, event.messages, False)
+            elif callback is None:
+                continue
+            elif streamed:
+                self._run_callback(callback, event.result, True)
+            else:
+                self._run_callback(callback, event.result)
 
     def _write(self, data, callback=None, retries=BaseKafka.MAX_RETRY):
-        """ Write `data` to the remote Kafka server. """
+        """ Write `data` to the remote Kafka server. Requests that expect 
+            a response pass a function that takes the Connection and 
+            returns the request instead, so that the response is expected 
+            on whichever connection the request ends up written to. """
 
         if callback is None:
             callback = lambda: None
 
         if not self._stream:
             self._connect()
+
+        request = data(self._connection) if callable(data) else data
+        # A request made of several buffers still goes out as one write, 
+        # so IOStream gets a single chunk to flush.
+        if not isinstance(request, str):
+            request = ''.join(request)
         
         try:
-            return self._stream.write(data, callback)
+            result = self._stream.write(request, callback)
         except IOError:
             if retries > 0:
-                self._stream = None
+                # The requests that were waiting for a slot were never 
+                # written, they go out on the new connection along with 
+                # this one
+                lost = self._drop_connection(keep_waiting=True, 
+                    keep_last=callable(data))
+                if lost:
+                    socket_log.warn('Connection lost, {0} requests went unanswered'.format(lost))
                 retries_left = retries - 1
                 socket_log.warn('Write failure, retrying ({0} retries left)'.format(retries_left))
-                return self._write(data, callback, retries_left)
+                if self.metrics is not None:
+                    self.metrics.increment('retries')
+                    self.metrics.increment('reconnects')
+                result = self._write(data, callback, retries_left)
+                self._fill_slots()
+                return result
             else:
                 raise
-            
-            
+        if self.metrics is not None:
+            self.metrics.increment('bytes_sent', len(request))
+        return result
+
+
+class AsyncProducerTornado(BaseAsyncProducer):
+    """ Batches messages and sends them from IOLoop callbacks.
+
+        Works like kafka.producer.AsyncProducer, but since nothing may 
+        block the IOLoop, send() raises QueueFull right away when 
+        max_queue_bytes are already queued.
+    """
+    def __init__(self, kafka, batch_size=None, batch_messages=None, 
+            linger_ms=None, max_queue_bytes=None, 
+            compression=COMPRESSION_NONE, io_loop=None, partitioner=None):
+        BaseAsyncProducer.__init__(self, kafka, batch_size, batch_messages, 
+            linger_ms, max_queue_bytes, compression, partitioner)
+        self._io_loop = io_loop or kafka._io_loop or IOLoop.instance()
+        self._linger_timeout = None
+
+    def send(self, topic, messages, partition=None, key=None):
+        """ Queue messages for topic/partition, or the partition the
+            partitioner picks for key. """
+        messages = self._kafka._clean_messages(messages)
+        size = self._message_bytes(messages)
+        if self.queued_bytes and \
+           self.queued_bytes + size > self.max_queue_bytes:
+            raise QueueFull('{0} bytes already queued'.format(self.queued_bytes))
+
+        if self._enqueue(topic, messages, partition, size, key):
+            self._io_loop.add_callback(self.flush)
+        elif self._linger_timeout is None:
+            self._linger_timeout = self._io_loop.add_timeout(
+                time.time() + self.linger_ms / 1000.0, self.flush)
+
+    def flush(self, callback=None):
+        """ Send everything queued so far. """
+        if self._linger_timeout is not None:
+            self._io_loop.remove_timeout(self._linger_timeout)
+            self._linger_timeout = None
+
+        batches = self._drain()
+        if batches:
+            return self._kafka.multi_produce(batches, callback, 
+                self.compression)
+        elif callback:
+            return callback()
+
+    def close(self, callback=None):
+        """ Send everything still queued, no more messages are accepted. """
+        self._closed = True
+        return self.flush(callback)
+
+
+class TopicConsumerTornado(BaseTopicConsumer):
+    """ Reads many partitions of a topic from the IOLoop.
+
+        Every partition has a fetch outstanding at all times, KafkaTornado 
+        pipelines them on its connection. Each batch is handed to the 
+        callback given to start() as callback(partition, messages), and the
+        partition's next fetch goes out right away. A partition with nothing
+        new is fetched again after poll_interval (and less and less often 
+        while it stays idle).
+
+        Connection errors are logged and the fetch retried after 
+        poll_interval, on a new connection. Other errors (e.g. 
+        OffsetOutOfRange) go to the errback given to start() as 
+        errback(partition, error), and the partition they came from is no 
+        longer fetched.
+
+        With a checkpoint, a batch counts as processed once the callback 
+        returns.
+    """
+    def __init__(self, kafka, topic, partitions, max_size=None, 
+            poll_interval=None, include_corrupt=False, checkpoint=None, 
+            io_loop=None):
+        BaseTopicConsumer.__init__(self, kafka, topic, partitions, max_size,
+            poll_interval, include_corrupt, checkpoint)
+        self._io_loop = io_loop or kafka._io_loop or IOLoop.instance()
+        self._callback = None
+        self._errback = None
+        # partition -> pending poll_interval timeout
+        self._timeouts = {}
+
+    def start(self, callback, errback=None):
+        """ Start fetching every partition. Without an errback, errors are
+            logged. """
+        self._callback = callback
+        self._errback = errback
+        for partition in self._partitions:
+            self._fetch(partition)
+
+    def close(self):
+        """ Stop fetching, responses still on their way are dropped. """
+        self._closed = True
+        for timeout in self._timeouts.values():
+            self._io_loop.remove_timeout(timeout)
+        self._timeouts.clear()
+
+    def _fetch(self, partition):
+        self._timeouts.pop(partition, None)
+        if self._closed:
+            return
+
+        offset = self._fetch_offsets[partition]
+        errback = partial(self._fetch_failed, partition)
+        try:
+            if offset is None:
+                return self._kafka.offsets(self.topic, LATEST_OFFSET, 
+                    max_offsets=1, partition=partition, 
+                    callback=partial(self._got_latest_offset, partition),
+                    errback=errback)
+            return self._kafka.fetch(self.topic, offset, partition=partition,
+                max_size=self._fetch_size(partition), 
+                include_corrupt=self.include_corrupt, 
+                callback=partial(self._got_batch, partition, offset),
+                errback=errback)
+        except (ConnectionFailure, IOError), e:
+            # Couldn't (re)connect
+            self._fetch_failed(partition, e)
+
+    def _fetch_failed(self, partition, error):
+        if self._closed:
+            return
+        if isinstance(error, (ConnectionFailure, IOError)):
+            # The next fetch reconnects
+            kafka_log.error("Fetch of topic {0}, partition {1} failed, retrying: {2}".format(self.topic, partition, error))
+            self._timeouts[partition] = self._io_loop.add_timeout(
+                time.time() + self.poll_interval, 
+                partial(self._fetch, partition))
+        elif self._errback is not None:
+            # Out of range offsets, messages too large and the like, the 
+            # consumer decides
+            self._errback(partition, error)
+        else:
+            kafka_log.error("Fetch of topic {0}, partition {1} failed: {2!r}".format(self.topic, partition, error))
+
+    def _got_latest_offset(self, partition, offsets):
+        self._fetch_offsets[partition] = offsets[0]
+        self._fetch(partition)
+
+    def _got_batch(self, partition, offset, batch):
+        if self._closed:
+            return
+        try:
+            delay = self._fetched(partition, offset, batch)
+        except KafkaError, e:
+            # MessageTooLarge
+            return self._fetch_failed(partition, e)
+        if delay:
+            self._timeouts[partition] = self._io_loop.add_timeout(
+                time.time() + delay, partial(self._fetch, partition))
+        else:
+            self._fetch(partition)
+
+        if batch:
+            self.offsets[partition] = batch.next_offset
+            self._callback(partition, batch)
+            self._processed(partition, batch)
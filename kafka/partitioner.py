@@ -0,0 +1,123 @@
+import random
+import threading
+import zlib
+
+__all__ = [
+    'Partitioner',
+    'HashPartitioner',
+    'RoundRobinPartitioner',
+    'LeastLoadedPartitioner',
+]
+
+class Partitioner(object):
+    """ Picks the partition of messages produced without one.
+
+        Give one to a client, Kafka(partitioner=...), and produce() and the
+        batching producers use it whenever no partition is given. Without
+        one, everything goes to partition 0.
+
+        Params:
+            partitions: how many partitions each topic has, a number for
+                        every topic or a dict mapping topics to numbers
+
+        Subclasses implement partition(). Batching producers also tell
+        them when messages are queued and sent, so they can follow what is
+        waiting for each partition.
+    """
+    def __init__(self, partitions):
+        self.partitions = partitions
+
+    def partition(self, topic, key, messages):
+        """ The partition to send messages, a list, to. key is whatever
+            was given to produce()/send() as the key, None by default. """
+        raise NotImplementedError()
+
+    def queued(self, topic, partition, size):
+        """ size bytes were queued for topic/partition. """
+        pass
+
+    def sent(self, topic, partition, size):
+        """ size bytes queued for topic/partition were sent. """
+        pass
+
+    def _num_partitions(self, topic):
+        if isinstance(self.partitions, dict):
+            try:
+                return self.partitions[topic]
+            except KeyError:
+                raise ValueError("Number of partitions of topic {0} unknown".format(topic))
+        return self.partitions
+
+
+class HashPartitioner(Partitioner):
+    """ Sends messages with the same key to the same partition, picked
+        from a CRC32 of the key so every process agrees on it. Messages
+        without a key go to a random partition. """
+
+    def partition(self, topic, key, messages):
+        num_partitions = self._num_partitions(topic)
+        if key is None:
+            return random.randrange(num_partitions)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return (zlib.crc32(str(key)) & 0x7fffffff) % num_partitions
+
+
+class RoundRobinPartitioner(Partitioner):
+    """ Sends each topic's batches to its partitions in turn. """
+
+    def __init__(self, partitions):
+        Partitioner.__init__(self, partitions)
+        # topic -> the partition to send to next
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def partition(self, topic, key, messages):
+        num_partitions = self._num_partitions(topic)
+        with self._lock:
+            partition = self._next.get(topic, 0) % num_partitions
+            self._next[topic] = partition + 1
+        return partition
+
+
+class LeastLoadedPartitioner(Partitioner):
+    """ Sends messages to the partition of the topic with the fewest bytes
+        queued in batching producers, taking turns between those tied (so
+        produce(), which queues nothing, goes round-robin). Partitions that
+        fall behind, e.g. because their broker is slow, get fewer new
+        messages. """
+
+    def __init__(self, partitions):
+        Partitioner.__init__(self, partitions)
+        # (topic, partition) -> bytes queued
+        self._pending = {}
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def partition(self, topic, key, messages):
+        num_partitions = self._num_partitions(topic)
+        with self._lock:
+            start = self._next.get(topic, 0)
+            self._next[topic] = start + 1
+            candidates = [(start + i) % num_partitions
+                          for i in range(num_partitions)]
+            return min(candidates, key=lambda partition:
+                self._pending.get((topic, partition), 0))
+
+    def pending(self, topic, partition):
+        """ Bytes queued for topic/partition. """
+        return self._pending.get((topic, partition), 0)
+
+    def queued(self, topic, partition, size):
+        with self._lock:
+            key = (topic, partition)
+            self._pending[key] = self._pending.get(key, 0) + size
+
+    def sent(self, topic, partition, size):
+        with self._lock:
+            key = (topic, partition)
+            pending = self._pending.get(key, 0) - size
+            if pending > 0:
+                self._pending[key] = pending
+            else:
+                self._pending.pop(key, None)
@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from kafka.base import logging, PoolExhausted
+from kafka.blocking import Connection
+pool_log = logging.getLogger('kafka.pool')
+
+__all__ = [
+    'ConnectionPool',
+]
+
+class ConnectionPool(object):
+    """ A thread-safe pool of blocking connections, keyed by (host, port).
+
+        Pass one to Kafka(pool=...) and every request will borrow a
+        connection for as long as it needs it, so a single Kafka object
+        can serve many threads with up to max_size concurrent requests
+        per broker:
+
+            pool = ConnectionPool(max_size=8)
+            kafka = Kafka(host='localhost', pool=pool)
+
+        Params (all optional):
+            min_size:       connections per broker kept open even when idle
+            max_size:       most connections open at once per broker
+            idle_timeout:   seconds after which an unused connection is
+                            closed (down to min_size)
+            checkout_timeout: seconds to wait for a free connection when
+                            max_size are in use before raising
+                            PoolExhausted. None waits forever.
+            health_check:   check idle connections are still usable before
+                            handing them out
+    """
+    def __init__(self, min_size=0, max_size=10, idle_timeout=300,
+            checkout_timeout=None, health_check=True):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check = health_check
+
+        self._lock = threading.Condition()
+        # (host, port) -> deque of idle connections, most recently used last
+        self._idle = {}
+        # (host, port) -> number of open connections, idle or checked out
+        self._size = {}
+
+    def checkout(self, host, port):
+        """ Borrow a connection to host:port. Give it back with checkin(). """
+        key = (host, port)
+        deadline = None
+        if self.checkout_timeout is not None:
+            deadline = time.time() + self.checkout_timeout
+
+        with self._lock:
+            while True:
+                self._evict_idle()
+
+                idle = self._idle.setdefault(key, deque())
+                while idle:
+                    connection = idle.pop()
+                    if not self.health_check or connection.is_alive():
+                        return connection
+                    pool_log.info('Dropping dead connection to {0}:{1}'.format(host, port))
+                    self._close(key, connection)
+
+                if self._size.get(key, 0) < self.max_size:
+                    # Reserve a slot, we connect outside of the lock
+                    self._size[key] = self._size.get(key, 0) + 1
+                    break
+
+                if deadline is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolExhausted("No connection to kafka at {0}:{1} available after {2}s".format(host, port, self.checkout_timeout))
+                    self._lock.wait(remaining)
+
+        connection = Connection(host, port)
+        try:
+            connection.connect()
+        except:
+            with self._lock:
+                self._size[key] -= 1
+                self._lock.notify()
+            raise
+        return connection
+
+    def checkin(self, connection, discard=False):
+        """ Give back a borrowed connection. Discard it if it is in an
+            unknown state, e.g. after an error halfway through a request. """
+        key = (connection.host, connection.port)
+        with self._lock:
+            if discard or not connection.connected:
+                self._close(key, connection)
+            else:
+                connection.last_used = time.time()
+                self._idle.setdefault(key, deque()).append(connection)
+            self._evict_idle()
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self, host, port):
+        """ Borrow a connection for the duration of a with block. """
+        connection = self.checkout(host, port)
+        try:
+            yield connection
+        except:
+            self.checkin(connection, discard=True)
+            raise
+        else:
+            self.checkin(connection)
+
+    def close(self):
+        """ Close all the idle connections. """
+        with self._lock:
+            for key, idle in self._idle.items():
+                while idle:
+                    self._close(key, idle.pop())
+
+    def size(self, host, port):
+        """ Number of open connections to host:port. """
+        with self._lock:
+            return self._size.get((host, port), 0)
+
+    # Must be called with the lock held
+
+    def _evict_idle(self):
+        """ Close the connections idle for longer than idle_timeout, to 
+            any broker. """
+        if self.idle_timeout is None:
+            return
+        expired = time.time() - self.idle_timeout
+        evicted = False
+        for key, idle in self._idle.iteritems():
+            # The least recently used connections are at the left
+            while idle and idle[0].last_used < expired and \
+                  self._size[key] > self.min_size:
+                self._close(key, idle.popleft())
+                evicted = True
+        if evicted:
+            # Threads waiting for a connection to those brokers may open one
+            self._lock.notify_all()
+
+    def _close(self, key, connection):
+        connection.close()
+        self._size[key] -= 1
@@ -0,0 +1,207 @@
+import threading
+import time
+
+from kafka.base import kafka_log, KafkaError, QueueFull, Lengths, \
+    COMPRESSION_NONE
+
+__all__ = [
+    'AsyncProducer',
+]
+
+class BaseAsyncProducer(object):
+    """ Queues messages per (topic, partition) so they can be sent in
+        batches, with a single MULTIPRODUCE request per flush. Subclasses
+        decide when and where flushes happen.
+
+        Params (all optional):
+            batch_size:     flush once a partition has this many bytes queued
+            batch_messages: flush once a partition has this many messages
+                            queued
+            linger_ms:      flush messages once they have waited this long,
+                            even if no batch is full
+            max_queue_bytes: most bytes queued at any time, past that
+                            send() blocks or raises QueueFull
+            compression:    codec to compress each batch with
+            partitioner:    picks the partition of messages sent without
+                            one (default: the client's), see 
+                            kafka.partitioner
+    """
+    DEFAULT_BATCH_SIZE = 64 * 1024
+    DEFAULT_BATCH_MESSAGES = 1000
+    DEFAULT_LINGER_MS = 10
+    DEFAULT_MAX_QUEUE_BYTES = 32 * 1024 * 1024
+
+    def __init__(self, kafka, batch_size=None, batch_messages=None,
+            linger_ms=None, max_queue_bytes=None,
+            compression=COMPRESSION_NONE, partitioner=None):
+        self._kafka = kafka
+        self.compression = compression
+        self.partitioner = partitioner or getattr(kafka, 'partitioner', None)
+        self.batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        self.batch_messages = batch_messages or self.DEFAULT_BATCH_MESSAGES
+        self.linger_ms = self.DEFAULT_LINGER_MS if linger_ms is None \
+            else linger_ms
+        self.max_queue_bytes = max_queue_bytes or self.DEFAULT_MAX_QUEUE_BYTES
+
+        # (topic, partition) -> [messages], [bytes]
+        self._batches = {}
+        self._batch_bytes = {}
+        self.queued_bytes = 0
+        # When the oldest message still queued was queued
+        self._first_queued = None
+        self._closed = False
+
+    def _message_bytes(self, messages):
+        return sum(len(message) for message in messages) + \
+            Lengths.MESSAGE_HEADER * len(messages)
+
+    def _enqueue(self, topic, messages, partition, size, key=None):
+        """ Queue messages, return whether their batch is now full. key is
+            for the partitioner, when partition is None. """
+        if self._closed:
+            raise KafkaError('Producer is closed')
+
+        if self.partitioner is not None:
+            if partition is None:
+                partition = self.partitioner.partition(topic, key, messages)
+            self.partitioner.queued(topic, partition or 0, size)
+        batch_key = (topic, partition or 0)
+        batch = self._batches.setdefault(batch_key, [])
+        batch.extend(messages)
+        self._batch_bytes[batch_key] = \
+            self._batch_bytes.get(batch_key, 0) + size
+        self.queued_bytes += size
+        if self._first_queued is None:
+            self._first_queued = time.time()
+
+        return self._batch_bytes[batch_key] >= self.batch_size or \
+            len(batch) >= self.batch_messages
+
+    def _batch_full(self):
+        for key, batch in self._batches.iteritems():
+            if self._batch_bytes[key] >= self.batch_size or \
+               len(batch) >= self.batch_messages:
+                return True
+        return False
+
+    def _linger_remaining(self):
+        """ Seconds until the oldest queued message must go out, None if
+            nothing is queued. """
+        if self._first_queued is None:
+            return None
+        return max(0, self._first_queued + self.linger_ms / 1000.0 -
+            time.time())
+
+    def _drain(self):
+        """ Take everything queued, to be sent with multi_produce(). """
+        batches = self._batches
+        if self.partitioner is not None:
+            for (topic, partition), size in self._batch_bytes.iteritems():
+                self.partitioner.sent(topic, partition, size)
+        self._batches = {}
+        self._batch_bytes = {}
+        self.queued_bytes = 0
+        self._first_queued = None
+        return batches
+
+
+class AsyncProducer(BaseAsyncProducer):
+    """ Batches messages and sends them from a background thread.
+
+        send() only queues messages, a background thread sends whatever is
+        queued (all partitions in one request) as soon as a batch is full
+        or linger_ms have elapsed. When max_queue_bytes are already queued,
+        send() waits up to block_timeout seconds for room (forever if
+        None), then raises QueueFull.
+
+        Errors while sending in the background are logged and the failed
+        messages dropped; call flush() to send synchronously and see them.
+        The Kafka object is only used by one thread at a time.
+
+        Example:
+
+            producer = AsyncProducer(Kafka(), linger_ms=50)
+            for event in events:
+                producer.send('good_dogs', event)
+            producer.close()
+    """
+    def __init__(self, kafka, batch_size=None, batch_messages=None,
+            linger_ms=None, max_queue_bytes=None,
+            compression=COMPRESSION_NONE, block_timeout=None, 
+            partitioner=None):
+        BaseAsyncProducer.__init__(self, kafka, batch_size, batch_messages,
+            linger_ms, max_queue_bytes, compression, partitioner)
+        self.block_timeout = block_timeout
+
+        self._lock = threading.Condition()
+        # Held while draining and sending, so batches go out in order
+        self._send_lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run,
+            name='kafka-async-producer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, topic, messages, partition=None, key=None):
+        """ Queue messages for topic/partition, or the partition the
+            partitioner picks for key. """
+        messages = self._kafka._clean_messages(messages)
+        size = self._message_bytes(messages)
+
+        with self._lock:
+            deadline = None
+            if self.block_timeout is not None:
+                deadline = time.time() + self.block_timeout
+            while self.queued_bytes and \
+                  self.queued_bytes + size > self.max_queue_bytes:
+                if deadline is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise QueueFull('{0} bytes already queued'.format(self.queued_bytes))
+                    self._lock.wait(remaining)
+
+            first = self._first_queued is None
+            full = self._enqueue(topic, messages, partition, size, key)
+            if full or first:
+                # Send right away, or start the linger clock
+                self._lock.notify_all()
+
+    def flush(self):
+        """ Send everything queued so far, from the calling thread. """
+        self._send(raise_errors=True)
+
+    def close(self):
+        """ Send everything still queued and stop the background thread. """
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._closed and not self._batch_full() and \
+                      self._linger_remaining() != 0:
+                    self._lock.wait(self._linger_remaining())
+                if self._closed and not self._batches:
+                    return
+            self._send()
+
+    def _send(self, raise_errors=False):
+        with self._send_lock:
+            with self._lock:
+                batches = self._drain()
+                # There is room in the queue again
+                self._lock.notify_all()
+
+            if not batches:
+                return
+            try:
+                self._kafka.multi_produce(batches,
+                    compression=self.compression)
+            except Exception, e:
+                if raise_errors:
+                    raise
+                kafka_log.exception('Failed to send {0} batches, dropping them'.format(len(batches)))
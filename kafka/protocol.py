@@ -0,0 +1,1033 @@
+""" The Kafka 0.7 wire protocol, without any I/O.
+
+    Codec turns requests into bytes and responses back into Python objects.
+    Connection keeps track of the requests sent on a connection and turns
+    the bytes that come back into events, one per response. Transports
+    (kafka.blocking, kafka.nonblocking, kafka.aio) only move the bytes.
+"""
+import binascii
+import copy
+import logging
+import struct
+import sys
+from array import array
+from collections import deque, namedtuple
+from itertools import izip
+
+from kafka.compression import COMPRESSION_NONE, COMPRESSION_CODEC_MASK, \
+    compress, decompress
+
+__all__ = [
+    'KafkaError',
+    'OffsetOutOfRange',
+    'InvalidMessageCode',
+    'WrongPartitionCode',
+    'InvalidRetchSizeCode',
+    'UnknownError',
+    'MultiFetchError',
+    'PRODUCE_REQUEST',
+    'FETCH_REQUEST',
+    'MULTIFETCH_REQUEST',
+    'MULTIPRODUCE_REQUEST',
+    'OFFSETS_REQUEST',
+    'LATEST_OFFSET',
+    'EARLIEST_OFFSET',
+    'Lengths',
+    'MessageSet',
+    'LazyMessageSet',
+    'Message',
+    'Codec',
+    'MessageSetStream',
+    'Connection',
+    'Response',
+    'ResponseFailed',
+    'MessagesReceived',
+]
+
+class KafkaError(Exception): pass
+class OffsetOutOfRange(KafkaError): pass
+class InvalidMessageCode(KafkaError): pass
+class WrongPartitionCode(KafkaError): pass
+class InvalidRetchSizeCode(KafkaError): pass
+class UnknownError(KafkaError): pass
+
+class MultiFetchError(KafkaError):
+    """ Some of the fetches of a MULTIFETCH failed. The others are still 
+        in results, one entry per fetch in the same order, with the error 
+        in place of the MessageSet for those that failed. errors maps the 
+        index of each of those to its error. """
+    def __init__(self, results, errors):
+        first = errors[min(errors)]
+        KafkaError.__init__(self, '{0} of {1} fetches failed, first: {2}: {3}'
+            .format(len(errors), len(results), type(first).__name__, first))
+        self.results = results
+        self.errors = errors
+
+error_codes = {
+    1: OffsetOutOfRange,
+    2: InvalidMessageCode,
+    3: WrongPartitionCode,
+    4: InvalidRetchSizeCode,
+}
+
+PRODUCE_REQUEST      = 0
+FETCH_REQUEST        = 1
+MULTIFETCH_REQUEST   = 2
+MULTIPRODUCE_REQUEST = 3
+OFFSETS_REQUEST      = 4
+
+MAGIC_BYTE = 0
+# Messages with this magic byte have an attributes byte after it, which
+# holds the compression codec
+MAGIC_BYTE_COMPRESSION = 1
+
+LATEST_OFFSET   = -1
+EARLIEST_OFFSET = -2
+
+kafka_log  = logging.getLogger('kafka')
+
+# Precompiled formats for the parts of requests and responses
+_UINT32 = struct.Struct('>I')
+_TOPIC_LENGTH = struct.Struct('>H')
+_ERROR_CODE = struct.Struct('>H')
+# <<uint:4 request size, uint:2 request type>>
+_REQUEST_HEADER = struct.Struct('>IH')
+# <<uint:4 request size, uint:2 request type, uint:2 topic/partition count>>
+_MULTI_REQUEST_HEADER = struct.Struct('>IHH')
+# <<uint:4 length, int:1 magic, int:4 checksum>>
+_MESSAGE_HEADER = struct.Struct('>iBi')
+# Read in parts, since the magic byte tells what follows it
+_MESSAGE_START = struct.Struct('>IB')
+_CHECKSUM = struct.Struct('>i')
+# <<int:1 attributes, int:4 checksum>>
+_COMPRESSED_MESSAGE_REST = struct.Struct('>Bi')
+# <<uint:4 length, int:1 magic, int:1 attributes, int:4 checksum>>
+_COMPRESSED_MESSAGE_HEADER = struct.Struct('>iBBi')
+# <<uint:8 offset, uint:4 max size>>
+_FETCH = struct.Struct('>QI')
+# <<int:8 time, uint:4 max number of offsets>>
+_OFFSETS = struct.Struct('>qI')
+
+class Lengths(object):
+    ERROR_CODE = 2
+    RESPONSE_SIZE = 4
+    REQUEST_TYPE = 2
+    TOPIC_LENGTH = 2
+    TOPIC_PARTITION_COUNT = 2
+    PARTITION = 4
+    OFFSET = 8
+    OFFSET_COUNT = 4
+    MAX_NUM_OFFSETS = 4
+    MAX_REQUEST_SIZE = 4
+    MESSAGE_SET_SIZE = 4
+    TIME_VAL = 8
+    MESSAGE_LENGTH = 4
+    MAGIC = 1
+    ATTRIBUTES = 1
+    CHECKSUM = 4
+    MESSAGE_HEADER = MESSAGE_LENGTH + MAGIC + CHECKSUM
+    COMPRESSED_MESSAGE_HEADER = MESSAGE_HEADER + ATTRIBUTES
+
+class MessageSet(list):
+    """ The result of a fetch: a list of (offset, message) tuples, plus
+        next_offset, the offset right after the last complete message.
+        Messages unpacked from a compressed message all share its offset,
+        so next_offset is the only safe way to know where to fetch next.
+        truncated is the number of bytes the fetch ended with that don't
+        make a whole message (there was more to read than max_size), 0 if
+        it ended on a message boundary. """
+    def __init__(self, messages=(), next_offset=None, truncated=0):
+        list.__init__(self, messages)
+        self.next_offset = next_offset
+        self.truncated = truncated
+
+class Message(object):
+    """ A message of a LazyMessageSet. The payload stays in the response
+        until it is asked for. Unpacks like the tuples of a MessageSet: 
+        (offset, payload), or (offset, payload, corrupt) with 
+        include_corrupt. """
+    __slots__ = ('offset', 'corrupt', '_data', '_start', '_end')
+
+    def __init__(self, offset, data, start, end, corrupt=None):
+        self.offset = offset
+        self.corrupt = corrupt
+        self._data = data
+        self._start = start
+        self._end = end
+
+    @property
+    def payload(self):
+        return self._data[self._start:self._end]
+
+    def startswith(self, prefix):
+        """ Whether the payload starts with prefix, without slicing it 
+            out. """
+        if isinstance(self._data, str):
+            return self._data.startswith(prefix, self._start, self._end)
+        return self._end - self._start >= len(prefix) and \
+            self._data[self._start:self._start + len(prefix)] == prefix
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __iter__(self):
+        yield self.offset
+        yield self.payload
+        if self.corrupt is not None:
+            yield self.corrupt
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            other = tuple(other)
+        return tuple(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Message{0!r}'.format(tuple(self))
+
+class LazyMessageSet(object):
+    """ A MessageSet that keeps the response it was read from and only
+        where each message is in it: its offset and the bounds of its 
+        payload, in arrays. Messages are made when they are looked at 
+        (see Message), and payloads sliced out when they are asked for, so
+        messages that are looked at and dropped cost little and memory
+        stays close to the size of the response.
+
+        Has len(), iteration, indexing, next_offset and truncated like a
+        MessageSet, plus with_prefix(). """
+
+    def __init__(self, start_offset, include_corrupt=False):
+        self.next_offset = None
+        self.truncated = 0
+        self._start_offset = start_offset
+        # Per message: offset - start_offset, which buffer the payload is
+        # in and where
+        self._offsets = array('i')
+        self._buffer_ids = array('i')
+        self._starts = array('i')
+        self._ends = array('i')
+        self._corrupt = array('b') if include_corrupt else None
+        # The response, then the message sets decompressed from it
+        self._buffers = []
+
+    def add(self, offset, data, start, end, corrupt=False):
+        """ Add the message at offset, whose payload is data[start:end]. """
+        self.extend(data, [offset], [start], [end], corrupt)
+
+    def extend(self, data, offsets, starts, ends, corrupt=False):
+        """ Add the messages whose payloads are data[starts[i]:ends[i]], at
+            offsets[i]. """
+        if not self._buffers or self._buffers[-1] is not data:
+            self._buffers.append(data)
+        start_offset = self._start_offset
+        self._offsets.extend([offset - start_offset for offset in offsets])
+        self._buffer_ids.extend([len(self._buffers) - 1] * len(offsets))
+        self._starts.extend(starts)
+        self._ends.extend(ends)
+        if self._corrupt is not None:
+            self._corrupt.extend([corrupt] * len(offsets))
+
+    def with_prefix(self, prefix):
+        """ The Messages whose payload starts with prefix. Those that don't
+            are skipped without making anything out of them. """
+        buffers = self._buffers
+        if len(buffers) == 1 and isinstance(buffers[0], str):
+            # All in the response, str.startswith() can look in place
+            startswith = buffers[0].startswith
+            return [self[i] for i, (start, end) in 
+                    enumerate(izip(self._starts, self._ends))
+                    if startswith(prefix, start, end)]
+        return [message for message in self if message.startswith(prefix)]
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __iter__(self):
+        for i in xrange(len(self._offsets)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return Message(self._start_offset + self._offsets[index],
+            self._buffers[self._buffer_ids[index]], self._starts[index],
+            self._ends[index], 
+            None if self._corrupt is None else bool(self._corrupt[index]))
+
+    def __repr__(self):
+        return 'LazyMessageSet({0!r})'.format(list(self))
+
+class Codec(object):
+    """ Encodes requests and decodes response bodies.
+
+        Requests are encoded as lists of strs (the size prefix and headers
+        first, then the message payloads as they were given to us) or as a
+        single str, so they can be written without joining everything into
+        one string. frame_into() appends one to a buffer of the caller's
+        instead.
+
+        Response bodies are what follows the 4 byte size prefix: a 2 byte
+        error code (see check_error()), then the response itself.
+
+        Params:
+            include_corrupt: keep going past a message that doesn't fit in
+                             a fetch, handing out what there is of it
+            zero_copy:       fetched payloads are memoryviews into the
+                             response instead of strs copied out of it.
+                             Only worth it for large payloads (a few KB
+                             and up) that are passed on as they are: 
+                             small ones copy quickly, each memoryview 
+                             costs more than a short str, and any str() 
+                             made of it copies anyway. Every payload 
+                             kept also keeps its whole response alive.
+            lazy:            fetches return LazyMessageSets instead of
+                             MessageSets
+            verify_checksums: check the CRC32 of fetched messages. Turning
+                             it off saves CPU where the network can be
+                             trusted, corrupt messages then go unnoticed.
+            crc32:           the function computing checksums, for a faster
+                             implementation than binascii.crc32 (e.g. a
+                             hardware accelerated one). It is given strs
+                             and memoryviews and must return the CRC32 
+                             (IEEE, as in zlib, not CRC32C) as a signed 
+                             int, like binascii.crc32.
+            metrics:         a kafka.metrics.Metrics to count the messages
+                             fetched, corrupt ones and truncated fetches in
+    """
+
+    def __init__(self, include_corrupt=False, zero_copy=False, lazy=False,
+            verify_checksums=True, crc32=None, metrics=None):
+        self.include_corrupt = include_corrupt
+        self.zero_copy = zero_copy
+        self.lazy = lazy
+        self.verify_checksums = verify_checksums
+        self.crc32 = crc32 or binascii.crc32
+        self.metrics = metrics
+        # (topic, partition) -> its header, see _topic_header()
+        self._topic_headers = {}
+
+    def compute_checksum(self, value):
+        return self.crc32(value)
+
+    @staticmethod
+    def frame_into(buffer, request):
+        """ Append request, as returned by the *_request() methods, to
+            buffer (e.g. a bytearray) and return the number of bytes
+            added. """
+        if isinstance(request, str):
+            buffer.extend(request)
+            return len(request)
+        size = 0
+        for part in request:
+            buffer.extend(part)
+            size += len(part)
+        return size
+
+    # Request encoding methods
+    #
+    # Every request names its topic/partition with the same bytes, which
+    # _topic_header() keeps around. The rest is packed with the
+    # precompiled structs above.
+
+    def _topic_header(self, topic, partition):
+        """ <<uint:2, str, uint:4>>: topic length, topic, partition """
+        key = (topic, partition)
+        header = self._topic_headers.get(key)
+        if header is None:
+            header = _TOPIC_LENGTH.pack(len(topic)) + topic + \
+                _UINT32.pack(partition)
+            self._topic_headers[key] = header
+        return header
+
+    def encode_messages(self, messages, compression=COMPRESSION_NONE):
+        """ Return the size of the message set and the list of strs it is
+            made of. """
+        if compression != COMPRESSION_NONE and messages:
+            return self._encode_compressed_messages(messages, compression)
+
+        message_set_size = 0
+        message_set = []
+        append = message_set.append
+        pack_header = _MESSAGE_HEADER.pack
+        compute_checksum = self.crc32
+        # What the length field counts besides the payload
+        length_overhead = Lengths.MAGIC + Lengths.CHECKSUM
+        header_length = Lengths.MESSAGE_HEADER
+
+        for message in messages:
+            # <<uint:4, int:1, int:4, str>>
+            message_length = len(message)
+            append(pack_header(length_overhead + message_length, MAGIC_BYTE,
+                compute_checksum(message)))
+            append(message)
+            message_set_size += header_length + message_length
+
+        return message_set_size, message_set
+
+    def _encode_compressed_messages(self, messages, compression):
+        # A single message whose payload is the compressed message set
+        payload = compress(compression, self.encode_message_set(messages))
+
+        # <<uint:4, int:1, int:1, int:4, str>>
+        header = _COMPRESSED_MESSAGE_HEADER.pack(
+            Lengths.MAGIC + Lengths.ATTRIBUTES + Lengths.CHECKSUM +
+            len(payload),
+            MAGIC_BYTE_COMPRESSION,
+            compression & COMPRESSION_CODEC_MASK,
+            self.compute_checksum(payload)
+        )
+        return Lengths.COMPRESSED_MESSAGE_HEADER + len(payload), \
+            [header, payload]
+
+    def encode_message_set(self, messages, compression=COMPRESSION_NONE):
+        return ''.join(self.encode_messages(messages, compression)[1])
+
+    def produce_request(self, topic, messages, partition,
+            compression=COMPRESSION_NONE):
+        message_set_size, message_set = self.encode_messages(messages,
+            compression)
+
+        # <<uint:4, uint:2, <<uint:2, str, uint:4>>, uint:4, str>>
+        topic_header = self._topic_header(topic, partition)
+        request_size = Lengths.REQUEST_TYPE + len(topic_header) + \
+            Lengths.MESSAGE_SET_SIZE + message_set_size
+        header = _REQUEST_HEADER.pack(request_size, PRODUCE_REQUEST) + \
+            topic_header + _UINT32.pack(message_set_size)
+        if kafka_log.isEnabledFor(logging.INFO):
+            kafka_log.info('produce request: topic {0}, partition {1}, {2} messages ({3} bytes)'.format(topic, partition, len(messages), request_size))
+        return [header] + message_set
+
+    def multi_produce_request(self, request_parts,
+            compression=COMPRESSION_NONE):
+        """ request_parts: a list of (topic, partition, messages) """
+        # <<uint:4, uint:2, uint:2, [<<uint:2, str, uint:4, uint:4, str>>]>>
+        request_size = Lengths.REQUEST_TYPE + Lengths.TOPIC_PARTITION_COUNT
+        request = [None]
+        for topic, partition, messages in request_parts:
+            message_set_size, message_set = self.encode_messages(messages,
+                compression)
+            topic_header = self._topic_header(topic, partition)
+            request_size += len(topic_header) + Lengths.MESSAGE_SET_SIZE + \
+                message_set_size
+            request.append(topic_header + _UINT32.pack(message_set_size))
+            request.extend(message_set)
+
+        request[0] = _MULTI_REQUEST_HEADER.pack(request_size,
+            MULTIPRODUCE_REQUEST, len(request_parts))
+        if kafka_log.isEnabledFor(logging.INFO):
+            kafka_log.info('multiproduce request: {0} topic/partitions ({1} bytes)'.format(len(request_parts), request_size))
+        return request
+
+    def fetch_request(self, topic, offset, partition, max_size):
+        # <<uint:4, uint:2, <<uint:2, str, uint:4>>, uint:8, uint:4>>
+        topic_header = self._topic_header(topic, partition)
+        request_size = Lengths.REQUEST_TYPE + len(topic_header) + \
+            Lengths.OFFSET + Lengths.MAX_REQUEST_SIZE
+        return _REQUEST_HEADER.pack(request_size, FETCH_REQUEST) + \
+            topic_header + _FETCH.pack(offset, max_size)
+
+    def multi_fetch_request(self, fetches):
+        """ fetches: a list of (topic, partition, offset, max_size) """
+        # <<uint:4, uint:2, uint:2, [<<uint:2, str, uint:4, uint:8, uint:4>>]>>
+        request_size = Lengths.REQUEST_TYPE + Lengths.TOPIC_PARTITION_COUNT
+        parts = [None]
+        for topic, partition, offset, max_size in fetches:
+            topic_header = self._topic_header(topic, partition)
+            request_size += len(topic_header) + Lengths.OFFSET + \
+                Lengths.MAX_REQUEST_SIZE
+            parts.append(topic_header)
+            parts.append(_FETCH.pack(offset, max_size))
+
+        parts[0] = _MULTI_REQUEST_HEADER.pack(request_size, 
+            MULTIFETCH_REQUEST, len(fetches))
+        return ''.join(parts)
+
+    def offsets_request(self, topic, time_val, max_offsets, partition):
+        # <<uint:4, uint:2, <<uint:2, str, uint:4>>, int:8, uint:4>>
+        topic_header = self._topic_header(topic, partition)
+        request_size = Lengths.REQUEST_TYPE + len(topic_header) + \
+            Lengths.TIME_VAL + Lengths.MAX_NUM_OFFSETS
+        if kafka_log.isEnabledFor(logging.DEBUG):
+            kafka_log.debug('Fetching offsets for {0}-{1}, time: {2}, max_offsets: {3}'.format(topic, partition, time_val, max_offsets))
+        return _REQUEST_HEADER.pack(request_size, OFFSETS_REQUEST) + \
+            topic_header + _OFFSETS.pack(time_val, max_offsets)
+
+    # Response decoding methods
+
+    def check_error(self, data):
+        """ Raise the error the response body data starts with, if any. """
+        # Check if there is a non zero error code (2 byte unsigned int):
+        error_code = _ERROR_CODE.unpack_from(data)[0]
+        if error_code != 0:
+            raise error_codes.get(error_code, UnknownError)('Code: {0}'.format(error_code))
+
+    def decode_fetch_response(self, data, start_offset,
+            include_corrupt=False):
+        """ The MessageSet in the body of a FETCH response. """
+        return self.parse_message_buffer(start_offset, data,
+            Lengths.ERROR_CODE, len(data), include_corrupt)
+
+    def decode_multi_fetch_response(self, data, fetches,
+            include_corrupt=False):
+        """ A list with one MessageSet per fetch, in the same order, from the
+            body of a MULTIFETCH response. If any fetch got an error code, 
+            MultiFetchError is raised with the results of all of them. """
+        results = []
+        errors = {}
+        position = Lengths.ERROR_CODE
+        for index, (topic, partition, offset, max_size) in \
+                enumerate(fetches):
+            # Each fetch gets its own <<uint:4, uint:2, str>> response
+            response_size, error_code = struct.unpack_from('>IH', data,
+                position)
+            message_set_start = position + Lengths.RESPONSE_SIZE + \
+                Lengths.ERROR_CODE
+            position += Lengths.RESPONSE_SIZE + response_size
+            if error_code != 0:
+                # The other fetches' results are still good
+                error = error_codes.get(error_code, UnknownError)(
+                    'Code: {0} (topic: {1}, partition: {2}, offset: {3})'
+                    .format(error_code, topic, partition, offset))
+                errors[index] = error
+                results.append(error)
+                continue
+
+            results.append(self.parse_message_buffer(offset, data,
+                message_set_start, position, include_corrupt))
+        if errors:
+            raise MultiFetchError(results, errors)
+        return results
+
+    def decode_offsets_response(self, data):
+        """ The list of offsets in the body of an OFFSETS response. """
+        # The number of offsets received (uint:4)
+        offset_count = struct.unpack_from('>L', data, Lengths.ERROR_CODE)[0]
+
+        # The offsets themselves (uint:8 each)
+        offsets = list(struct.unpack_from('>{0}Q'.format(offset_count),
+            data, Lengths.ERROR_CODE + Lengths.OFFSET_COUNT))
+
+        if kafka_log.isEnabledFor(logging.DEBUG):
+            kafka_log.debug('Received {0} offsets: {1}'.format(offset_count, offsets))
+        return offsets
+
+    def parse_message_buffer(self, start_offset, data, start, end,
+            include_corrupt=False):
+        """ Parse the message set found in data[start:end] into a MessageSet
+
+            Same output and corrupt-message handling as parse_message_set(),
+            but walks the response in place with struct.unpack_from instead
+            of reading it piece by piece out of a StringIO, and only slices
+            out the payloads. With zero_copy, payloads are memoryviews into
+            data and nothing is copied at all.
+
+            Compressed messages are replaced by the messages they contain,
+            which all get the offset of the compressed message.
+
+            With lazy, returns a LazyMessageSet.
+        """
+        messages = self._parse_message_buffer(start_offset, data, start, end,
+            include_corrupt)
+        if self.metrics is not None:
+            self.metrics.increment('messages.fetched', len(messages))
+            if messages.truncated:
+                self.metrics.increment('fetches.truncated')
+        return messages
+
+    def _parse_message_buffer(self, start_offset, data, start, end,
+            include_corrupt):
+        if self.lazy:
+            messages = LazyMessageSet(start_offset, include_corrupt)
+        else:
+            messages = MessageSet()
+        position = self._parse_messages(messages, start_offset, data, start,
+            end, include_corrupt)
+        messages.next_offset = start_offset + position - start
+        messages.truncated = end - position
+        return messages
+
+    def verify_message_set(self, data, start=0, end=None):
+        """ Check the checksums of all the messages in data[start:end] in
+            one go. Return the positions in data of those that don't match,
+            [] if they all do. Ignores verify_checksums. """
+        if end is None:
+            end = len(data)
+        index = self._index_messages(data, start, end)[0]
+        return [index[i][0] for i in sorted(self._checksum_failures(data, 
+            index))]
+
+    def _index_messages(self, data, start, end):
+        """ Walk the headers of the messages in data[start:end]. Return a
+            list of (position, magic, attributes, checksum, payload_start, 
+            payload_end), one per message, and the position right after 
+            the last complete one. """
+        index = []
+        append = index.append
+        unpack_start = _MESSAGE_START.unpack_from
+        unpack_checksum = _CHECKSUM.unpack_from
+        unpack_compressed = _COMPRESSED_MESSAGE_REST.unpack_from
+        # Where the fields are, from the start of the message
+        header_length = Lengths.MESSAGE_HEADER
+        compressed_header_length = Lengths.COMPRESSED_MESSAGE_HEADER
+        magic_end = Lengths.MESSAGE_LENGTH + Lengths.MAGIC
+        include_corrupt = self.include_corrupt
+
+        position = start
+        while position < end:
+            # Fetches that fill max_size end in the middle of a message, it
+            # is reported by MessageSet.truncated
+            if end - position < header_length:
+                if kafka_log.isEnabledFor(logging.DEBUG):
+                    kafka_log.debug('End of message set. Expected {0} bytes for message header, only read {1}'.format(header_length, end - position))
+                break
+
+            # <<uint:4, uint:1, [uint:1,] int:4, str>>
+            message_length, magic = unpack_start(data, position)
+            if magic == MAGIC_BYTE_COMPRESSION:
+                if end - position < compressed_header_length:
+                    if kafka_log.isEnabledFor(logging.DEBUG):
+                        kafka_log.debug('End of message set. Expected {0} bytes for message header, only read {1}'.format(compressed_header_length, end - position))
+                    break
+                attributes, checksum = unpack_compressed(data, 
+                    position + magic_end)
+                payload_start = position + compressed_header_length
+            else:
+                attributes = 0
+                checksum = unpack_checksum(data, position + magic_end)[0]
+                payload_start = position + header_length
+
+            # Parse the payload (variable length string)
+            payload_end = position + Lengths.MESSAGE_LENGTH + message_length
+            if payload_end > end:
+                if not include_corrupt:
+                    # This is not an error - this happens everytime we reach
+                    # the end of the read buffer without having parsed a
+                    # complete msg
+                    break
+                payload_end = end
+            append((position, magic, attributes, checksum, payload_start, 
+                payload_end))
+            position = payload_end
+
+        return index, position
+
+    def _checksum_failures(self, data, index):
+        """ The indexes in index of the messages whose checksum doesn't
+            match. The checksums are computed by a single map() over the
+            payloads, still one crc32 call per message, and when they all 
+            match (nearly always) that is found with a single comparison. 
+            """
+        view = memoryview(data)
+        expected = [message[3] for message in index]
+        actual = map(self.crc32, [view[message[4]:message[5]] 
+                                  for message in index])
+        if actual == expected:
+            return frozenset()
+        return frozenset(i for i, checksum in enumerate(actual) 
+                         if checksum != expected[i])
+
+    def _parse_messages(self, messages, start_offset, data, start, end,
+            include_corrupt, wrapper_offset=None):
+        """ Append the messages in data[start:end] to `messages` and return
+            the position right after the last complete one. """
+        index, position = self._index_messages(data, start, end)
+        if self.verify_checksums:
+            checksum_failures = self._checksum_failures(data, index)
+        else:
+            checksum_failures = frozenset()
+
+        view = memoryview(data)
+        payload_slice = view if self.zero_copy else data
+        log_messages = kafka_log.isEnabledFor(logging.DEBUG)
+        lazy = isinstance(messages, LazyMessageSet)
+
+        if lazy and not checksum_failures and not log_messages and \
+                all(message[1] == MAGIC_BYTE for message in index):
+            # Nothing to decompress or report, the index is all it takes
+            if wrapper_offset is None:
+                offsets = [start_offset + message[0] - start 
+                           for message in index]
+            else:
+                offsets = [wrapper_offset] * len(index)
+            messages.extend(payload_slice, offsets, 
+                [message[4] for message in index], 
+                [message[5] for message in index])
+            return position
+
+        for i, (message_start, magic, attributes, checksum, payload_start, 
+                payload_end) in enumerate(index):
+            if wrapper_offset is None:
+                offset = start_offset + message_start - start
+            else:
+                offset = wrapper_offset
+
+            if magic not in (MAGIC_BYTE, MAGIC_BYTE_COMPRESSION):
+                kafka_log.error('Unexpected magic byte: {0} (expecting {1} or {2})'.format(magic, MAGIC_BYTE, MAGIC_BYTE_COMPRESSION))
+                corrupt = True
+            elif i in checksum_failures:
+                kafka_log.error('Checksum failure at offset {0}'.format(offset))
+                corrupt = True
+            else:
+                corrupt = False
+
+            codec = attributes & COMPRESSION_CODEC_MASK
+            if codec != COMPRESSION_NONE and not corrupt:
+                try:
+                    message_set = decompress(codec,
+                        view[payload_start:payload_end].tobytes())
+                except Exception, e:
+                    kafka_log.error('Could not decompress message at offset {0}: {1}'.format(offset, e))
+                    corrupt = True
+                else:
+                    self._parse_messages(messages, start_offset, message_set,
+                        0, len(message_set), include_corrupt, offset)
+                    continue
+
+            if corrupt and self.metrics is not None:
+                self.metrics.increment('messages.corrupt')
+            if log_messages:
+                kafka_log.debug('message {0}: (offset: {1}, {2} bytes, corrupt: {3})'.format(payload_slice[payload_start:payload_end], offset, payload_end - payload_start, corrupt))
+            if lazy:
+                messages.add(offset, payload_slice, payload_start, 
+                    payload_end, corrupt)
+            elif include_corrupt:
+                messages.append((offset, 
+                    payload_slice[payload_start:payload_end], corrupt))
+            else:
+                messages.append((offset, 
+                    payload_slice[payload_start:payload_end]))
+
+        return position
+
+    def parse_message_set(self, start_offset, message_buffer,
+            include_corrupt=False):
+        """ Generate the messages read out of message_buffer, a file-like
+            object positioned right after the error code. Slower than
+            parse_message_buffer() and doesn't handle compressed
+            messages. """
+        offset = start_offset
+
+        try:
+            has_more = True
+            while has_more:
+                offset = start_offset + message_buffer.tell() - Lengths.ERROR_CODE
+
+                # Parse the message length (uint:4)
+                raw_message_length = message_buffer.read(Lengths.MESSAGE_LENGTH)
+
+                if raw_message_length == '':
+                    break
+                elif len(raw_message_length) < Lengths.MESSAGE_LENGTH:
+                    kafka_log.error('Unexpected end of message set. Expected {0} bytes for message length, only read {1}'.format(Lengths.MESSAGE_LENGTH, len(raw_message_length)))
+                    break
+
+                message_length = struct.unpack('>I',
+                    raw_message_length)[0]
+
+                # Parse the magic byte (int:1)
+                raw_magic = message_buffer.read(Lengths.MAGIC)
+                if len(raw_magic) < Lengths.MAGIC:
+                    kafka_log.error('Unexpected end of message set. Expected {0} bytes for magic byte, only read{1}'.format(Lengths.MAGIC, len(raw_magic)))
+                    break
+
+                magic = struct.unpack('>B', raw_magic)[0]
+
+                # Parse the checksum (int:4)
+                raw_checksum = message_buffer.read(Lengths.CHECKSUM)
+                if len(raw_checksum) < Lengths.CHECKSUM:
+                    kafka_log.error('Unexpected end of message set. Expected {0} bytes for checksum, only read {1}'.format(Lengths.CHECKSUM, len(raw_checksum)))
+                    break
+
+                checksum = struct.unpack('>i', raw_checksum)[0]
+
+                # Parse the payload (variable length string)
+                payload_length = message_length - Lengths.MAGIC - Lengths.CHECKSUM
+                payload = message_buffer.read(payload_length)
+                if len(payload) < payload_length and not self.include_corrupt:
+                    # This is not an error - this happens everytime we reach
+                    # the end of the read buffer without having parsed a complete msg
+                    # kafka_log.error('Unexpected end of message set. Expected {0} bytes for payload, only read {1}'.format(payload_length, len(payload)))
+                    break
+
+                actual_checksum = self.compute_checksum(payload)
+                if magic != MAGIC_BYTE:
+                    kafka_log.error('Unexpected magic byte: {0} (expecting {1})'.format(magic, MAGIC_BYTE))
+                    corrupt = True
+
+                elif checksum != actual_checksum:
+                    kafka_log.error('Checksum failure at offset {0}'.format(offset))
+                    corrupt = True
+                else:
+                    corrupt = False
+
+                if include_corrupt:
+                    kafka_log.debug('message {0}: (offset: {1}, {2} bytes, corrupt: {3})'.format(payload, offset, message_length, corrupt))
+                    yield offset, payload, corrupt
+                else:
+                    kafka_log.debug('message {0}: (offset: {1}, {2} bytes)'.format(payload, offset, message_length))
+                    yield offset, payload
+        except:
+            kafka_log.error("Unexpected error:{0}".format(sys.exc_info()[0]))
+        finally:
+            message_buffer.close()
+
+
+class MessageSetStream(object):
+    """ Parses a message set a piece at a time, as it comes in: feed() 
+        returns the messages completed by each piece. Only the partial 
+        message at the end of what came in so far is kept.
+
+        next_offset is the offset of the first message not handed out yet.
+        Once all of the message set was fed, finish() returns the 
+        MessageSet of what is left: nothing but its next_offset and 
+        truncated, or with the codec's include_corrupt, the partial message
+        flagged as corrupt.
+    """
+
+    def __init__(self, codec, start_offset, include_corrupt=False):
+        self._codec = codec
+        # The message at the end of a piece is only truncated if it is also
+        # the end of the message set
+        self._feed_codec = copy.copy(codec)
+        self._feed_codec.include_corrupt = False
+        self.include_corrupt = include_corrupt
+        self.next_offset = start_offset
+        # The pieces of the partial message, only joined once it is 
+        # complete so a large one isn't copied again with every piece
+        self._pieces = []
+        self._buffered = 0
+        # Bytes the partial message needs before it is worth parsing
+        self._needed = 0
+
+    def feed(self, data):
+        """ Return a MessageSet (or LazyMessageSet) of the messages data 
+            completes. """
+        self._pieces.append(data)
+        self._buffered += len(data)
+        if self._buffered < self._needed:
+            data = ''
+        else:
+            data = ''.join(self._pieces)
+            self._pieces = []
+            self._buffered = 0
+        # Not parse_message_buffer(), which would count every piece as a 
+        # truncated fetch
+        messages = self._feed_codec._parse_message_buffer(self.next_offset, 
+            data, 0, len(data), self.include_corrupt)
+        if messages.truncated:
+            partial = data[len(data) - messages.truncated:]
+            self._pieces.append(partial)
+            self._buffered = len(partial)
+            if len(partial) >= _UINT32.size:
+                self._needed = _UINT32.size + _UINT32.unpack_from(partial)[0]
+            else:
+                self._needed = _UINT32.size
+        elif data:
+            self._needed = 0
+        self.next_offset = messages.next_offset
+        if self._codec.metrics is not None:
+            self._codec.metrics.increment('messages.fetched', len(messages))
+        return messages
+
+    def finish(self):
+        partial = ''.join(self._pieces)
+        self._pieces = []
+        self._buffered = 0
+        self._needed = 0
+        return self._codec.parse_message_buffer(self.next_offset, partial, 
+            0, len(partial), self.include_corrupt)
+
+
+# What Connection.receive_data() returns, one per response: token is what
+# the request was sent with, result what its decoder returned, error what
+# it raised (a KafkaError for an error code sent by the server). Streamed
+# fetches get a MessagesReceived as each batch of messages comes in, then a
+# Response with the MessageSetStream's finish().
+Response = namedtuple('Response', 'token result')
+ResponseFailed = namedtuple('ResponseFailed', 'token error')
+MessagesReceived = namedtuple('MessagesReceived', 'token messages')
+
+class Connection(object):
+    """ The client side of one connection to a Kafka server, without the
+        connection: the transport writes out what the request methods
+        return, feeds whatever it reads to receive_data() and acts on the
+        events that come out.
+
+        The server answers requests in the order they were sent, so any
+        number of them may be waiting for a response (see pending).
+        PRODUCE and MULTIPRODUCE requests get no response.
+
+        Example:
+
+            connection = Connection()
+            sock.sendall(connection.fetch('good_dogs', 0, token='dogs'))
+            while not events:
+                events = connection.receive_data(sock.recv(65536))
+            # [Response(token='dogs', result=[(0, 'Rusty'), ...])]
+    """
+
+    def __init__(self, codec=None):
+        self.codec = codec or Codec()
+        self._buffer = bytearray()
+        # (token, decode, stream) for each request waiting for a response,
+        # oldest first. stream is a MessageSetStream for streamed fetches.
+        self._expected = deque()
+        # [token, stream, bytes left] of the streamed response coming in
+        self._streaming = None
+
+    @property
+    def pending(self):
+        """ The number of requests waiting for a response, or for the rest
+            of it. """
+        return len(self._expected) + (self._streaming is not None)
+
+    # Requests. Each returns the request, or appends it to buffer and
+    # returns buffer when one is given.
+
+    def produce(self, topic, messages, partition=0,
+            compression=COMPRESSION_NONE, buffer=None):
+        return self._frame(self.codec.produce_request(topic, messages,
+            partition, compression), buffer)
+
+    def multi_produce(self, request_parts, compression=COMPRESSION_NONE,
+            buffer=None):
+        return self._frame(self.codec.multi_produce_request(request_parts,
+            compression), buffer)
+
+    def fetch(self, topic, offset, partition=0, max_size=1024 * 1024,
+            include_corrupt=False, token=None, buffer=None):
+        """ The result is a MessageSet. """
+        return self.request(
+            self.codec.fetch_request(topic, offset, partition, max_size),
+            lambda data: self.codec.decode_fetch_response(data, offset,
+                include_corrupt),
+            token, buffer)
+
+    def fetch_stream(self, topic, offset, partition=0, max_size=1024 * 1024,
+            include_corrupt=False, token=None, buffer=None):
+        """ A fetch whose messages come out of receive_data() as they come 
+            in, in MessagesReceived events, instead of all at once. """
+        stream = MessageSetStream(self.codec, offset, include_corrupt)
+        self._expected.append((token, None, stream))
+        return self._frame(
+            self.codec.fetch_request(topic, offset, partition, max_size),
+            buffer)
+
+    def multi_fetch(self, fetches, include_corrupt=False, token=None,
+            buffer=None):
+        """ The result is a list of MessageSets, one per fetch. """
+        return self.request(
+            self.codec.multi_fetch_request(fetches),
+            lambda data: self.codec.decode_multi_fetch_response(data,
+                fetches, include_corrupt),
+            token, buffer)
+
+    def offsets(self, topic, time_val, max_offsets, partition=0,
+            token=None, buffer=None):
+        """ The result is a list of offsets. """
+        return self.request(
+            self.codec.offsets_request(topic, time_val, max_offsets,
+                partition),
+            self.codec.decode_offsets_response,
+            token, buffer)
+
+    def request(self, request, decode, token=None, buffer=None):
+        """ Expect a response to request, an encoded request. Its body goes
+            through decode() once error codes have been checked. """
+        self._expected.append((token, decode, None))
+        return self._frame(request, buffer)
+
+    def _frame(self, request, buffer):
+        if buffer is None:
+            return request
+        self.codec.frame_into(buffer, request)
+        return buffer
+
+    # Responses
+
+    def receive_data(self, data):
+        """ Take in data read from the server, return the list of Response,
+            ResponseFailed and MessagesReceived events it brought. """
+        self._buffer.extend(data)
+        buffer = self._buffer
+
+        # <<uint:4 size, size bytes>> per response
+        events = []
+        position = 0
+        buffered = len(buffer)
+        while True:
+            if self._streaming is not None:
+                position = self._stream_received(buffer, position, buffered,
+                    events)
+                if self._streaming is not None:
+                    break
+                continue
+
+            if buffered - position < Lengths.RESPONSE_SIZE:
+                break
+            size = _UINT32.unpack_from(buffer, position)[0]
+            end = position + Lengths.RESPONSE_SIZE + size
+            if self._expected and self._expected[0][2] is not None and \
+                    buffered - position >= Lengths.RESPONSE_SIZE + \
+                    Lengths.ERROR_CODE and \
+                    not _ERROR_CODE.unpack_from(buffer, 
+                        position + Lengths.RESPONSE_SIZE)[0]:
+                # A streamed fetch, its messages go out as they come in
+                token, decode, stream = self._expected.popleft()
+                self._streaming = [token, stream, size - Lengths.ERROR_CODE]
+                position += Lengths.RESPONSE_SIZE + Lengths.ERROR_CODE
+                continue
+            if end > buffered:
+                break
+            body = str(buffer[position + Lengths.RESPONSE_SIZE:end])
+            position = end
+            events.append(self._response_received(body))
+        if position:
+            del buffer[:position]
+        return events
+
+    def _stream_received(self, buffer, position, buffered, events):
+        """ Feed what there is of the streamed response to its stream,
+            return the position after it. """
+        token, stream, remaining = self._streaming
+        length = min(buffered - position, remaining)
+        if length:
+            messages = stream.feed(str(buffer[position:position + length]))
+            if messages:
+                events.append(MessagesReceived(token, messages))
+            self._streaming[2] -= length
+        if not self._streaming[2]:
+            self._streaming = None
+            events.append(Response(token, stream.finish()))
+        return position + length
+
+    def _response_received(self, data):
+        token, decode, stream = self._expected.popleft()
+        try:
+            self.codec.check_error(data)
+            if stream is not None:
+                # An empty streamed fetch
+                stream.feed(data[Lengths.ERROR_CODE:])
+                return Response(token, stream.finish())
+            return Response(token, decode(data))
+        except Exception, e:
+            return ResponseFailed(token, e)
+
+    def connection_lost(self, error):
+        """ The connection is gone: return a ResponseFailed with error for
+            every request still waiting for a response, and start over. """
+        events = [ResponseFailed(token, error)
+                  for token, decode, stream in self._expected]
+        if self._streaming is not None:
+            events.insert(0, ResponseFailed(self._streaming[0], error))
+            self._streaming = None
+        self._expected.clear()
+        del self._buffer[:]
+        return events
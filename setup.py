@@ -12,6 +12,10 @@ setuptools.setup(
   url = 'https://github.com/datadog/pykafka',
   platforms = 'any',
   packages = ['kafka'],
+  extras_require = {
+    # kafka.aio
+    'asyncio': ['trollius'],
+  },
   zip_safe = True,
   verbose = False,
 )
@@ -1,28 +1,102 @@
+import errno
+import itertools
 import logging
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
 import time
 import unittest
+from cStringIO import StringIO
+from functools import partial
 from kafka import (
     Kafka, 
-    LATEST_OFFSET, EARLIEST_OFFSET, Lengths, 
+    LATEST_OFFSET, EARLIEST_OFFSET, Lengths, COMPRESSION_GZIP,
     ConnectionFailure,
+    PoolExhausted,
     OffsetOutOfRange,
+    WrongPartitionCode,
     InvalidOffset,
+    MessageTooLarge,
+    NoBrokerForPartition,
+    MultiFetchError,
+    QueueFull,
+    MessageSet,
+    LazyMessageSet,
+    AdaptiveFetch,
 )
 
+from kafka.base import _Prefetcher
+from kafka.blocking import Connection as SocketConnection
+from kafka.checkpoint import Checkpoint, FileOffsetStore, \
+    SQLiteOffsetStore
+from kafka.cluster import KafkaCluster
+from kafka.consumer import TopicConsumer
+from kafka.fakebroker import FakeBroker
+from kafka.metrics import MemoryMetrics, CallbackMetrics, Histogram
+from kafka.protocol import Codec, Connection, Response, ResponseFailed, \
+    MessagesReceived, MessageSetStream
+from kafka.pool import ConnectionPool
+from kafka.partitioner import HashPartitioner, RoundRobinPartitioner, \
+    LeastLoadedPartitioner
+from kafka.producer import AsyncProducer
+
 try:
     from tornado.testing import AsyncTestCase, LogTrapTestCase
-    from kafka.nonblocking import KafkaTornado
+    from kafka.nonblocking import KafkaTornado, AsyncProducerTornado, \
+        TopicConsumerTornado
     has_tornado = True
 except ImportError:
     has_tornado = False
 
-# Messages are not available to clients until they have been flushed.
-# By default is is 1000ms, see log.default.flush.interval.ms in 
-# server.properties
+try:
+    import trollius as asyncio
+    from trollius import From
+    from kafka.aio import KafkaAsyncio
+    has_asyncio = True
+except ImportError:
+    has_asyncio = False
+
+# The tests run against a kafka.fakebroker started on localhost:9092, so 
+# they need neither a network nor a Kafka install, and what is produced can 
+# be fetched right away. With KAFKA_REAL_BROKER=1 they run against the Kafka 
+# broker on localhost:9092 instead.
+fake_broker = None
+
+# A real broker's messages are not available to clients until they have 
+# been flushed. By default is is 1000ms, see log.default.flush.interval.ms 
+# in server.properties
 MESSAGE_DELAY_SECS = (1000 * 2) / 1000
 
+def setUpModule():
+    global fake_broker
+    if not os.environ.get('KAFKA_REAL_BROKER'):
+        fake_broker = FakeBroker(host='localhost', port=9092)
+        fake_broker.start()
+
+def tearDownModule():
+    if fake_broker is not None:
+        fake_broker.close()
+
+def wait_for_messages():
+    """ Wait until what was just produced can be fetched. """
+    if fake_broker is None:
+        time.sleep(MESSAGE_DELAY_SECS)
+
+_topic_numbers = itertools.count()
+
 def get_unique_topic(name):
-    return '{0}-{1}'.format(time.time(), name)
+    # The clock alone repeats itself when tests don't sleep
+    return '{0}-{1}-{2}'.format(time.time(), next(_topic_numbers), name)
+
+class HangUpBroker(FakeBroker):
+    """ Hangs up on requests about the topic hang_up. """
+    def handle_request(self, request):
+        if self._topic_partition(request, 2)[0] == 'hang_up':
+            raise socket.error()
+        return FakeBroker.handle_request(self, request)
 
 class TestKafkaBlocking(unittest.TestCase):
     def test_kafka(self):
@@ -33,7 +107,7 @@ class TestKafkaBlocking(unittest.TestCase):
         input_messages = ['message0', 'message1', 'message2']
         
         kafka.produce(topic, input_messages)
-        time.sleep(MESSAGE_DELAY_SECS)
+        wait_for_messages()
         fetch_results = kafka.fetch(topic, start_offset)
         
         output_messages = []
@@ -65,7 +139,390 @@ class TestKafkaBlocking(unittest.TestCase):
         self.assertRaises(ConnectionFailure, kafka.produce, topic, 
             'wont appear')
 
-    
+    def test_multi_produce(self):
+        kafka = Kafka()
+        topic1 = get_unique_topic('test-multi-produce-1')
+        topic2 = get_unique_topic('test-multi-produce-2')
+
+        kafka.multi_produce({
+            (topic1, 0): ['message0', 'message1'],
+            (topic2, 0): 'message2',
+        })
+        wait_for_messages()
+
+        self.assertEquals(['message0', 'message1'], 
+            [message for offset, message in kafka.fetch(topic1, 0)])
+        self.assertEquals(['message2'], 
+            [message for offset, message in kafka.fetch(topic2, 0)])
+
+    def test_multi_fetch(self):
+        kafka = Kafka()
+        topic1 = get_unique_topic('test-multi-fetch-1')
+        topic2 = get_unique_topic('test-multi-fetch-2')
+
+        kafka.produce(topic1, ['message0', 'message1'])
+        kafka.produce(topic2, ['message2'])
+        wait_for_messages()
+
+        results = kafka.multi_fetch([
+            (topic1, 0, 0, None),
+            (topic2, 0, 0, None),
+            (topic1, 0, Lengths.MESSAGE_HEADER + len('message0'), None),
+        ])
+        self.assertEquals(3, len(results))
+        self.assertEquals(['message0', 'message1'], 
+            [message for offset, message in results[0]])
+        self.assertEquals(['message2'], 
+            [message for offset, message in results[1]])
+        self.assertEquals(['message1'], 
+            [message for offset, message in results[2]])
+
+        # A bad fetch doesn't take the others' results with it
+        try:
+            kafka.multi_fetch([
+                (topic1, 0, 0, None),
+                (topic2, 0, 1000, None),
+                (topic2, 0, 0, None),
+            ])
+        except MultiFetchError, e:
+            self.assertEquals([1], e.errors.keys())
+            self.assertTrue(isinstance(e.errors[1], OffsetOutOfRange))
+            self.assertTrue(e.results[1] is e.errors[1])
+            self.assertEquals(['message0', 'message1'], 
+                [message for offset, message in e.results[0]])
+            self.assertEquals(['message2'], 
+                [message for offset, message in e.results[2]])
+        else:
+            self.fail('MultiFetchError not raised')
+
+    def test_pipeline(self):
+        kafka = Kafka()
+        topic = get_unique_topic('test-pipeline')
+
+        kafka.produce(topic, ['message0', 'message1'])
+        wait_for_messages()
+
+        pipeline = kafka.pipeline(max_in_flight=2)
+        pipeline.fetch(topic, 0)
+        pipeline.offsets(topic, LATEST_OFFSET, max_offsets=1)
+        pipeline.fetch(topic, Lengths.MESSAGE_HEADER + len('message0'))
+        fetch0, latest_offsets, fetch1 = pipeline.execute()
+
+        self.assertEquals(['message0', 'message1'], 
+            [message for offset, message in fetch0])
+        self.assertEquals([2 * Lengths.MESSAGE_HEADER + len('message0') + 
+            len('message1')], latest_offsets)
+        self.assertEquals(['message1'], 
+            [message for offset, message in fetch1])
+
+    def test_pipeline_connection_lost(self):
+        with HangUpBroker() as broker:
+            kafka = Kafka(broker.host, broker.port)
+            pipeline = kafka.pipeline()
+            pipeline.fetch('dogs', 0)
+            pipeline.fetch('hang_up', 0)
+            pipeline.fetch('dogs', 0)
+            self.assertRaises(ConnectionFailure, pipeline.execute)
+            self.assertFalse(kafka._connection.connected)
+        broker.close()
+
+    def test_pipeline_write_failure(self):
+        with FakeBroker() as broker:
+            kafka = Kafka(broker.host, broker.port)
+            kafka.produce('dogs', 'Rusty')
+            connection = kafka._connection
+            sent = []
+            def send(data):
+                # The second request of the pipeline can't be written
+                sent.append(data)
+                if len(sent) == 2:
+                    raise socket.error(errno.EPIPE, 'Broken pipe')
+                return SocketConnection.send(connection, data)
+            connection.send = send
+
+            pipeline = kafka.pipeline()
+            pipeline.fetch('dogs', 0)
+            pipeline.fetch('dogs', 0)
+            # Not retried on a new connection, where the response to the 
+            # first fetch will never come
+            self.assertRaises(ConnectionFailure, pipeline.execute)
+            self.assertFalse(kafka._connection.connected)
+        broker.close()
+
+    def test_multi_offsets(self):
+        kafka = Kafka(offsets_ttl=60)
+        topic = get_unique_topic('test-multi-offsets')
+        kafka.produce(topic, ['message0', 'message1'], 1)
+        wait_for_messages()
+
+        results = kafka.multi_offsets([
+            (topic, 0, LATEST_OFFSET, 1),
+            (topic, 1, LATEST_OFFSET, 1),
+            (topic, 1, EARLIEST_OFFSET, 1),
+        ])
+        latest = 2 * Lengths.MESSAGE_HEADER + len('message0message1')
+        self.assertEquals([[0], [latest], [0]], results)
+
+        # Served from the cache from now on
+        kafka.produce(topic, 'message2', 1)
+        wait_for_messages()
+        partition = kafka.partition(topic, 1)
+        self.assertEquals(latest, partition.latest_offset())
+        self.assertTrue(latest < partition.latest_offset(max_age=0))
+
+        # Not cached by default
+        kafka = Kafka()
+        partition = kafka.partition(topic, 1)
+        latest = partition.latest_offset()
+        kafka.produce(topic, 'message3', 1)
+        wait_for_messages()
+        self.assertTrue(latest < partition.latest_offset())
+
+    def test_fetch_stream(self):
+        kafka = Kafka()
+        topic = get_unique_topic('test-fetch-stream')
+        messages = ['message{0}'.format(i) for i in range(100)]
+        kafka.produce(topic, messages)
+        wait_for_messages()
+
+        # Small reads, so the messages come out over many of them
+        stream = kafka.fetch_stream(topic, 0, max_size=1000, chunk_size=7)
+        self.assertEqual(kafka.fetch(topic, 0, max_size=1000), list(stream))
+        fetched = kafka.fetch(topic, 0, max_size=1000)
+        self.assertEqual(fetched.next_offset, stream.next_offset)
+        self.assertEqual(fetched.truncated, stream.truncated)
+
+        # Stopping half way leaves the client usable
+        stream = kafka.fetch_stream(topic, 0, chunk_size=7)
+        stream.next()
+        stream.close()
+        self.assertEqual(messages,
+            [message for offset, message in kafka.fetch(topic, 0)])
+
+    def test_fetch_stream_interleaved(self):
+        topic = get_unique_topic('test-fetch-stream-interleaved')
+        messages = ['message{0}'.format(i) for i in range(100)]
+        Kafka().produce(topic, messages)
+        wait_for_messages()
+
+        for kafka in [Kafka(), Kafka(pool=ConnectionPool(max_size=2))]:
+            # Other requests go on while the stream is half read
+            stream = kafka.fetch_stream(topic, 0, chunk_size=7)
+            first = [stream.next() for i in range(10)]
+            self.assertEqual(messages,
+                [message for offset, message in kafka.fetch(topic, 0)])
+            self.assertEqual(messages,
+                [message for offset, message in first + list(stream)])
+
+    def test_connection_pool(self):
+        pool = ConnectionPool(max_size=2)
+        kafka = Kafka(pool=pool)
+        topic = get_unique_topic('test-connection-pool')
+
+        kafka.produce(topic, ['message0', 'message1'])
+        wait_for_messages()
+
+        results = []
+        def fetch():
+            for i in range(10):
+                results.append([message for offset, message 
+                                in kafka.fetch(topic, 0)])
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals([['message0', 'message1']] * 40, results)
+        self.assertTrue(pool.size(kafka.host, kafka.port) <= 2)
+
+        # Every connection is in use and we can't wait for one
+        pool = ConnectionPool(max_size=1, checkout_timeout=0)
+        connection = pool.checkout(kafka.host, kafka.port)
+        self.assertRaises(PoolExhausted, pool.checkout, kafka.host, kafka.port)
+        pool.checkin(connection)
+        pool.close()
+
+    def test_recv_buffer(self):
+        kafka = Kafka(max_size=4 * 1024 * 1024)
+        topic = get_unique_topic('test-recv-buffer')
+        kafka.produce(topic, ['Rusty', 'x' * 2 * 1024 * 1024])
+        wait_for_messages()
+
+        kafka.fetch(topic, 0, max_size=100)
+        self.assertTrue(0 < len(kafka._connection.recv_buffer) <= 200)
+        # Too large to keep around
+        self.assertEquals(2, len(kafka.fetch(topic, 0)))
+        self.assertTrue(len(kafka._connection.recv_buffer) <= 200)
+
+    def test_connection_pool_idle_timeout(self):
+        pool = ConnectionPool(idle_timeout=0.05)
+        with FakeBroker() as broker1:
+            with FakeBroker() as broker2:
+                connection1 = pool.checkout(broker1.host, broker1.port)
+                connection2 = pool.checkout(broker2.host, broker2.port)
+                pool.checkin(connection1)
+                pool.checkin(connection2)
+                time.sleep(0.1)
+
+                # Idle connections to every broker are closed, not only to
+                # the one a connection is asked for
+                pool.checkin(pool.checkout(broker1.host, broker1.port))
+                self.assertEqual(1, pool.size(broker1.host, broker1.port))
+                self.assertEqual(0, pool.size(broker2.host, broker2.port))
+                self.assertFalse(connection1.connected)
+                self.assertFalse(connection2.connected)
+                pool.close()
+            broker2.close()
+        broker1.close()
+
+    def test_connection_pool_health_check(self):
+        pool = ConnectionPool()
+        broker = FakeBroker()
+        broker.start()
+        connection = pool.checkout(broker.host, broker.port)
+        self.assertTrue(connection.is_alive())
+        pool.checkin(connection)
+
+        # The broker hangs up on the idle connection
+        broker.stop()
+        broker.port = connection.port
+        broker.start()
+        self.assertFalse(connection.is_alive())
+        fresh = pool.checkout(broker.host, broker.port)
+        self.assertTrue(fresh is not connection)
+        self.assertTrue(fresh.is_alive())
+        self.assertFalse(connection.connected)
+        self.assertEqual(1, pool.size(broker.host, broker.port))
+        pool.checkin(fresh)
+        pool.close()
+        broker.close()
+
+    def test_cluster(self):
+        # The same server under two names stands in for two brokers
+        brokers = ['localhost:9092', ('127.0.0.1', 9092)]
+        topic = get_unique_topic('test-cluster')
+        cluster = KafkaCluster(brokers, {
+            (topic, 0): 'localhost:9092',
+            (topic, 1): '127.0.0.1:9092',
+        })
+        self.assertEquals('localhost', cluster.broker(topic, 0).host)
+        self.assertEquals('127.0.0.1', cluster.broker(topic, 1).host)
+        self.assertRaises(NoBrokerForPartition, cluster.fetch, topic, 0, 2)
+        self.assertRaises(ValueError, cluster.assign, topic, 2, 
+            'localhost:9093')
+
+        cluster.produce(topic, 'message0', 0)
+        cluster.multi_produce({
+            (topic, 0): 'message1',
+            (topic, 1): ['message2', 'message3'],
+        })
+        wait_for_messages()
+
+        results = cluster.multi_fetch([
+            (topic, 1, 0, None),
+            (topic, 0, 0, None),
+        ])
+        self.assertEquals(['message2', 'message3'], 
+            [message for offset, message in results[0]])
+        self.assertEquals(['message0', 'message1'], 
+            [message for offset, message in results[1]])
+        try:
+            cluster.multi_fetch([(topic, 1, 1000, None), (topic, 0, 0, None)])
+        except MultiFetchError, e:
+            self.assertEquals([0], e.errors.keys())
+            self.assertEquals(['message0', 'message1'], 
+                [message for offset, message in e.results[1]])
+        else:
+            self.fail('MultiFetchError not raised')
+
+        latest = 2 * Lengths.MESSAGE_HEADER + len('message0message1')
+        self.assertEquals([[latest], [latest]], cluster.multi_offsets([
+            (topic, 0, LATEST_OFFSET, 1),
+            (topic, 1, LATEST_OFFSET, 1),
+        ]))
+        self.assertEquals(latest, cluster.partition(topic, 1).latest_offset())
+
+        # Requests to a single broker are sent from the calling thread, the
+        # threads for the others are kept for the next requests
+        cluster.close()
+        cluster.multi_fetch([(topic, 0, 0, None)])
+        self.assertEquals(0, len(cluster._workers))
+        for i in range(3):
+            cluster.multi_fetch([(topic, 0, 0, None), (topic, 1, 0, None)])
+        self.assertEquals(1, len(cluster._workers))
+        cluster.close()
+
+        self.assertRaises(ValueError, KafkaCluster, [])
+
+    def test_cluster_pool(self):
+        pool = ConnectionPool(max_size=2)
+        cluster = KafkaCluster(['localhost:9092', '127.0.0.1:9092'], {
+            ('dogs', 0): 'localhost:9092',
+            ('dogs', 1): '127.0.0.1:9092',
+        }, pool=pool)
+        cluster.multi_fetch([('dogs', 0, 0, None), ('dogs', 1, 0, None)])
+        self.assertEquals(1, pool.size('localhost', 9092))
+        self.assertEquals(1, pool.size('127.0.0.1', 9092))
+        cluster.close()
+        self.assertEquals(0, pool.size('localhost', 9092))
+        self.assertEquals(0, pool.size('127.0.0.1', 9092))
+
+    def test_async_producer(self):
+        kafka = Kafka()
+        topic = get_unique_topic('test-async-producer')
+        input_messages = ['message{0}'.format(i) for i in range(25)]
+
+        producer = AsyncProducer(kafka, batch_messages=10, linger_ms=10)
+        for message in input_messages:
+            producer.send(topic, message)
+        producer.close()
+        wait_for_messages()
+
+        self.assertEquals(input_messages, 
+            [message for offset, message in kafka.fetch(topic, 0)])
+
+    def test_topic_consumer(self):
+        kafka = Kafka(pool=ConnectionPool(max_size=4))
+        topic = get_unique_topic('test-topic-consumer')
+        for partition in range(3):
+            kafka.produce(topic, ['p{0}m0'.format(partition), 
+                'p{0}m1'.format(partition)], partition)
+        wait_for_messages()
+
+        consumer = TopicConsumer(kafka, topic, dict.fromkeys(range(4), 0), 
+            workers=2, max_size=20, poll_interval=0.1)
+        received = dict((partition, []) for partition in range(3))
+        for partition, messages in consumer:
+            received[partition].extend(msg for offset, msg in messages)
+            if sum(len(msgs) for msgs in received.values()) == 6:
+                break
+        consumer.close()
+
+        for partition in range(3):
+            self.assertEquals(['p{0}m0'.format(partition), 
+                'p{0}m1'.format(partition)], received[partition])
+            self.assertEquals(26, consumer.offsets[partition])
+        self.assertEquals(0, consumer.offsets[3])
+
+    def test_topic_consumer_close_with_full_queue(self):
+        kafka = Kafka(pool=ConnectionPool(max_size=4))
+        topic = get_unique_topic('test-topic-consumer-close')
+        for partition in range(8):
+            kafka.produce(topic, 'message', partition)
+        wait_for_messages()
+
+        # Workers are left waiting to queue their batches
+        consumer = TopicConsumer(kafka, topic, dict.fromkeys(range(8), 0),
+            workers=4, max_batches=1)
+        consumer.next()
+        wait_for_messages()
+        closing = threading.Thread(target=consumer.close)
+        closing.daemon = True
+        closing.start()
+        closing.join(5)
+        self.assertFalse(closing.is_alive())
+
 
 if has_tornado:
     class TestKafkaTornado(AsyncTestCase, LogTrapTestCase):
@@ -80,7 +537,7 @@ if has_tornado:
             self.wait()
             
             # By default messages may not be available for up to 1 second.
-            time.sleep(MESSAGE_DELAY_SECS)
+            wait_for_messages()
             
             kafka.fetch(topic, start_offset, 
                 callback=self.stop)
@@ -111,6 +568,58 @@ if has_tornado:
             self.assertEquals(len(actual_earliest_offsets), 1)
             self.assertEquals(0, actual_earliest_offsets[0])            
 
+        def test_concurrent_requests(self):
+            kafka = KafkaTornado(io_loop=self.io_loop, max_in_flight=2)
+            topic = get_unique_topic('test-kafka-tornado-concurrent')
+
+            kafka.produce(topic, ['message0', 'message1'], callback=self.stop)
+            self.wait()
+            wait_for_messages()
+
+            # Issue more requests than there are in-flight slots, without
+            # waiting for any of them
+            results = {}
+            def on_response(key, response):
+                results[key] = response
+                if len(results) == 4:
+                    self.stop()
+            for start_offset in (0, Lengths.MESSAGE_HEADER + len('message0')):
+                kafka.fetch(topic, start_offset, 
+                    callback=partial(on_response, start_offset))
+            for time_val in (EARLIEST_OFFSET, LATEST_OFFSET):
+                kafka.offsets(topic, time_val, max_offsets=1, 
+                    callback=partial(on_response, time_val))
+            self.wait()
+
+            self.assertEquals(['message0', 'message1'], 
+                [message for offset, message in results[0]])
+            self.assertEquals(['message1'], 
+                [message for offset, message 
+                 in results[Lengths.MESSAGE_HEADER + len('message0')]])
+            self.assertEquals([0], results[EARLIEST_OFFSET])
+            self.assertEquals([2 * Lengths.MESSAGE_HEADER + len('message0') + 
+                len('message1')], results[LATEST_OFFSET])
+
+        def test_fetch_stream(self):
+            kafka = KafkaTornado(io_loop=self.io_loop)
+            topic = get_unique_topic('test-kafka-tornado-stream')
+            kafka.produce(topic, ['message0', 'message1'], callback=self.stop)
+            self.wait()
+            wait_for_messages()
+
+            received = []
+            def on_messages(messages, done):
+                received.extend(messages)
+                if done:
+                    self.stop(messages.next_offset)
+            kafka.fetch_stream(topic, 0, callback=on_messages)
+            next_offset = self.wait()
+
+            self.assertEquals(['message0', 'message1'], 
+                [message for offset, message in received])
+            self.assertEquals(2 * Lengths.MESSAGE_HEADER + len('message0') + 
+                len('message1'), next_offset)
+
         def test_cant_connect(self):
             kafka = KafkaTornado(host=str(time.time()), io_loop=self.io_loop)
             topic = get_unique_topic('test-cant-connect')
@@ -118,6 +627,687 @@ if has_tornado:
             self.assertRaises(ConnectionFailure, kafka.produce, topic, 
                 'wont appear')
 
+        def test_connection_lost(self):
+            with HangUpBroker() as broker:
+                kafka = KafkaTornado(broker.host, broker.port, 
+                    io_loop=self.io_loop)
+                kafka.fetch('hang_up', 0, callback=self.stop)
+                self.assertRaises(ConnectionFailure, self.wait)
+
+                # The next request gets a connection of its own
+                kafka.fetch('dogs', 0, callback=self.stop)
+                self.assertEquals([], list(self.wait()))
+                kafka._disconnect()
+            broker.close()
+
+        def test_error_response(self):
+            with FakeBroker(latency=0.05) as broker:
+                Kafka(broker.host, broker.port).produce('dogs', 'Rusty')
+                kafka = KafkaTornado(broker.host, broker.port,
+                    io_loop=self.io_loop)
+                results = []
+                def done(result):
+                    results.append(result)
+                    if len(results) == 2:
+                        self.stop()
+                # Both in flight at once, only the first one fails
+                kafka.fetch('dogs', 1000, callback=done, errback=done)
+                kafka.fetch('dogs', 0, callback=done, errback=done)
+                self.wait()
+
+                self.assertTrue(isinstance(results[0], OffsetOutOfRange))
+                self.assertEquals(['Rusty'],
+                    [message for offset, message in results[1]])
+                # The connection is still good
+                kafka.offsets('dogs', LATEST_OFFSET, 1, callback=self.stop)
+                self.assertEquals([Lengths.MESSAGE_HEADER + 5], self.wait())
+                kafka._disconnect()
+            broker.close()
+
+        def test_callback_error(self):
+            kafka = KafkaTornado(io_loop=self.io_loop)
+            errors = []
+            def callback(messages):
+                raise ValueError('callback bug')
+            # The callback's own exception isn't the request's error
+            kafka.fetch('dogs', 0, callback=callback, errback=errors.append)
+            self.assertRaises(ValueError, self.wait)
+            self.assertEquals([], errors)
+
+            # and the connection is still good
+            kafka.offsets('dogs', EARLIEST_OFFSET, 1, callback=self.stop)
+            self.assertEquals([0], self.wait())
+            kafka._disconnect()
+
+        def test_fetch_stream_needs_callback(self):
+            kafka = KafkaTornado(io_loop=self.io_loop)
+            self.assertRaises(ValueError, kafka.fetch_stream, 'dogs', 0)
+
+        def test_write_retry_keeps_waiting_requests(self):
+            with FakeBroker(latency=0.05) as broker:
+                Kafka(broker.host, broker.port).produce('dogs', 'Rusty')
+                kafka = KafkaTornado(broker.host, broker.port, 
+                    io_loop=self.io_loop, max_in_flight=1)
+                results = []
+                def done(result):
+                    results.append(result)
+                    if len(results) == 2:
+                        self.stop()
+                # One in flight, one waiting for its slot
+                kafka.fetch('dogs', 0, callback=done, errback=done)
+                kafka.fetch('dogs', 0, callback=done, errback=done)
+                stream = kafka._stream
+                def write(data, callback=None):
+                    raise IOError('Broken pipe')
+                stream.write = write
+                kafka.produce('dogs', 'Fido')
+                self.wait()
+                stream.close()
+
+                # Only the request that was written on the lost connection 
+                # fails, the waiting one goes out on the new one
+                self.assertTrue(isinstance(results[0], ConnectionFailure))
+                self.assertEquals(['Rusty', 'Fido'],
+                    [message for offset, message in results[1]])
+                kafka._disconnect()
+            broker.close()
+
+        def test_async_producer(self):
+            with FakeBroker() as broker:
+                kafka = KafkaTornado(broker.host, broker.port, 
+                    io_loop=self.io_loop)
+                producer = AsyncProducerTornado(kafka, batch_messages=2, 
+                    linger_ms=20, max_queue_bytes=100)
+                # A full batch goes out on the next IOLoop iteration, the 
+                # others after linger_ms
+                producer.send('dogs', ['Rusty', 'Patty'])
+                producer.send('dogs', 'Jack', 1)
+                self.assertRaises(QueueFull, producer.send, 'dogs', 
+                    'x' * 100)
+                self.io_loop.add_timeout(time.time() + 0.1, self.stop)
+                self.wait()
+
+                producer.send('dogs', 'Clyde', 1)
+                producer.close(callback=self.stop)
+                self.wait()
+                wait_for_messages()
+
+                reader = Kafka(broker.host, broker.port)
+                self.assertEquals(['Rusty', 'Patty'], 
+                    [message for offset, message in reader.fetch('dogs', 0)])
+                self.assertEquals(['Jack', 'Clyde'], 
+                    [message for offset, message 
+                     in reader.fetch('dogs', 0, 1)])
+                self.assertEquals(0, producer.queued_bytes)
+                reader._disconnect()
+                kafka._disconnect()
+            broker.close()
+
+        def test_topic_consumer(self):
+            with FakeBroker() as broker:
+                writer = Kafka(broker.host, broker.port)
+                for partition in range(3):
+                    writer.produce('dogs', ['p{0}m0'.format(partition), 
+                        'p{0}m1'.format(partition)], partition)
+
+                kafka = KafkaTornado(broker.host, broker.port, 
+                    io_loop=self.io_loop)
+                consumer = TopicConsumerTornado(kafka, 'dogs', 
+                    dict.fromkeys(range(4), 0), max_size=20, 
+                    poll_interval=0.01)
+                received = dict((partition, []) for partition in range(4))
+                def on_batch(partition, messages):
+                    received[partition].extend(
+                        message for offset, message in messages)
+                    if sum(len(messages) 
+                           for messages in received.values()) == 7:
+                        self.stop()
+                consumer.start(on_batch)
+                # Partition 3 is polled until something comes
+                writer.produce('dogs', 'p3m0', 3)
+                self.wait()
+                consumer.close()
+
+                for partition in range(3):
+                    self.assertEquals(['p{0}m0'.format(partition), 
+                        'p{0}m1'.format(partition)], received[partition])
+                    self.assertEquals(26, consumer.offsets[partition])
+                self.assertEquals(['p3m0'], received[3])
+                self.assertEquals(13, consumer.offsets[3])
+                writer._disconnect()
+                kafka._disconnect()
+            broker.close()
+
+        def test_topic_consumer_errors(self):
+            with FakeBroker() as broker:
+                writer = Kafka(broker.host, broker.port)
+                writer.produce('dogs', 'Rusty', 1)
+
+                kafka = KafkaTornado(broker.host, broker.port,
+                    io_loop=self.io_loop)
+                consumer = TopicConsumerTornado(kafka, 'dogs',
+                    {0: 1000, 1: 0}, poll_interval=0.01)
+                received = []
+                errors = []
+                def on_batch(partition, messages):
+                    received.extend(message for offset, message in messages)
+                    self.stop()
+                def on_error(partition, error):
+                    errors.append((partition, error))
+                consumer.start(on_batch, on_error)
+                self.wait()
+                self.assertEquals(['Rusty'], received)
+                self.assertEquals(1, len(errors))
+                self.assertEquals(0, errors[0][0])
+                self.assertTrue(isinstance(errors[0][1], OffsetOutOfRange))
+
+                # Partition 1 carries on over a new connection
+                kafka._stream.close()
+                writer.produce('dogs', 'Patty', 1)
+                self.wait()
+                self.assertEquals(['Rusty', 'Patty'], received)
+                self.assertEquals(1, len(errors))
+                consumer.close()
+                writer._disconnect()
+                kafka._disconnect()
+            broker.close()
+
+
+if has_asyncio:
+    class TestKafkaAsyncio(unittest.TestCase):
+        def setUp(self):
+            self.loop = asyncio.new_event_loop()
+
+        def tearDown(self):
+            self.loop.close()
+
+        def run_coroutine(self, coroutine):
+            return self.loop.run_until_complete(coroutine)
+
+        def test_kafka_asyncio(self):
+            kafka = KafkaAsyncio(loop=self.loop, max_in_flight=2)
+            topic = get_unique_topic('test-kafka-asyncio')
+            input_messages = ['message0', 'message1', 'message2']
+
+            self.run_coroutine(kafka.produce(topic, input_messages))
+            wait_for_messages()
+
+            # More requests than there are in-flight slots, all at once
+            fetches = [kafka.fetch(topic, 0) for i in range(5)]
+            offsets = kafka.multi_offsets([
+                (topic, 0, EARLIEST_OFFSET, 1), 
+                (topic, 0, LATEST_OFFSET, 1),
+            ])
+            results = self.run_coroutine(asyncio.gather(
+                offsets, *fetches, loop=self.loop))
+
+            self.assertEquals([[0], [3 * Lengths.MESSAGE_HEADER + 
+                len(''.join(input_messages))]], results[0])
+            for fetch_results in results[1:]:
+                self.assertEquals(input_messages, 
+                    [message for offset, message in fetch_results])
+
+            self.assertRaises(OffsetOutOfRange, self.run_coroutine, 
+                kafka.fetch(topic, 1000))
+            kafka.close()
+
+        def test_poll(self):
+            kafka = KafkaAsyncio(loop=self.loop)
+            topic = get_unique_topic('test-kafka-asyncio-poll')
+            self.run_coroutine(kafka.produce(topic, ['Rusty', 'Patty']))
+            wait_for_messages()
+
+            dogs = kafka.partition(topic).poll(0, end_offset=14, 
+                poll_interval=None)
+            status, messages = self.run_coroutine(dogs.next())
+            self.assertEquals(['Rusty', 'Patty'], messages)
+            self.assertEquals(28, status.next_offset)
+            self.assertEquals(None, self.run_coroutine(dogs.next()))
+
+            self.assertRaises(InvalidOffset, self.run_coroutine, 
+                kafka.partition(topic).poll(5).next())
+
+            dogs = kafka.partition(topic).poll(0, poll_interval=None, 
+                max_size=10)
+            self.assertRaises(MessageTooLarge, self.run_coroutine, 
+                dogs.next())
+            kafka.close()
+
+
+class TestRequestEncoding(unittest.TestCase):
+    def test_produce_request(self):
+        request = Codec().produce_request('topic', ['Rusty', 'Patty'], 1)
+        # The payloads are passed through rather than copied
+        self.assertEqual(['Rusty', 'Patty'], request[2::2])
+
+        data = ''.join(request)
+        request_size, request_type, topic_length = struct.unpack_from('>IHH', 
+            data)
+        self.assertEqual(len(data) - Lengths.RESPONSE_SIZE, request_size)
+        self.assertEqual(0, request_type)
+        self.assertEqual(len('topic'), topic_length)
+
+
+    def test_fetch_request(self):
+        codec = Codec()
+        # The topic/partition headers are cached, make sure each partition
+        # gets its own
+        for partition in [1, 2, 1]:
+            request = codec.fetch_request('topic', 1234, partition, 4096)
+            self.assertEqual((len(request) - Lengths.RESPONSE_SIZE, 1, 5, 
+                'topic', partition, 1234, 4096), 
+                struct.unpack('>IHH5sIQI', request))
+
+
+class TestMessageSetParsing(unittest.TestCase):
+    def setUp(self):
+        self.codec = Codec()
+        self.messages = ['Rusty', 'Patty', 'Jack', 'Clyde']
+        # A fetch response: <<uint:2 error code, message set>>
+        self.response = struct.pack('>H', 0) + \
+            self.codec.encode_message_set(self.messages)
+
+    def parse(self, data, include_corrupt=False):
+        return self.codec.parse_message_buffer(0, data, 
+            Lengths.ERROR_CODE, len(data), include_corrupt)
+
+    def test_matches_stringio_parser(self):
+        response_buffer = StringIO(self.response)
+        response_buffer.read(Lengths.ERROR_CODE)
+        expected = list(self.codec.parse_message_set(0, response_buffer))
+        self.assertEqual(expected, self.parse(self.response))
+        self.assertEqual([(0, 'Rusty'), (14, 'Patty'), (28, 'Jack'), 
+            (41, 'Clyde')], self.parse(self.response))
+
+    def test_truncated_message(self):
+        self.assertEqual(self.messages[:3], 
+            [message for offset, message in self.parse(self.response[:-1])])
+
+    def test_corrupt_message(self):
+        data = self.response[:-1] + 'X'
+        self.assertEqual([False, False, False, True], 
+            [corrupt for offset, message, corrupt 
+             in self.parse(data, include_corrupt=True)])
+
+    def test_verify_message_set(self):
+        self.assertEqual([], self.codec.verify_message_set(self.response, 
+            Lengths.ERROR_CODE))
+        data = self.response[:-1] + 'X'
+        self.assertEqual([len(data) - Lengths.MESSAGE_HEADER - 
+            len(self.messages[-1])], 
+            self.codec.verify_message_set(data, Lengths.ERROR_CODE))
+
+        # Not checked at all when asked not to
+        self.codec.verify_checksums = False
+        self.assertEqual([False] * 4, 
+            [corrupt for offset, message, corrupt 
+             in self.parse(data, include_corrupt=True)])
+
+    def test_next_offset(self):
+        self.assertEqual(55, self.parse(self.response).next_offset)
+        self.assertEqual(41, self.parse(self.response[:-1]).next_offset)
+
+    def test_compressed_messages(self):
+        response = struct.pack('>H', 0) + \
+            self.codec.encode_message_set(self.messages[:3], 
+                COMPRESSION_GZIP) + \
+            self.codec.encode_message_set(self.messages[3:])
+        messages = self.parse(response)
+
+        self.assertEqual(self.messages, 
+            [message for offset, message in messages])
+        # The messages unpacked from the compressed one share its offset
+        compressed_length = len(response) - Lengths.ERROR_CODE - \
+            Lengths.MESSAGE_HEADER - len(self.messages[3])
+        self.assertEqual([0, 0, 0, compressed_length], 
+            [offset for offset, message in messages])
+        self.assertEqual(len(response) - Lengths.ERROR_CODE, 
+            messages.next_offset)
+
+    def test_lazy(self):
+        response = self.response + \
+            self.codec.encode_message_set(['Biscuit', 'Rex'], COMPRESSION_GZIP)
+        expected = self.parse(response)
+        self.codec.lazy = True
+        messages = self.parse(response)
+        self.assertTrue(isinstance(messages, LazyMessageSet))
+        self.assertEqual(list(expected), list(messages))
+        self.assertEqual(expected.next_offset, messages.next_offset)
+        self.assertEqual((14, 'Patty'), messages[1])
+        self.assertEqual('Rex', messages[-1].payload)
+        self.assertEqual(['Rusty', 'Rex'], 
+            [message.payload for message in messages.with_prefix('R')])
+
+        self.codec.zero_copy = True
+        self.assertEqual([False, False, False, False, False, False], 
+            [corrupt for offset, message, corrupt 
+             in self.parse(response, include_corrupt=True)])
+        self.assertEqual([0, 55], [message.offset for message in 
+                                   self.parse(response).with_prefix('R')])
+
+    def test_zero_copy(self):
+        self.codec.zero_copy = True
+        messages = self.parse(self.response)
+        self.assertTrue(all(isinstance(message, memoryview) 
+                            for offset, message in messages))
+        self.assertEqual(self.messages, 
+            [message.tobytes() for offset, message in messages])
+
+
+class TestConnection(unittest.TestCase):
+    def respond(self, body):
+        return struct.pack('>I', len(body)) + body
+
+    def test_requests_are_framed_into_buffer(self):
+        connection = Connection()
+        buffer = bytearray()
+        connection.fetch('dogs', 0, buffer=buffer)
+        connection.offsets('dogs', LATEST_OFFSET, 1, buffer=buffer)
+        codec = Codec()
+        self.assertEqual(codec.fetch_request('dogs', 0, 0, 1024 * 1024) + 
+            codec.offsets_request('dogs', LATEST_OFFSET, 1, 0), str(buffer))
+        self.assertEqual(2, connection.pending)
+
+    def test_responses_become_events(self):
+        connection = Connection()
+        connection.fetch('dogs', 0, token='fetch')
+        connection.offsets('dogs', LATEST_OFFSET, 1, token='offsets')
+        connection.fetch('dogs', 1000, token='out of range')
+
+        data = self.respond(struct.pack('>H', 0) + 
+            Codec().encode_message_set(['Rusty', 'Patty'])) + \
+            self.respond(struct.pack('>HLQ', 0, 1, 28)) + \
+            self.respond(struct.pack('>H', 1))
+        # Responses split anywhere come out whole
+        self.assertEqual([], connection.receive_data(data[:3]))
+        events = connection.receive_data(data[3:40])
+        self.assertEqual([Response('fetch', [(0, 'Rusty'), (14, 'Patty')])],
+            events)
+        events = connection.receive_data(data[40:])
+        self.assertEqual(Response('offsets', [28]), events[0])
+        self.assertEqual('out of range', events[1].token)
+        self.assertTrue(isinstance(events[1].error, OffsetOutOfRange))
+        self.assertEqual(0, connection.pending)
+
+    def test_streamed_fetch(self):
+        connection = Connection()
+        connection.fetch_stream('dogs', 0, token='stream')
+        connection.fetch('dogs', 0, token='fetch')
+
+        message_set = Codec().encode_message_set(['Rusty', 'Patty', 'Jack'])
+        body = struct.pack('>H', 0) + message_set
+        data = self.respond(body[:-1]) + self.respond(body)
+        events = []
+        for i in range(len(data)):
+            events.extend(connection.receive_data(data[i]))
+            if i == 4 + 2 + 14:
+                # The first message is out as soon as it is complete
+                self.assertEqual([MessagesReceived('stream', [(0, 'Rusty')])],
+                    events)
+
+        self.assertEqual([(0, 'Rusty'), (14, 'Patty')], 
+            [event.messages[0] for event in events 
+             if isinstance(event, MessagesReceived)])
+        streamed, fetched = [event for event in events 
+                             if isinstance(event, Response)]
+        self.assertEqual(('stream', []), streamed)
+        self.assertEqual(28, streamed.result.next_offset)
+        self.assertEqual(len(message_set) - 1 - 28, streamed.result.truncated)
+        self.assertEqual('fetch', fetched.token)
+        self.assertEqual(3, len(fetched.result))
+        self.assertEqual(0, connection.pending)
+
+    def test_stream_large_message(self):
+        codec = Codec()
+        message_set = codec.encode_message_set(['x' * 100000, 'Rusty'])
+        stream = MessageSetStream(codec, 0)
+        messages = []
+        # Pieces that split the length of the second message too
+        for start in range(0, len(message_set), 1001):
+            messages.extend(stream.feed(message_set[start:start + 1001]))
+        self.assertEqual(['x' * 100000, 'Rusty'], 
+            [message for offset, message in messages])
+        self.assertEqual(len(message_set), stream.finish().next_offset)
+
+        stream = MessageSetStream(codec, 0)
+        self.assertEqual(1, len(stream.feed(message_set[:-1])))
+        finished = stream.finish()
+        self.assertEqual(100000 + Lengths.MESSAGE_HEADER, 
+            finished.next_offset)
+        self.assertEqual(len('Rusty') + Lengths.MESSAGE_HEADER - 1, 
+            finished.truncated)
+
+    def test_connection_lost(self):
+        connection = Connection()
+        connection.fetch('dogs', 0, token='fetch')
+        error = ConnectionFailure()
+        self.assertEqual([ResponseFailed('fetch', error)], 
+            connection.connection_lost(error))
+        self.assertEqual(0, connection.pending)
+
+
+class TestAdaptiveFetch(unittest.TestCase):
+    def test_grows_for_large_messages(self):
+        policy = AdaptiveFetch(1024, max_fetch_size=4096)
+        self.assertEqual(0, policy.fetched(0, MessageSet([], 0, 1024)))
+        self.assertEqual(2048, policy.max_size)
+        policy.fetched(0, MessageSet([], 0, 2048))
+        self.assertEqual(4096, policy.max_size)
+        self.assertRaises(MessageTooLarge, policy.fetched, 0, 
+            MessageSet([], 0, 4096))
+
+    def test_grows_when_busy_and_shrinks_when_quiet(self):
+        policy = AdaptiveFetch(1024, min_size=256)
+        policy.fetched(0, MessageSet([(0, 'x' * 1000)], 1009, 15))
+        self.assertEqual(2048, policy.max_size)
+        for i in range(AdaptiveFetch.SHRINK_AFTER):
+            policy.fetched(0, MessageSet([(0, 'x')], 10))
+        self.assertEqual(1024, policy.max_size)
+        for i in range(10 * AdaptiveFetch.SHRINK_AFTER):
+            policy.fetched(0, MessageSet([(0, 'x')], 10))
+        self.assertEqual(256, policy.max_size)
+
+    def test_backs_off_when_idle(self):
+        policy = AdaptiveFetch(poll_interval=1, max_poll_interval=4)
+        delays = [policy.fetched(0, MessageSet([], 0)) for i in range(5)]
+        for delay, limit in zip(delays, [1, 2, 4, 4, 4]):
+            self.assertTrue(limit / 2.0 <= delay <= limit)
+        policy.fetched(0, MessageSet([(0, 'x')], 10))
+        self.assertTrue(policy.fetched(10, MessageSet([], 10)) <= 1)
+
+
+class TestPartitioner(unittest.TestCase):
+    def test_hash(self):
+        partitioner = HashPartitioner({'dogs': 4, 'cats': 2})
+        partitions = [partitioner.partition('dogs', 'dog{0}'.format(i), [])
+                      for i in range(100)]
+        self.assertEqual(set(range(4)), set(partitions))
+        self.assertEqual(partitions, [partitioner.partition('dogs', 
+            'dog{0}'.format(i), []) for i in range(100)])
+        self.assertTrue(partitioner.partition('cats', None, []) in (0, 1))
+        self.assertRaises(ValueError, partitioner.partition, 'birds', 'a', [])
+
+    def test_round_robin(self):
+        partitioner = RoundRobinPartitioner(3)
+        self.assertEqual([0, 1, 2, 0, 0], [
+            partitioner.partition('dogs', None, []),
+            partitioner.partition('dogs', None, []),
+            partitioner.partition('dogs', None, []),
+            partitioner.partition('dogs', None, []),
+            partitioner.partition('cats', None, [])])
+
+        # Producer threads share it, and still take turns
+        partitions = []
+        def produce():
+            for i in range(3000):
+                partitions.append(partitioner.partition('birds', None, []))
+        threads = [threading.Thread(target=produce) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([4000, 4000, 4000], 
+            [partitions.count(partition) for partition in range(3)])
+
+    def test_least_loaded(self):
+        partitioner = LeastLoadedPartitioner(3)
+        partitioner.queued('dogs', 0, 100)
+        partitioner.queued('dogs', 1, 50)
+        self.assertEqual(2, partitioner.partition('dogs', None, []))
+        partitioner.queued('dogs', 2, 200)
+        self.assertEqual(1, partitioner.partition('dogs', None, []))
+        partitioner.sent('dogs', 0, 100)
+        self.assertEqual(0, partitioner.pending('dogs', 0))
+        self.assertEqual(0, partitioner.partition('dogs', None, []))
+
+    def test_produce(self):
+        kafka = Kafka(partitioner=RoundRobinPartitioner(2))
+        topic = get_unique_topic('test-partitioner')
+        kafka.produce(topic, 'message0')
+        kafka.produce(topic, 'message1')
+        kafka.produce(topic, 'message2', partition=0)
+
+        partitioner = LeastLoadedPartitioner(2)
+        producer = AsyncProducer(kafka, partitioner=partitioner, 
+            linger_ms=1000)
+        producer.send(topic, ['message3', 'message4'])
+        producer.send(topic, 'message5')
+        self.assertEqual(2, len(producer._batches))
+        producer.close()
+        self.assertEqual(0, partitioner.pending(topic, 0))
+        wait_for_messages()
+
+        self.assertEqual(['message0', 'message2', 'message3', 'message4'], 
+            [message for offset, message in kafka.fetch(topic, 0)])
+        self.assertEqual(['message1', 'message5'], 
+            [message for offset, message in kafka.fetch(topic, 0, 1)])
+
+class TestFakeBroker(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_requests(self):
+        broker = FakeBroker(partitions={'dogs': 2}, log_dir=self.directory)
+        with broker:
+            kafka = Kafka(broker.host, broker.port)
+            kafka.multi_produce({('dogs', 0): 'woof', ('dogs', 1): 'wuff'})
+            kafka.produce('dogs', 'bark', 1)
+            self.assertEqual(['wuff', 'bark'], 
+                [message for offset, message in kafka.fetch('dogs', 0, 1)])
+            latest = 2 * Lengths.MESSAGE_HEADER + len('wuffbark')
+            self.assertEqual([latest, 0], 
+                kafka.offsets('dogs', LATEST_OFFSET, 10, 1))
+            self.assertEqual([0], kafka.offsets('dogs', EARLIEST_OFFSET, 10, 1))
+            self.assertRaises(OffsetOutOfRange, kafka.fetch, 'dogs', 
+                latest + 1, 1)
+            self.assertRaises(WrongPartitionCode, kafka.fetch, 'dogs', 0, 2)
+            kafka._disconnect()
+        broker.close()
+
+        # The logs are kept in files, and so outlive the broker
+        with FakeBroker(log_dir=self.directory) as broker:
+            kafka = Kafka(broker.host, broker.port)
+            self.assertEqual(['woof'], 
+                [message for offset, message in kafka.fetch('dogs', 0)])
+            kafka._disconnect()
+        broker.close()
+
+    def test_latency(self):
+        with FakeBroker(latency=0.05) as broker:
+            kafka = Kafka(broker.host, broker.port)
+            start = time.time()
+            kafka.fetch('dogs', 0)
+            self.assertTrue(time.time() - start >= 0.05)
+            kafka._disconnect()
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram(smallest=1, num_buckets=4)
+        for value in [0.5, 1, 3, 3, 3, 100]:
+            histogram.add(value)
+        self.assertEqual(6, histogram.count)
+        self.assertEqual(1, histogram.percentile(30))
+        self.assertEqual(4, histogram.percentile(50))
+        self.assertEqual(100, histogram.percentile(99))
+        self.assertEqual(None, Histogram().percentile(50))
+
+    def test_codec(self):
+        metrics = MemoryMetrics()
+        codec = Codec(metrics=metrics)
+        data = struct.pack('>H', 0) + codec.encode_message_set(['woof', 
+            'bark'])
+        codec.decode_fetch_response(data[:-1] + 'X', 0)
+        codec.decode_fetch_response(data[:-1], 0)
+        self.assertEqual({'messages.fetched': 3, 'messages.corrupt': 1,
+            'fetches.truncated': 1}, metrics.counters)
+
+    def test_client(self):
+        metrics = MemoryMetrics()
+        kafka = Kafka(metrics=metrics)
+        topic = get_unique_topic('test-metrics')
+        kafka.produce(topic, ['message0', 'message1'])
+        wait_for_messages()
+        kafka.fetch(topic, 0)
+        kafka.fetch(topic, 0, max_size=Lengths.MESSAGE_HEADER + 10)
+        kafka.offsets(topic, LATEST_OFFSET, 1)
+
+        counters = metrics.counters
+        self.assertEqual(1, counters['requests.produce'])
+        self.assertEqual(2, counters['requests.fetch'])
+        self.assertEqual(1, counters['requests.offsets'])
+        self.assertEqual(3, counters['messages.fetched'])
+        self.assertEqual(1, counters['fetches.truncated'])
+        self.assertEqual(kafka.total_read, counters['bytes_received'])
+        self.assertTrue(counters['bytes_sent'] > 0)
+        self.assertEqual(2, metrics.histograms['latency.fetch'].count)
+
+        sent = []
+        kafka.metrics = CallbackMetrics(
+            lambda *args: sent.append(args), prefix='kafka.')
+        kafka.produce(topic, 'message2')
+        request = kafka.codec.produce_request(topic, ['message2'], 0)
+        self.assertEqual([('kafka.requests.produce', 1, 'c'), 
+            ('kafka.bytes_sent', len(''.join(request)), 'c')], sent)
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_store(self, make_store):
+        checkpoint = Checkpoint(make_store(), every_messages=10, 
+            every_seconds=60)
+        checkpoint.commit('dogs', 0, 14)
+        checkpoint.commit('dogs', 1, 28, messages=2)
+        self.assertEqual(14, checkpoint.offset('dogs', 0))
+        # Nothing is due yet
+        self.assertEqual({}, make_store().load())
+
+        checkpoint.commit('dogs', 0, 41, messages=10)
+        checkpoint.close()
+        offsets = make_store().load()
+        self.assertEqual({('dogs', 0): 41, ('dogs', 1): 28}, offsets)
+        self.assertEqual([str, str], 
+            [type(topic) for topic, partition in offsets])
+
+        checkpoint = Checkpoint(make_store())
+        self.assertEqual(41, checkpoint.offset('dogs'))
+        self.assertEqual(None, checkpoint.offset('cats'))
+        checkpoint.close()
+
+    def test_file_store(self):
+        path = os.path.join(self.directory, 'offsets.json')
+        self.check_store(lambda: FileOffsetStore(path))
+
+    def test_sqlite_store(self):
+        path = os.path.join(self.directory, 'offsets.db')
+        self.check_store(lambda: SQLiteOffsetStore(path))
+
 
 class TestTopic(unittest.TestCase):
     # Contents of self.dogs_queue after setUp:
@@ -132,7 +1322,7 @@ class TestTopic(unittest.TestCase):
         # If you don't do this sleep, then you can get into a condition where
         # a fetch immediately after a produce will cause a state where the 
         # produce is duplicated (it really gets that way in Kafka).
-        time.sleep(MESSAGE_DELAY_SECS)
+        wait_for_messages()
         self.dogs_queue = self.k.topic(self.topic_name)
         
         # print list(self.k.fetch(self.topic_name, 0))
@@ -156,6 +1346,93 @@ class TestTopic(unittest.TestCase):
         self.assertEqual(status.num_fetches, 1)
         self.assertEqual(messages, ['Rusty', 'Patty', 'Jack'])
         self.assertRaises(StopIteration, dogs.next)
+
+    def test_message_larger_than_max_size(self):
+        self.k.produce(self.topic_name, 'Rex' * 100)
+        wait_for_messages()
+        latest_offset_calls = []
+        latest_offset = self.dogs_queue.latest_offset
+        def count_latest_offset(*args, **kwargs):
+            latest_offset_calls.append(args)
+            return latest_offset(*args, **kwargs)
+        self.dogs_queue.latest_offset = count_latest_offset
+
+        dogs = self.dogs_queue.poll(41, poll_interval=None, max_size=20, 
+                                    adaptive=True)
+        messages = []
+        while len(messages) < 2:
+            status, batch = dogs.next()
+            messages.extend(batch)
+        self.assertEqual(messages, ['Clyde', 'Rex' * 100])
+        # Once for the message, not for each larger fetch
+        self.assertEqual(1, len(latest_offset_calls))
+
+        # Without adaptive, max_size stays what it is
+        dogs = self.dogs_queue.poll(41, poll_interval=None, max_size=20)
+        self.assertEqual(['Clyde'], dogs.next()[1])
+        self.assertRaises(MessageTooLarge, dogs.next)
+
+    def test_checkpoint(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'offsets.db')
+            checkpoint = Checkpoint(SQLiteOffsetStore(path))
+            dogs = self.dogs_queue.poll(0, poll_interval=None, max_size=30, 
+                                        checkpoint=checkpoint)
+            status, messages = dogs.next()
+            self.assertEqual(messages, ['Rusty', 'Patty'])
+            # Only counts as processed when we ask for more
+            self.assertEqual(None, checkpoint.offset(self.topic_name))
+            dogs.next()
+            dogs.close()
+            checkpoint.close()
+
+            checkpoint = Checkpoint(SQLiteOffsetStore(path))
+            dogs = self.dogs_queue.poll(poll_interval=None, 
+                                        checkpoint=checkpoint)
+            status, messages = dogs.next()
+            self.assertEqual(messages, ['Jack', 'Clyde'])
+            checkpoint.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_prefetch(self):
+        # Small fetches so there's more than one batch to read ahead
+        dogs = self.dogs_queue.poll(0, end_offset=41, poll_interval=None, 
+                                    max_size=30, prefetch=2)
+        messages = []
+        for status, batch in dogs:
+            messages.extend(batch)
+        self.assertEqual(messages, ['Rusty', 'Patty', 'Jack', 'Clyde'])
+        self.assertEqual(status.next_offset, 55)
+        # Going back discards whatever was fetched ahead
+        dogs = self.dogs_queue.poll(14, poll_interval=None, prefetch=2)
+        status, messages = dogs.next()
+        self.assertEqual(messages, ['Patty', 'Jack', 'Clyde'])
+        dogs.close()
+
+    def test_prefetch_other_offset_while_fetching(self):
+        fetching = threading.Event()
+        release = threading.Event()
+        def fetch(offset):
+            if offset == 1:
+                fetching.set()
+                release.wait()
+            return MessageSet([offset], offset + 1)
+        prefetcher = _Prefetcher(fetch, 2)
+        self.assertEqual([0], prefetcher(0))
+
+        # Asked for another offset while reading ahead from 1
+        fetching.wait()
+        batches = []
+        thread = threading.Thread(target=lambda: batches.append(prefetcher(5)))
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.05)
+        release.set()
+        thread.join(5)
+        prefetcher.stop()
+        self.assertEqual([[5]], batches)
     
         
 